@@ -0,0 +1,279 @@
+# The async serving mode: a small ASGI application that runs the item, store and user resources as coroutines
+# on an async SQLAlchemy engine, so a request waiting on the database or on a slow client does not hold a thread
+# The resources of both modes share the models, the request and response schemas, the cache, the password hasher,
+# the blocklist and the JWT settings, so every response looks exactly the same in both modes
+# Start it with `gunicorn -c gunicorn.conf.py` and SERVER_MODE=async, or `uvicorn asgi:app` (see asgi.py)
+import re
+import json
+import asyncio
+import logging
+import functools
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import MultiDict, CombinedMultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags, parse_date
+from jwt import ExpiredSignatureError, InvalidTokenError
+from flask import current_app
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTDecodeError
+from schemas import dumps
+from blocklist import blocklist
+
+logger = logging.getLogger(__name__)
+
+# URL rules use the same syntax as Flask's, for example /item/<string:name> or /user/<int:user_id>
+RULE_CONVERTERS = {'string': (r'[^/]+', str), 'int': (r'\d+', int)}
+RULE_VARIABLE = re.compile(r'<(?:(\w+):)?(\w+)>')
+
+
+# Raised by the JWT decorators below. kind is one of the keys of the token_errors given to AsyncApi
+class TokenError(Exception):
+    def __init__(self, kind):
+        super().__init__(kind)
+        self.kind = kind
+
+
+# The request of the async mode. It has the attributes of Flask's request that our code reads (args, values,
+# get_json, the conditional headers...), so reqparse, the schemas, conditional.py and pagination.py work on it as well
+class AsyncRequest:
+    def __init__(self, scope, body, session):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope['query_string']
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = body
+        # The AsyncSession of this request, closed once the response is ready
+        self.session = session
+        # The decoded JWT, set by the decorators below (get_raw_jwt() in the sync mode)
+        self.jwt = None
+        self.args = MultiDict(parse_qsl(self.query_string.decode('latin-1'), keep_blank_values=True))
+        # scope['client'] is (host, port), or None when the server does not know it
+        self.remote_addr = scope['client'][0] if scope.get('client') else None
+
+    @property
+    def mimetype(self):
+        return self.headers.get('content-type', '').split(';', 1)[0].strip().lower()
+
+    @property
+    def form(self):
+        if self.mimetype == 'application/x-www-form-urlencoded':
+            return MultiDict(parse_qsl(self.body.decode('latin-1'), keep_blank_values=True))
+        return MultiDict()
+
+    @property
+    def values(self):
+        return CombinedMultiDict([self.args, self.form])
+
+    # Same as Flask's get_json(silent=True): the parsed JSON body, or None if the body is not JSON
+    def get_json(self, silent=True):
+        if self.mimetype != 'application/json' or not self.body:
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    @property
+    def json(self):
+        return self.get_json()
+
+    @property
+    def if_none_match(self):
+        return parse_etags(self.headers.get('if-none-match'))
+
+    @property
+    def if_modified_since(self):
+        return parse_date(self.headers.get('if-modified-since'))
+
+    # The identity and the claims of the JWT, like get_jwt_identity() and get_jwt_claims()
+    @property
+    def jwt_identity(self):
+        return self.jwt['identity'] if self.jwt else None
+
+    @property
+    def jwt_claims(self):
+        return self.jwt.get('user_claims', {}) if self.jwt else {}
+
+
+# Decodes the token of the Authorization header and checks it the way flask-jwt-extended's decorators do
+def _verify_token(request, token_type, fresh=False, optional=False):
+    header = request.headers.get('authorization')
+    if not header:
+        if optional:
+            return None
+        raise TokenError('missing')
+    # The header is 'Bearer <token>', or just the token when JWT_HEADER_TYPE is empty
+    parts = header.split()
+    header_type = current_app.config['JWT_HEADER_TYPE']
+    if parts[:-1] != ([header_type] if header_type else []):
+        raise TokenError('invalid')
+    try:
+        token = decode_token(parts[-1])
+    except ExpiredSignatureError:
+        raise TokenError('expired')
+    except (InvalidTokenError, JWTDecodeError):
+        raise TokenError('invalid')
+    if token.get('type') != token_type:
+        raise TokenError('invalid')
+    if blocklist.is_revoked(token):
+        raise TokenError('revoked')
+    if fresh and not token.get('fresh'):
+        raise TokenError('not_fresh')
+    return token
+
+
+def _token_decorator(token_type, fresh=False, optional=False):
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, request, *args, **kwargs):
+            request.jwt = _verify_token(request, token_type, fresh, optional)
+            return await method(self, request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# The async versions of flask-jwt-extended's decorators, for the methods of the async resources
+jwt_required = _token_decorator('access')
+jwt_optional = _token_decorator('access', optional=True)
+fresh_jwt_required = _token_decorator('access', fresh=True)
+jwt_refresh_token_required = _token_decorator('refresh')
+
+
+# Turns /item/<string:name> into a regular expression and the functions that convert every variable
+def _compile_rule(rule):
+    converters = {}
+    pattern = ''
+    position = 0
+    for match in RULE_VARIABLE.finditer(rule):
+        regex, convert = RULE_CONVERTERS[match.group(1) or 'string']
+        pattern += re.escape(rule[position:match.start()]) + f'(?P<{match.group(2)}>{regex})'
+        converters[match.group(2)] = convert
+        position = match.end()
+    pattern += re.escape(rule[position:])
+    return re.compile(pattern), converters
+
+
+# Splits what a resource method returned into body, status and headers, like Flask-RESTful does
+def _unpack(rv):
+    if not isinstance(rv, tuple):
+        return rv, 200, {}
+    body, status, headers = rv + (None,) * (3 - len(rv))
+    return body, status or 200, headers or {}
+
+
+# The ASGI application of the async mode. Works like Flask-RESTful's Api: every resource is a class and its
+# methods are named after the HTTP methods, except that they are coroutines and get the request as first argument
+class AsyncApi:
+    def __init__(self, engine, token_errors):
+        self.engine = engine
+        # Every request gets its own session. An AsyncSession cannot reload expired attributes behind our back,
+        # so the objects keep their values after a commit instead of being expired
+        self.session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        # The body sent with the 401 of every TokenError, the same ones the JWT callbacks of the sync mode send
+        self.token_errors = token_errors
+        self.routes = []
+
+    def add_resource(self, resource, rule):
+        pattern, converters = _compile_rule(rule)
+        self.routes.append((pattern, converters, resource()))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            body = await _read_body(receive)
+            status, payload, headers = await self.dispatch(scope, body)
+            # A resource returns an async generator of bytes for a response that is written as it is produced
+            if hasattr(payload, '__aiter__'):
+                await _send_stream(send, receive, status, payload, headers)
+            else:
+                await _send_response(send, status, payload, headers)
+
+    # Finds the resource of the request, runs it and returns the status, the body and the headers of the response
+    async def dispatch(self, scope, body):
+        for pattern, converters, resource in self.routes:
+            match = pattern.fullmatch(scope['path'])
+            if match:
+                break
+        else:
+            return 404, {'message': 'The requested URL was not found on the server. If you entered the URL manually please check your spelling and try again.'}, {}
+        method = getattr(resource, scope['method'].lower(), None)
+        if method is None:
+            return 405, {'message': 'The method is not allowed for the requested URL.'}, {}
+        kwargs = {name: converters[name](value) for name, value in match.groupdict().items()}
+
+        async with self.session_factory() as session:
+            request = AsyncRequest(scope, body, session)
+            try:
+                payload, status, headers = _unpack(await method(request, **kwargs))
+            except TokenError as error:
+                payload, status, headers = self.token_errors[error.kind], 401, {}
+            except HTTPException as error:
+                # flask_restful.abort(), used by reqparse, the schemas and pagination.py, attaches the body as data
+                payload, status, headers = getattr(error, 'data', {'message': error.description}), error.code, {}
+            except Exception:
+                logger.exception('Error while handling %s %s', scope['method'], scope['path'])
+                await session.rollback()
+                payload, status, headers = {'message': 'Internal Server Error'}, 500, {}
+        return status, payload, headers
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+# Reads the whole body of the request, which can arrive in several messages
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+# Sends the response. The body is encoded like output_json() does in the sync mode, and a 304 has no body at all
+async def _send_response(send, status, payload, headers):
+    if status == 304 or payload is None:
+        body = b''
+    else:
+        body = dumps(payload)
+        body = (body if isinstance(body, bytes) else body.encode()) + b'\n'
+    raw_headers = [(b'content-length', str(len(body)).encode())]
+    if body:
+        raw_headers.append((b'content-type', b'application/json'))
+    raw_headers += [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers.items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# Sends a streamed response, one chunk per item of the async generator chunks, until it ends or the client goes away
+# The server tells us about the disconnect on receive, so we wait on both and stop the generator when the client left
+async def _send_stream(send, receive, status, chunks, headers):
+    raw_headers = [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers.items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+
+    async def write():
+        async for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(write()), asyncio.ensure_future(disconnected())]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    # Cancelling the writer runs the finally blocks of the generator, which is how a stream unsubscribes
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()
@@ -1,92 +1,203 @@
-# Import flask libraries
-from flask import Flask
-from flask_restful import Api
-from flask_jwt_extended import JWTManager
-# Import our registers
-from resources.user import User, UserRegister, UserLogin, TokenRefresh
-from resources.item import Item, ItemList
-from resources.store import Store, StoreList
-# Import out database code
-from db import db 
-
-# Create the Flask application, passing in the file name
-app = Flask(__name__)
-
-# Specify a configuration property for SQLAlchemy
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///data.db' # Connect SQLAlchemy to our sqlite database which lives in the root of our project
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False # SQLAlchemy has its own modification tracker, so we can turn off Flask's version
-app.config['PROPOGATE_EXCEPTIONS'] = True # Without this, if Flask JWT raises a custom error, you won't see it
-
-# Should be something long, complicated and secure. It is used to encrypt the JWT
-app.secret_key = 'karan'
-# Allows us to easily add resources and routes. Every resource has to be a class
-api = Api(app)
-
-# Use a flask decorator to affect the method below it | It will run that method before the first request into the app
-@app.before_first_request
-# This will create our sqlite database using the config above unless it has been created already
-def create_tables():
-    # It is important to import the modals above so that SQLAlchemy knows which tables to create
-    db.create_all()
-
-jwt = JWTManager(app)
-
-@jwt.user_claims_loader
-def add_claims_to_jwt(identity):
-    # If the user is the first user in the database, they are an admin
-    if identity == 1: # Instead of hard-coding, you should read from a config file or database
-        return {'is_admin': True}
-    return {'is_admin': False}
-
-''' Configure token error messages. JWT has its own default messages, but if we wanted to configure them, here is how '''
-
-@jwt.expired_token_loader
-# When JWT realizes that a token has has expired, it will call this function to know what message it should send to the user
-def expired_token_callback():
-    return jsonify({'description': 'Your token has expired', 'error': 'token_expired'}), 401
-
-# Called when the token sent to us in the header is not an actual JWT
-@jwt.invalid_token_loader
-def invalid_token_callback(error):
-    return jsonify({'description': 'Signature verification failed', 'error': 'Invalid Token'}), 401
-
-# Called when a JWT is not sent at all
-@jwt.unauthorized_loader
-def missing_token_callback(error):
-    return jsonify({'description': 'Request does not contain an access token', 'error': 'authorization required'}), 401
-
-# Called when a non-fresh token is sent but we require a fresh token for the endpoint
-@jwt.needs_fresh_token_loader
-def token_not_fresh_callback(error):
-    return jsonify({'description': 'This Token is not Fresh', 'error': 'Fresh token required'}), 401
-
-# Called when a revokved token is used (Like when a user logs out)
-@jwt.revoked_token_loader
-def revoked_token_callback(error):
-    return jsonify({'description': 'This token has been revoked', 'error': 'Token Revoked'}), 401
-
-''' Add endpoints to the API '''
-
-# Tells our Api that this resource should become accessible through our Api. A resource is a route with different methods POST, GET, etc.
-# But we need an endpoint / route. We cannot use the @app.route decorator anymore though
-# The first parameter is the name of our resource, the second is the route URI
-api.add_resource(Item, '/item/<string:name>') # The name variable goes into the function parameter
-api.add_resource(ItemList, '/items')
-
-api.add_resource(User, '/user/<int:user_id>') # Pass in the user id 
-api.add_resource(UserRegister, '/register') # UserRegister is a resource in our user.py file
-api.add_resource(UserLogin, '/login')
-api.add_resource(TokenRefresh, '/refresh')
-
-api.add_resource(Store, '/store/<string:name>')
-api.add_resource(StoreList, '/stores')
-
-# This ensures that if we ever imported app.py from another file, it would not automatically start a Flask server
-# This will only run if app.py specifically is executed
-if __name__ == '__main__':
-    # Initializ our database
-    db.init_app(app) 
-    # Port 5000 is the default, but you can put it in to be explicit
-    # setting debug to true will improve the error messages
-    app.run(port=5000, debug=True) 
-
+# Import flask libraries
+from flask import Flask, jsonify
+from flask_restful import Api
+from flask_jwt_extended import JWTManager
+# Import our registers
+from resources.user import User, UserRegister, UserLogin, UserLogout, UserRevoke, TokenRefresh
+from resources.item import Item, ItemList, ItemBulk, ItemBatch
+from resources.store import Store, StoreList, StoreBatch
+from resources.cache import CacheStats
+from resources.change import Changes, ChangeStream
+# Import out database code
+from db import db, engine_options, set_sqlite_pragmas, replica_binds, init_replicas
+from cache import cache
+from config import Config
+from passwords import hasher
+from blocklist import blocklist
+from ratelimit import limiter
+from schemas import configure_json, output_json
+from metrics import metrics
+from changefeed import feed
+from writebehind import write_queue
+from shards import shards
+from models.user import UserModel
+from migrations import upgrade_db
+
+# The JWT manager is created here so the callbacks below can be registered on it, and linked to the app in create_app()
+jwt = JWTManager()
+
+@jwt.user_claims_loader
+# The role of the user is baked into the token, so the resources never query the database to check it
+# UserLogin passes the claims in itself, so this only runs when a token is refreshed
+def add_claims_to_jwt(identity):
+    user = UserModel.find_by_id(identity)
+    if user:
+        return user.claims()
+    return {'is_admin': False, 'role': 'user'}
+
+@jwt.token_in_blacklist_loader
+# Called for every request with a token. The blocklist lives in memory (or in the shared store), never in the database
+def check_if_token_revoked(decrypted_token):
+    return blocklist.is_revoked(decrypted_token)
+
+''' Configure token error messages. JWT has its own default messages, but if we wanted to configure them, here is how '''
+
+# The bodies of the 401 responses, shared with the async mode (see aio.py)
+TOKEN_ERRORS = {
+    'expired': {'description': 'Your token has expired', 'error': 'token_expired'},
+    'invalid': {'description': 'Signature verification failed', 'error': 'Invalid Token'},
+    'missing': {'description': 'Request does not contain an access token', 'error': 'authorization required'},
+    'not_fresh': {'description': 'This Token is not Fresh', 'error': 'Fresh token required'},
+    'revoked': {'description': 'This token has been revoked', 'error': 'Token Revoked'},
+}
+
+@jwt.expired_token_loader
+# When JWT realizes that a token has has expired, it will call this function to know what message it should send to the user
+def expired_token_callback():
+    return jsonify(TOKEN_ERRORS['expired']), 401
+
+# Called when the token sent to us in the header is not an actual JWT
+@jwt.invalid_token_loader
+def invalid_token_callback(error):
+    return jsonify(TOKEN_ERRORS['invalid']), 401
+
+# Called when a JWT is not sent at all
+@jwt.unauthorized_loader
+def missing_token_callback(error):
+    return jsonify(TOKEN_ERRORS['missing']), 401
+
+# Called when a non-fresh token is sent but we require a fresh token for the endpoint
+# Flask-JWT-Extended 3.x calls this one and the next one without arguments
+@jwt.needs_fresh_token_loader
+def token_not_fresh_callback():
+    return jsonify(TOKEN_ERRORS['not_fresh']), 401
+
+# Called when a revokved token is used (Like when a user logs out)
+@jwt.revoked_token_loader
+def revoked_token_callback():
+    return jsonify(TOKEN_ERRORS['revoked']), 401
+
+# This will create our sqlite database using the config, or apply any pending migrations if it already exists
+def create_tables():
+    # It is important to import the modals above so that SQLAlchemy knows which tables to create
+    upgrade_db()
+
+
+# Creates and configures the Flask application (the application factory pattern)
+# Anything passed in config overrides the defaults in config.py, which is how tests and benchmarks use another database
+def create_app(config=None):
+    # Create the Flask application, passing in the file name
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+    # Settings for the connection pool, unless they have been given explicitly
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    # The read replicas are extra binds of Flask-SQLAlchemy, which db.session picks for the reads of GET requests
+    app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, **replica_binds(app.config))
+
+    # Link our database, cache and JWT manager to the app
+    db.init_app(app)
+    # The databases the items are spread over when sharding is on (DB_SHARDS)
+    shards.init_app(app)
+    cache.init_app(app)
+    hasher.init_app(app)
+    jwt.init_app(app)
+    # After the JWT manager, which fills in the default token lifetimes the blocklist needs
+    blocklist.init_app(app)
+    limiter.init_app(app)
+    feed.init_app(app)
+    write_queue.init_app(app)
+    # The engine is created the first time we ask for it, so the pragmas run on every connection it ever opens
+    with app.app_context():
+        set_sqlite_pragmas(db.engine, app.config)
+        replicas = init_replicas(app)
+        # Request latency, SQL statement counts and timings, served on /metrics and in the Server-Timing header
+        metrics.init_app(app, db.engine, *replicas, *shards.engines)
+
+    # Use a flask method to run create_tables before the first request into the app
+    app.before_first_request(create_tables)
+
+    # Allows us to easily add resources and routes. Every resource has to be a class
+    api = Api(app)
+    # Encode the responses with the JSON encoder picked by JSON_BACKEND instead of Flask-RESTful's default one
+    configure_json(app)
+    api.representation('application/json')(output_json)
+
+    ''' Add endpoints to the API '''
+
+    # Tells our Api that this resource should become accessible through our Api. A resource is a route with different methods POST, GET, etc.
+    # But we need an endpoint / route. We cannot use the @app.route decorator anymore though
+    # The first parameter is the name of our resource, the second is the route URI
+    api.add_resource(Item, '/item/<string:name>') # The name variable goes into the function parameter
+    api.add_resource(ItemList, '/items')
+    api.add_resource(ItemBulk, '/items/bulk')
+    api.add_resource(ItemBatch, '/items/batch')
+
+    api.add_resource(User, '/user/<int:user_id>') # Pass in the user id 
+    api.add_resource(UserRegister, '/register') # UserRegister is a resource in our user.py file
+    api.add_resource(UserLogin, '/login')
+    api.add_resource(UserLogout, '/logout')
+    api.add_resource(UserRevoke, '/user/<int:user_id>/revoke')
+    api.add_resource(TokenRefresh, '/refresh')
+
+    api.add_resource(Store, '/store/<string:name>')
+    api.add_resource(StoreList, '/stores')
+    api.add_resource(StoreBatch, '/stores/batch')
+
+    api.add_resource(Changes, '/changes')
+    api.add_resource(ChangeStream, '/changes/stream')
+
+    api.add_resource(CacheStats, '/cache/stats')
+
+    return app
+
+# Same as create_app(), but returns the ASGI application of the async serving mode (see aio.py and asgi.py)
+# The Flask app is still created, because both modes share its configuration, JWT manager, cache, hasher and blocklist
+def create_async_app(config=None):
+    # Imported here because the async mode needs SQLAlchemy 1.4 and an async driver, which the sync mode does not
+    from aio import AsyncApi
+    from db import create_async_engine
+    from resources.async_item import AsyncItem, AsyncItemList
+    from resources.async_store import AsyncStore, AsyncStoreList
+    from resources.async_user import AsyncUser, AsyncUserRegister, AsyncUserLogin, AsyncUserLogout, AsyncUserRevoke, AsyncTokenRefresh
+    from resources.async_change import AsyncChanges, AsyncChangeStream
+
+    app = create_app(config)
+    # The async resources read and write the items in the primary database only
+    if shards.enabled:
+        raise ValueError('Sharding (DB_SHARDS) is not supported in the async serving mode')
+    # flask-jwt-extended and reqparse read their settings from current_app. Every request of the async mode runs on
+    # the thread of the event loop, so the application context is pushed once here and stays for the life of the process
+    app.app_context().push()
+    # There is no before_first_request in the async mode, so the migrations run now
+    create_tables()
+    # There is no before_request either, so the thread of the change feed (and of its compaction) starts now
+    feed.start()
+
+    api = AsyncApi(create_async_engine(app.config), TOKEN_ERRORS)
+    api.add_resource(AsyncItem, '/item/<string:name>')
+    api.add_resource(AsyncItemList, '/items')
+
+    api.add_resource(AsyncUser, '/user/<int:user_id>')
+    api.add_resource(AsyncUserRegister, '/register')
+    api.add_resource(AsyncUserLogin, '/login')
+    api.add_resource(AsyncUserLogout, '/logout')
+    api.add_resource(AsyncUserRevoke, '/user/<int:user_id>/revoke')
+    api.add_resource(AsyncTokenRefresh, '/refresh')
+
+    api.add_resource(AsyncStore, '/store/<string:name>')
+    api.add_resource(AsyncStoreList, '/stores')
+
+    api.add_resource(AsyncChanges, '/changes')
+    api.add_resource(AsyncChangeStream, '/changes/stream')
+    return api
+
+# This ensures that if we ever imported app.py from another file, it would not automatically start a Flask server
+# This will only run if app.py specifically is executed. This is the single-process development server,
+# in production run `gunicorn -c gunicorn.conf.py` instead
+if __name__ == '__main__':
+    app = create_app()
+    # Port 5000 is the default, but you can put it in to be explicit
+    # setting debug to true will improve the error messages
+    app.run(port=5000, debug=True)
@@ -0,0 +1,4 @@
+# Entrypoint for ASGI servers, the async serving mode: SERVER_MODE=async gunicorn -c gunicorn.conf.py, or uvicorn asgi:app
+from app import create_async_app
+
+app = create_async_app()
@@ -0,0 +1,42 @@
+# Benchmark for the bulk item import
+# Compares the rows per second of POST /items/bulk (JSON array and NDJSON) with one POST /item/<name> per item
+# Usage: python -m benchmarks.bulk_bench [--rows 50000] [--single-rows 1000]
+import argparse
+import json
+from benchmarks.common import make_client, login, timed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--single-rows', type=int, default=1000, help='one request per item is slow, so fewer rows are used')
+    args = parser.parse_args()
+
+    client = make_client()
+    headers = login(client)
+    client.post('/store/bench')
+
+    # One POST /item/<name> (and one commit) per item
+    def single():
+        for i in range(args.single_rows):
+            client.post(f'/item/single{i}', json={'price': i / 100, 'store_id': 1}, headers=headers)
+    seconds = timed(single)
+    print(f'POST /item/<name>     {args.single_rows:>8} rows {args.single_rows / seconds:>12.0f} rows/s')
+
+    # A JSON array of new items
+    rows = [{'name': f'array{i}', 'price': i / 100, 'store_id': 1} for i in range(args.rows)]
+    seconds = timed(lambda: client.post('/items/bulk', json=rows, headers=headers))
+    print(f'POST /items/bulk JSON {args.rows:>8} rows {args.rows / seconds:>12.0f} rows/s')
+
+    # NDJSON that updates every item of the JSON array above
+    body = ''.join(json.dumps(dict(row, price=row['price'] + 1)) + '\n' for row in rows)
+    seconds = timed(lambda: client.post('/items/bulk', data=body, content_type='application/x-ndjson', headers=headers))
+    print(f'POST /items/bulk NDJSON (updates) {args.rows:>8} rows {args.rows / seconds:>12.0f} rows/s')
+
+    # Export everything back out
+    seconds = timed(lambda: client.get('/items?format=ndjson').get_data())
+    print(f'GET /items?format=ndjson {args.rows + args.single_rows:>8} rows {(args.rows + args.single_rows) / seconds:>12.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main()
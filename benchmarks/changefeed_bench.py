@@ -0,0 +1,80 @@
+# Benchmark for the change feed of /changes/stream
+# Connects more and more clients to the feed of one process while a writer updates an item at a steady rate, and
+# measures how long a change takes to reach the clients and how many reads of the change log the process runs.
+# The price of every update is the time it was written, so each client can tell the latency of every event it gets
+# Polling instead would cost one read per client every poll, the feed should read the same whatever the number of clients
+# Usage: python -m benchmarks.changefeed_bench [--clients 1 10 100 500] [--seconds 5] [--writes 50]
+import json
+import time
+import argparse
+import threading
+from sqlalchemy import event
+from benchmarks.common import make_client, login
+from changefeed import feed
+from db import db
+from models.change import ChangeModel
+
+
+# A client of the feed: reads events from the stream until stop is set, and keeps the latency of every change
+def consume(since, latencies, stop):
+    for frame in feed.stream(since):
+        now = time.time()
+        for line in frame.split(b'\n'):
+            if line.startswith(b'data: '):
+                change = json.loads(line[6:])
+                if change.get('data'):
+                    latencies.append(now - change['data']['price'])
+        if stop.is_set():
+            return
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 100, 500])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--writes', type=int, default=50, help='Updates per second')
+    args = parser.parse_args()
+
+    client = make_client({'CHANGES_POLL_INTERVAL': 0.1, 'CHANGES_HEARTBEAT': 1})
+    headers = login(client)
+    client.post('/store/bench')
+    client.put('/item/bench', json={'price': time.time(), 'store_id': 1}, headers=headers)
+
+    # Counts the statements that read the change log
+    reads = [0]
+    with client.application.app_context():
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().startswith('SELECT') and 'FROM changes' in statement:
+                reads[0] += 1
+
+    print(f'{"clients":>8} {"events/s":>10} {"p50 ms":>9} {"p99 ms":>9} {"log reads/s":>12}')
+    for clients in args.clients:
+        with client.application.app_context():
+            since = ChangeModel.bounds()[1] or 0
+        latencies, stop = [], threading.Event()
+        threads = [threading.Thread(target=consume, args=(since, latencies, stop), daemon=True) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        # Let the clients connect and the feed start before we count
+        time.sleep(1)
+        reads[0] = 0
+        start = time.time()
+        while time.time() - start < args.seconds:
+            client.put('/item/bench', json={'price': time.time(), 'store_id': 1}, headers=headers)
+            time.sleep(1 / args.writes)
+        elapsed = time.time() - start
+        stop.set()
+        for thread in threads:
+            thread.join()
+        print(f'{clients:>8} {len(latencies) / elapsed:>10.0f} {percentile(latencies, 0.5):>9.1f} '
+              f'{percentile(latencies, 0.99):>9.1f} {reads[0] / elapsed:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+# Helpers shared by the benchmarks that drive the API in-process through Flask's test client
+import os
+import tempfile
+import time
+from app import create_app
+
+
+# Points the app at a brand new SQLite database in a temporary directory and returns a test client
+# config can override any other setting of config.py
+def make_client(config=None):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = create_app(dict({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}', 'TESTING': True}, **(config or {})))
+    return app.test_client()
+
+
+# Registers a user, logs in and returns the Authorization header for the access token
+# The first user registered gets id 1, which is the admin
+def login(client, username='bench', password='bench'):
+    client.post('/register', json={'username': username, 'password': password})
+    tokens = client.post('/login', json={'username': username, 'password': password}).get_json()
+    return {'Authorization': f'Bearer {tokens["access_token"]}'}
+
+
+# Calls func() and returns how many seconds it took
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
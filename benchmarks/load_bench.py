@@ -0,0 +1,152 @@
+# Load test comparing how many concurrent connections the sync (gthread) and async (uvicorn) serving modes can handle
+# Starts the real server with gunicorn.conf.py in each mode, one worker each, and opens more and more connections
+# that all request GET /item/<name> and GET /stores in a loop. --slow makes every client send its request in two halves
+# with a pause in between, like a client on a bad network, which holds a thread of the sync mode while it waits
+# Usage: python -m benchmarks.load_bench [--modes sync async] [--connections 10 100 500 1000] [--seconds 10] [--slow 0.2]
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+
+# Starts gunicorn in the given mode on a fresh database and waits until it answers
+def start_server(mode, port, threads):
+    path = os.path.join(tempfile.mkdtemp(), 'load.db')
+    env = dict(os.environ, SERVER_MODE=mode, BIND=f'127.0.0.1:{port}', WORKERS='1', THREADS=str(threads),
+               DATABASE_URL=f'sqlite:///{path}', METRICS_ENABLED='false', PASSWORD_HASH_ITERATIONS='1000')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/stores', timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'The {mode} server did not start')
+
+
+def call(port, method, path, body=None, token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    request = urllib.request.Request(f'http://127.0.0.1:{port}{path}', json.dumps(body).encode() if body else None, headers, method=method)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read() or b'null')
+
+
+# Creates a store with a few items to read during the test
+def seed(port, items=20):
+    call(port, 'POST', '/register', {'username': 'load', 'password': 'load'})
+    token = call(port, 'POST', '/login', {'username': 'load', 'password': 'load'})['access_token']
+    call(port, 'POST', '/store/load')
+    for number in range(items):
+        call(port, 'POST', f'/item/item-{number}', {'price': number, 'store_id': 1}, token)
+    return [f'/item/item-{number}' for number in range(items)] + ['/stores']
+
+
+# One client: a keep-alive connection sending requests until the deadline. Returns the latency of every request
+# and the number of failed requests (refused or reset connections, timeouts and non-200 answers)
+async def client(port, paths, deadline, slow, timeout):
+    latencies, errors = [], 0
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return latencies, 1
+    position = 0
+    while time.time() < deadline:
+        path = paths[position % len(paths)]
+        position += 1
+        request = f'GET {path} HTTP/1.1\r\nHost: localhost\r\nUser-Agent: load-bench\r\n\r\n'.encode()
+        start = time.perf_counter()
+        try:
+            if slow:
+                writer.write(request[:len(request) // 2])
+                await writer.drain()
+                await asyncio.sleep(slow)
+                writer.write(request[len(request) // 2:])
+            else:
+                writer.write(request)
+            status, length = await asyncio.wait_for(read_response(reader), timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            errors += 1
+            break
+        if status != 200:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+    return latencies, errors
+
+
+# Reads the status line, the headers and the body of a response. Returns the status and the length of the body
+async def read_response(reader):
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status, length
+
+
+async def run_level(port, paths, connections, seconds, slow, timeout):
+    deadline = time.time() + seconds
+    results = await asyncio.gather(*[client(port, paths, deadline, slow, timeout) for _ in range(connections)])
+    latencies = sorted(latency for client_latencies, _ in results for latency in client_latencies)
+    errors = sum(client_errors for _, client_errors in results)
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'])
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 100, 500, 1000])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--slow', type=float, default=0, help='Seconds every client waits in the middle of a request')
+    parser.add_argument('--threads', type=int, default=4, help='Threads of the sync worker')
+    parser.add_argument('--timeout', type=float, default=5, help='Seconds before a request counts as failed')
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    # Every connection needs a file descriptor on both ends
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError):
+        pass
+
+    loop = asyncio.get_event_loop()
+    print(f'{"mode":>6} {"conns":>6} {"req/s":>9} {"p50 ms":>9} {"p99 ms":>9} {"errors":>7}')
+    for mode in args.modes:
+        server = start_server(mode, args.port, args.threads)
+        try:
+            paths = seed(args.port)
+            for connections in args.connections:
+                latencies, errors = loop.run_until_complete(
+                    run_level(args.port, paths, connections, args.seconds, args.slow, args.timeout))
+                print(f'{mode:>6} {connections:>6} {len(latencies) / args.seconds:>9.0f} {percentile(latencies, 0.5):>9.1f} '
+                      f'{percentile(latencies, 0.99):>9.1f} {errors:>7}')
+        finally:
+            server.terminate()
+            server.wait()
+            # Give the port back before the next mode binds it
+            time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
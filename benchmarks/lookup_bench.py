@@ -0,0 +1,66 @@
+# Benchmark for the name lookups done on every request (find_by_name, find_by_username)
+# Measures the latency of SELECT ... WHERE name = ? LIMIT 1 against table size, without and with the indexes
+# that were added by the add_lookup_indexes migration
+# Usage: python -m benchmarks.lookup_bench [--sizes 1000 10000 100000] [--lookups 2000]
+import argparse
+import random
+import sqlite3
+import time
+
+# The tables as they were before the indexes were added
+SCHEMA = [
+    'CREATE TABLE stores (id INTEGER PRIMARY KEY, name VARCHAR(80))',
+    'CREATE TABLE items (id INTEGER PRIMARY KEY, name VARCHAR(80), price FLOAT, store_id INTEGER REFERENCES stores (id))',
+]
+# The same statements as the add_lookup_indexes migration
+INDEXES = [
+    'CREATE UNIQUE INDEX ix_items_name ON items (name)',
+    'CREATE INDEX ix_items_store_id ON items (store_id)',
+    'CREATE UNIQUE INDEX ix_stores_name ON stores (name)',
+]
+
+
+# Creates an in-memory database with size items spread over size / 100 stores
+def seed(size):
+    conn = sqlite3.connect(':memory:')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    stores = max(1, size // 100)
+    conn.executemany('INSERT INTO stores (id, name) VALUES (?, ?)', ((i, f'store{i}') for i in range(1, stores + 1)))
+    conn.executemany('INSERT INTO items (name, price, store_id) VALUES (?, ?, ?)',
+                     ((f'item{i}', i / 100, i % stores + 1) for i in range(size)))
+    return conn
+
+
+# Returns the mean latency of a lookup in microseconds
+def time_lookups(conn, query, names):
+    start = time.perf_counter()
+    for name in names:
+        conn.execute(query, (name,)).fetchone()
+    return (time.perf_counter() - start) / len(names) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f'{"items":>10} {"item by name (us)":>28} {"store items (us)":>28}')
+    print(f'{"":>10} {"before":>13} {"after":>14} {"before":>13} {"after":>14}')
+    for size in args.sizes:
+        conn = seed(size)
+        item_names = [f'item{random.randrange(size)}' for _ in range(args.lookups)]
+        store_ids = [random.randrange(max(1, size // 100)) + 1 for _ in range(args.lookups)]
+        by_name = 'SELECT * FROM items WHERE name = ? LIMIT 1'
+        by_store = 'SELECT * FROM items WHERE store_id = ?'
+
+        before = (time_lookups(conn, by_name, item_names), time_lookups(conn, by_store, store_ids))
+        for statement in INDEXES:
+            conn.execute(statement)
+        after = (time_lookups(conn, by_name, item_names), time_lookups(conn, by_store, store_ids))
+        print(f'{size:>10} {before[0]:>13.1f} {after[0]:>14.1f} {before[1]:>13.1f} {after[1]:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+# Benchmark for the cost of password hashing
+# Prints how many logins per second a single core can verify at each PBKDF2 iteration count,
+# so we can pick the highest PASSWORD_HASH_ITERATIONS that our login traffic can afford
+# Usage: python -m benchmarks.password_bench [--iterations 50000 150000 300000 600000] [--logins 20]
+import argparse
+import time
+from werkzeug.security import generate_password_hash
+from passwords import hash_method, check_password
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--algorithm', default='sha256')
+    parser.add_argument('--iterations', type=int, nargs='+', default=[50000, 150000, 300000, 600000])
+    parser.add_argument('--logins', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f'{"iterations":>12} {"ms per login":>14} {"logins/s/core":>15}')
+    for iterations in args.iterations:
+        stored = generate_password_hash('correct horse battery staple', hash_method(args.algorithm, iterations))
+        # check_password is what UserLogin runs on the hash pool for every login
+        start = time.perf_counter()
+        for _ in range(args.logins):
+            check_password(stored, 'correct horse battery staple')
+        seconds = (time.perf_counter() - start) / args.logins
+        print(f'{iterations:>12} {seconds * 1000:>14.1f} {1 / seconds:>15.1f}')
+
+
+if __name__ == '__main__':
+    main()
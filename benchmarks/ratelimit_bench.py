@@ -0,0 +1,52 @@
+# Benchmark for the overhead of the rate limiter on every limited request
+# Measures the time of one hit for each backend and algorithm, on a single hot key (one client hammering the login)
+# and on a new key for every hit (a credential stuffing run spread over many usernames), with several threads at once
+# Usage: python -m benchmarks.ratelimit_bench [--hits 200000] [--threads 1 4 8]
+import argparse
+import threading
+import time
+from cache import LocalSharedClient
+from ratelimit import LocalLimiter, SharedLimiter
+
+BACKENDS = {
+    'local token_bucket': lambda: LocalLimiter('token_bucket'),
+    'local sliding_window': lambda: LocalLimiter('sliding_window'),
+    'shared (in-process)': lambda: SharedLimiter(LocalSharedClient()),
+}
+
+
+# Runs hits hits spread over threads threads and returns the microseconds per hit
+def run(backend, hits, threads, distinct_keys):
+    per_thread = hits // threads
+
+    def work(number):
+        hit = backend.hit
+        for position in range(per_thread):
+            key = f'login:{number}:{position}' if distinct_keys else 'login:203.0.113.7'
+            hit(key, 20, 60)
+
+    workers = [threading.Thread(target=work, args=(number,)) for number in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (per_thread * threads) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hits', type=int, default=200000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    print(f'{"backend":>22} {"threads":>8} {"hot key us":>11} {"new keys us":>12}')
+    for name, make_backend in BACKENDS.items():
+        for threads in args.threads:
+            hot = run(make_backend(), args.hits, threads, False)
+            new = run(make_backend(), args.hits, threads, True)
+            print(f'{name:>22} {threads:>8} {hot:>11.2f} {new:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
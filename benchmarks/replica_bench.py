@@ -0,0 +1,69 @@
+# Benchmark for the read/write splitting
+# Runs reader threads paging through GET /items while a writer thread keeps updating items, with the reads on the
+# primary (no replicas) and on DB_READ_REPLICAS read-only pools, and prints reads per second and their latency
+# Also checks that a client reads its own writes: right after a write, its GETs go to the primary
+# Usage: python -m benchmarks.replica_bench [--replicas 0 2 4] [--readers 8] [--seconds 5] [--items 5000]
+import argparse
+import threading
+import time
+from benchmarks.common import make_client, login
+from db import STICKY_COOKIE
+
+
+def run(replicas, readers, seconds, items):
+    client = make_client({'DB_READ_REPLICAS': replicas, 'CACHE_TYPE': 'null', 'RATELIMIT_ENABLED': False})
+    app = client.application
+    headers = login(client)
+    client.post('/store/bench')
+    client.post('/items/bulk', json=[{'name': f'item{i}', 'price': i, 'store_id': 1} for i in range(items)], headers=headers)
+
+    # A client that just wrote gets the cookie that keeps its reads on the primary
+    response = client.put('/item/item0', json={'price': 1, 'store_id': 1}, headers=headers)
+    sticky = STICKY_COOKIE in response.headers.get('Set-Cookie', '') if replicas else 'n/a'
+
+    deadline = time.time() + seconds
+    latencies = []
+    writes = [0]
+
+    def write():
+        writer = app.test_client()
+        while time.time() < deadline:
+            writer.put(f'/item/item{writes[0] % items}', json={'price': writes[0], 'store_id': 1}, headers=headers)
+            writes[0] += 1
+
+    def read():
+        # Every reader is a separate client without the cookie of the writer
+        reader = app.test_client()
+        cursor = None
+        while time.time() < deadline:
+            start = time.perf_counter()
+            page = reader.get('/items?limit=100' + (f'&cursor={cursor}' if cursor else '')).get_json()
+            latencies.append(time.perf_counter() - start)
+            cursor = page['next_cursor']
+
+    threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else float('nan')
+    return len(latencies) / seconds, p99, writes[0] / seconds, sticky
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replicas', type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--items', type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f'{"replicas":>9} {"reads/s":>9} {"read p99 ms":>12} {"writes/s":>9} {"sticky":>7}')
+    for replicas in args.replicas:
+        reads, p99, writes, sticky = run(replicas, args.readers, args.seconds, args.items)
+        print(f'{replicas:>9} {reads:>9.0f} {p99:>12.1f} {writes:>9.0f} {str(sticky):>7}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Benchmark for the filters of GET /items
+# Measures the latency of every filter (store, price range, name prefix, full-text search) at several table sizes,
+# using the same indexes and FTS5 table as the migrations
+# Usage: python -m benchmarks.search_bench [--sizes 10000 100000 1000000] [--queries 200]
+import argparse
+import random
+import sqlite3
+import time
+from migrations import SEARCH_INDEX_SQL
+
+SCHEMA = [
+    'CREATE TABLE items (id INTEGER PRIMARY KEY, name VARCHAR(80), price FLOAT, store_id INTEGER)',
+    'CREATE UNIQUE INDEX ix_items_name ON items (name)',
+    'CREATE INDEX ix_items_store_id ON items (store_id)',
+    'CREATE INDEX ix_items_price ON items (price)',
+    'CREATE INDEX ix_items_store_id_price ON items (store_id, price)',
+]
+WORDS = ['red', 'blue', 'green', 'oak', 'steel', 'chair', 'table', 'lamp', 'desk', 'sofa', 'rug', 'shelf',
+         'small', 'large', 'round', 'square', 'office', 'garden', 'kitchen', 'vintage']
+PAGE = 100
+
+# The queries ItemModel.search() builds for each filter, with a function that picks random arguments
+QUERIES = {
+    'store_id': ('SELECT * FROM items WHERE store_id = ? ORDER BY id LIMIT ?',
+                 lambda size: (random.randrange(size // 100) + 1,)),
+    'store_id + price': ('SELECT * FROM items WHERE store_id = ? AND price >= ? AND price <= ? ORDER BY price, id LIMIT ?',
+                         lambda size: (random.randrange(size // 100) + 1, 10.0, 50.0)),
+    'price range': ('SELECT * FROM items WHERE price >= ? AND price <= ? ORDER BY price, id LIMIT ?',
+                    lambda size: (42.0, 42.5)),
+    'name prefix': ('SELECT * FROM items WHERE name >= ? AND name < ? ORDER BY id LIMIT ?',
+                    lambda size: _prefix(random.choice(WORDS) + ' ' + random.choice(WORDS))),
+    'full-text (fts5)': ('SELECT * FROM items WHERE id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ?) ORDER BY id LIMIT ?',
+                         lambda size: (f'"{random.choice(WORDS)}" "{random.choice(WORDS)}"',)),
+    'full-text (LIKE)': ('SELECT * FROM items WHERE name LIKE ? AND name LIKE ? ORDER BY id LIMIT ?',
+                         lambda size: (f'%{random.choice(WORDS)}%', f'%{random.choice(WORDS)}%')),
+}
+
+
+def _prefix(prefix):
+    return prefix, prefix + '\U0010ffff'
+
+
+# Creates an in-memory database with size items spread over size / 100 stores
+def seed(size):
+    conn = sqlite3.connect(':memory:')
+    for statement in SCHEMA + SEARCH_INDEX_SQL:
+        conn.execute(statement)
+    rows = ((f'{random.choice(WORDS)} {random.choice(WORDS)} {random.choice(WORDS)} {i}', round(random.uniform(1, 100), 2),
+             random.randrange(size // 100) + 1) for i in range(size))
+    conn.executemany('INSERT INTO items (name, price, store_id) VALUES (?, ?, ?)', rows)
+    conn.commit()
+    return conn
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f'{"filter":>18} ' + ' '.join(f'{size:>12}' for size in args.sizes) + '   (ms per page of 100)')
+    results = {name: [] for name in QUERIES}
+    for size in args.sizes:
+        conn = seed(size)
+        for name, (query, make_args) in QUERIES.items():
+            start = time.perf_counter()
+            for _ in range(args.queries):
+                conn.execute(query, make_args(size) + (PAGE,)).fetchall()
+            results[name].append((time.perf_counter() - start) / args.queries * 1000)
+    for name, timings in results.items():
+        print(f'{name:>18} ' + ' '.join(f'{ms:>12.3f}' for ms in timings))
+
+
+if __name__ == '__main__':
+    main()
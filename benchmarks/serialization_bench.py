@@ -0,0 +1,49 @@
+# Benchmark for request parsing and response serialization
+# Compares requests per second of GET /item/<name> and GET /stores with the standard library JSON encoder
+# and with orjson, and the cost of parsing an item body with reqparse and with schemas.item_request
+# Usage: python -m benchmarks.serialization_bench [--requests 2000] [--stores 20] [--items-per-store 20]
+import argparse
+from flask_restful import reqparse
+from benchmarks.common import make_client, login, timed
+from schemas import item_request, orjson
+
+
+# Requests per second of GET url
+def requests_per_second(client, url, count):
+    return count / timed(lambda: [client.get(url) for _ in range(count)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--stores', type=int, default=20)
+    parser.add_argument('--items-per-store', type=int, default=20)
+    args = parser.parse_args()
+
+    backends = ['stdlib'] + (['orjson'] if orjson is not None else [])
+    print(f'{"backend":>8} {"GET /item/<name> req/s":>24} {"GET /stores req/s":>20}')
+    for backend in backends:
+        client = make_client({'JSON_BACKEND': backend})
+        headers = login(client)
+        for store in range(args.stores):
+            client.post(f'/store/store{store}')
+        rows = [{'name': f'item{store}-{i}', 'price': i / 100, 'store_id': store + 1}
+                for store in range(args.stores) for i in range(args.items_per_store)]
+        client.post('/items/bulk', json=rows, headers=headers)
+
+        items = requests_per_second(client, '/item/item0-0', args.requests)
+        stores = requests_per_second(client, f'/stores?limit={args.stores}', args.requests // 10)
+        print(f'{backend:>8} {items:>24.0f} {stores:>20.0f}')
+
+    # The parser that Item used before, against the request schema that replaced it
+    old_parser = reqparse.RequestParser()
+    old_parser.add_argument('price', type=float, required=True, help="This field cannot be left blank!")
+    old_parser.add_argument('store_id', type=int, required=True, help="Every Item must belong to a Store!")
+    with client.application.test_request_context('/item/chair', method='PUT', json={'price': 12.99, 'store_id': 1}):
+        count = args.requests * 10
+        print(f'reqparse.RequestParser {timed(lambda: [old_parser.parse_args() for _ in range(count)]) / count * 1e6:>8.1f} us per body')
+        print(f'schemas.RequestSchema  {timed(lambda: [item_request.parse_args() for _ in range(count)]) / count * 1e6:>8.1f} us per body')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Benchmark for the sharding of the items by store
+# Several threads update the items of their own store as fast as they can, with the items in the primary database
+# and then spread over 2 and 4 shards. Prints the writes per second and the p50 and p99 latency of PUT /item/<name>,
+# then the p50 latency of GET /items (which asks every shard) and of GET /items?store_id= (which asks one)
+# Any request that fails makes the benchmark stop with an error, so a broken mode is never timed as a fast one
+# Usage: python -m benchmarks.shard_bench [--threads 8] [--items 200] [--seconds 5] [--shards 0 2 4]
+import sys
+import time
+import argparse
+import threading
+from benchmarks.common import make_client, login
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else float('nan')
+
+
+# Stops the benchmark when a request did not get one of the expected statuses
+def check(response, expected, what):
+    if response.status_code not in expected:
+        sys.exit(f'{what} failed with {response.status_code}: {response.get_data(as_text=True)[:200]}')
+
+
+# Updates the items of one store round-robin until stop is set, and keeps the latency of every PUT
+# The statuses of the failed PUTs go to failures, the main thread stops the benchmark when there are any
+def update(client, headers, store_id, items, latencies, failures, stop):
+    i = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = client.put(f'/item/s{store_id}-item{i % items}', json={'price': i / 100, 'store_id': store_id}, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            failures.append(response.status_code)
+        i += 1
+
+
+def read_latency(client, headers, url, repeat=200):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        check(response, (200,), f'GET {url}')
+    return percentile(latencies, 0.5)
+
+
+def run(args, shards):
+    client = make_client({'CACHE_TYPE': 'lru', 'DB_SHARDS': shards})
+    headers = login(client)
+    # One store per thread, so with enough shards every thread writes to a database of its own
+    for store_id in range(1, args.threads + 1):
+        check(client.post(f'/store/bench{store_id}'), (201,), 'Creating a store')
+        # One item through POST /item/<name>, which reserves the first block of item ids, the rest in bulk
+        check(client.post(f'/item/s{store_id}-item0', json={'price': 1, 'store_id': store_id}, headers=headers), (201,), 'Creating an item')
+        check(client.post('/items/bulk', json=[{'name': f's{store_id}-item{i}', 'price': 1, 'store_id': store_id} for i in range(1, args.items)],
+                          headers=headers), (200,), 'Creating the items')
+
+    latencies, failures, stop = [], [], threading.Event()
+    threads = [threading.Thread(target=update, args=(client.application.test_client(), headers, store_id, args.items, latencies, failures, stop))
+               for store_id in range(1, args.threads + 1)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if failures:
+        sys.exit(f'{len(failures)} of {len(latencies)} PUT /item/<name> failed, statuses {sorted(set(failures))}')
+    return (len(latencies) / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99),
+            read_latency(client, headers, '/items?limit=100'), read_latency(client, headers, '/items?limit=100&store_id=1'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8, help='Concurrent writers, each to a store of its own')
+    parser.add_argument('--items', type=int, default=200, help='Items per store')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 2, 4])
+    args = parser.parse_args()
+
+    print(f'{"shards":>7} {"writes/s":>9} {"p50 ms":>9} {"p99 ms":>9} {"/items ms":>10} {"?store_id ms":>13}')
+    for shards in args.shards:
+        throughput, p50, p99, scatter, single = run(args, shards)
+        print(f'{shards:>7} {throughput:>9.0f} {p50:>9.2f} {p99:>9.2f} {scatter:>10.2f} {single:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
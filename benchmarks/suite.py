@@ -0,0 +1,496 @@
+# The benchmark suite: drives every route of the API and saves the results so two runs can be compared
+# Seeds a fresh database with a synthetic dataset (--users, --stores, --items), logs in through POST /login to get
+# the tokens, then sends --requests requests to every route registered by create_app(), in-process through the test
+# client and over HTTP to a gunicorn server (sync mode, one worker). For every route it reports the p50, p95 and p99
+# latency, the requests per second, the SQL statements per request (from the Server-Timing header) and the errors,
+# and for every transport the peak RSS of the process that served the requests
+# The data, the order of the requests and the request bodies only depend on --seed, so two runs do the same work
+# Rate limiting is turned off, it would reject the logins and registrations (see ratelimit_bench.py for its cost)
+# --shards 2 runs the same scenarios with the items spread over that many shards (see shards.py)
+# Usage: python -m benchmarks.suite [--transports inprocess http] [--requests 200] [--shards 0] [--output results.json]
+#        python -m benchmarks.suite --baseline results.json [--threshold 0.1]
+# With --baseline it exits with status 1 when a route got slower or runs more SQL statements than in the baseline
+# A run where any request got an unexpected status exits with status 1 as well, and is not saved by --output,
+# since its timings are those of the errors and would make a broken baseline
+import os
+import re
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import http.client
+from datetime import datetime
+
+# Every scenario expects one of these statuses unless it says otherwise, anything else counts as an error
+OK_STATUSES = (200, 201, 202, 304)
+STATEMENTS = re.compile(r'desc="(\d+) queries"')
+PASSWORD = 'bench'
+
+# The settings of the app under test, in-process and in the environment of the HTTP server
+SETTINGS = {
+    'RATELIMIT_ENABLED': False,
+    'METRICS_ENABLED': True,
+    # An abandoned stream of the sync mode holds a thread until its next heartbeat, so it is sent every second
+    'CHANGES_HEARTBEAT': 1,
+}
+
+
+# The seeded data and the tokens, shared by the scenarios
+class Context:
+    def __init__(self, args):
+        self.random = random.Random(args.seed)
+        self.args = args
+        self.items = [f'item-{number}' for number in range(args.items)]
+        self.stores = [f'store-{number}' for number in range(args.stores)]
+        # The first user registered is the admin, the users seeded after it have the next ids
+        self.user_ids = list(range(2, args.users + 2))
+        self.revoked_user = None
+        self.doomed_users = []
+        # Rows only created to be deleted, one per request of the delete scenarios
+        self.doomed = args.requests + args.warmup
+        self.latest_seq = 0
+        self.admin = None
+        self.tokens = []
+        self.refresh_tokens = []
+
+    def token(self, i):
+        return self.tokens[i % len(self.tokens)]
+
+
+# One route (method + rule as registered in app.py) and how to build its i-th request
+# build(ctx, i) returns (path, body, token). prepare(ctx, i, transport) runs before the request and is not timed
+class Scenario:
+    def __init__(self, method, rule, build, name=None, expect=OK_STATUSES, prepare=None, stream=False):
+        self.method = method
+        self.rule = rule
+        self.name = name or f'{method} {rule}'
+        self.build = build
+        self.expect = expect
+        self.prepare = prepare
+        self.stream = stream
+
+
+def new_access_token(ctx, i, transport):
+    status, body, _ = transport.request('POST', '/refresh', token=ctx.refresh_tokens[i % len(ctx.refresh_tokens)])
+    return body['access_token']
+
+
+SCENARIOS = [
+    Scenario('POST', '/register', lambda ctx, i: ('/register', {'username': f'new-{ctx.args.seed}-{i}', 'password': PASSWORD}, None)),
+    Scenario('POST', '/login', lambda ctx, i: ('/login', {'username': f'user-{i % ctx.args.users}', 'password': PASSWORD}, None)),
+    Scenario('POST', '/refresh', lambda ctx, i: ('/refresh', None, ctx.refresh_tokens[i % len(ctx.refresh_tokens)])),
+    # Every logout revokes the token it is sent with, so each one gets a new token first
+    Scenario('POST', '/logout', lambda ctx, i: ('/logout', None, ctx.prepared), prepare=new_access_token),
+    Scenario('GET', '/user/<int:user_id>', lambda ctx, i: (f'/user/{ctx.random.choice(ctx.user_ids)}', None, None)),
+    Scenario('DELETE', '/user/<int:user_id>', lambda ctx, i: (f'/user/{ctx.doomed_users[i]}', None, None)),
+    # Revokes the tokens of a user that is not logged in by the suite, so the other scenarios keep working
+    Scenario('POST', '/user/<int:user_id>/revoke', lambda ctx, i: (f'/user/{ctx.revoked_user}/revoke', None, ctx.admin)),
+    Scenario('GET', '/items', lambda ctx, i: ('/items?limit=100', None, ctx.token(i))),
+    Scenario('GET', '/items', lambda ctx, i: (f'/items?store_id={ctx.random.randint(1, ctx.args.stores)}&sort=-price&limit=100', None, None),
+             name='GET /items?store_id&sort'),
+    Scenario('GET', '/items', lambda ctx, i: (f'/items?q=item&min_price={ctx.random.randint(0, 100)}&limit=100', None, None),
+             name='GET /items?q&min_price'),
+    # The streaming and export modes read every matching item, so they stay within one store
+    Scenario('GET', '/items', lambda ctx, i: (f'/items?store_id={ctx.random.randint(1, ctx.args.stores)}&sort=-price&stream=true', None, None),
+             name='GET /items?store_id&sort&stream'),
+    Scenario('GET', '/items', lambda ctx, i: (f'/items?store_id={ctx.random.randint(1, ctx.args.stores)}&format=ndjson', None, None),
+             name='GET /items?store_id&format=ndjson'),
+    Scenario('POST', '/items/bulk', lambda ctx, i: ('/items/bulk', [
+        {'name': name, 'price': ctx.random.randint(1, 10000) / 100, 'store_id': ctx.random.randint(1, ctx.args.stores)}
+        for name in ctx.random.sample(ctx.items, min(ctx.args.batch, len(ctx.items)))], ctx.token(i))),
+    Scenario('POST', '/items/batch', lambda ctx, i: ('/items/batch', {'names': ctx.random.sample(ctx.items, min(ctx.args.batch, len(ctx.items)))}, None)),
+    Scenario('GET', '/item/<string:name>', lambda ctx, i: (f'/item/{ctx.random.choice(ctx.items)}', None, None)),
+    Scenario('POST', '/item/<string:name>', lambda ctx, i: (f'/item/new-{i}', {'price': 1.5, 'store_id': ctx.random.randint(1, ctx.args.stores)}, ctx.token(i))),
+    Scenario('PUT', '/item/<string:name>', lambda ctx, i: (f'/item/{ctx.random.choice(ctx.items)}',
+                                                             {'price': ctx.random.randint(1, 10000) / 100, 'store_id': 1}, ctx.token(i))),
+    Scenario('DELETE', '/item/<string:name>', lambda ctx, i: (f'/item/doomed-{i}', None, ctx.admin), expect=OK_STATUSES + (410,)),
+    Scenario('GET', '/stores', lambda ctx, i: ('/stores?limit=20', None, None)),
+    Scenario('POST', '/stores/batch', lambda ctx, i: ('/stores/batch', {'names': ctx.random.sample(ctx.stores, min(10, len(ctx.stores)))}, None)),
+    Scenario('GET', '/store/<string:name>', lambda ctx, i: (f'/store/{ctx.random.choice(ctx.stores)}', None, None)),
+    Scenario('GET', '/store/<string:name>', lambda ctx, i: (f'/store/{ctx.random.choice(ctx.stores)}?fields=summary', None, None),
+             name='GET /store/<string:name>?fields=summary'),
+    Scenario('POST', '/store/<string:name>', lambda ctx, i: (f'/store/new-{i}', None, None)),
+    Scenario('DELETE', '/store/<string:name>', lambda ctx, i: (f'/store/doomed-{i}', None, None)),
+    Scenario('GET', '/changes', lambda ctx, i: ('/changes?since=0&limit=100', None, None)),
+    Scenario('GET', '/cache/stats', lambda ctx, i: ('/cache/stats', None, ctx.admin)),
+    Scenario('GET', '/metrics', lambda ctx, i: ('/metrics', None, None)),
+    # The time until the first event arrives. Last, because the sync server keeps a thread per stream for a moment
+    Scenario('GET', '/changes/stream', lambda ctx, i: (f'/changes/stream?since={max(0, ctx.latest_seq - 10)}', None, None), stream=True),
+]
+
+
+# Sends the requests through Flask's test client, in this process
+class InProcess:
+    name = 'inprocess'
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    # Every thread gets its own client
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    # Returns the status, the JSON body (None for a stream) and the SQL statements the request ran
+    def request(self, method, path, body=None, token=None, stream=False):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        response = self._client().open(path, method=method, json=body, headers=headers, buffered=not stream)
+        if stream:
+            # Reads up to the first event and hangs up, which ends the generator of the stream
+            for chunk in response.response:
+                if b'id: ' in chunk:
+                    break
+            response.close()
+            data = None
+        else:
+            data = response.get_json(silent=True)
+        return response.status_code, data, statements(response.headers.get('Server-Timing'))
+
+    # The peak RSS of this process in KiB
+    def peak_rss(self):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss // 1024 if sys.platform == 'darwin' else rss
+
+    def close(self):
+        pass
+
+
+# Sends the requests to a gunicorn server in the sync mode, with one worker, over keep-alive connections
+class Http:
+    name = 'http'
+
+    def __init__(self, database, port, threads):
+        self.port = port
+        env = dict(os.environ, SERVER_MODE='sync', BIND=f'127.0.0.1:{port}', WORKERS='1', THREADS=str(threads),
+                   DATABASE_URL=f'sqlite:///{database}', **{key: str(value) for key, value in SETTINGS.items()})
+        self.server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'], env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._local = threading.local()
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                self.request('GET', '/stores')
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.close()
+        raise RuntimeError('The server did not start')
+
+    def _connection(self):
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        return self._local.connection
+
+    def request(self, method, path, body=None, token=None, stream=False):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        # A stream never ends by itself, so it gets a connection of its own that is closed after the first event
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30) if stream else self._connection()
+        try:
+            connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = connection.getresponse()
+            if stream:
+                while not response.readline().startswith(b'id: '):
+                    pass
+                data = None
+            else:
+                raw = response.read()
+                data = json.loads(raw) if response.getheader('Content-Type', '').startswith('application/json') and raw else None
+        except (OSError, http.client.HTTPException):
+            # The connection is no good any more, the next request opens a new one
+            connection.close()
+            self._local.__dict__.pop('connection', None)
+            raise
+        if stream:
+            connection.close()
+        return response.status, data, statements(response.getheader('Server-Timing'))
+
+    # The peak RSS of the gunicorn master and its worker in KiB, read from /proc (None where there is no /proc)
+    def peak_rss(self):
+        peak = None
+        for pid in [self.server.pid] + children(self.server.pid):
+            try:
+                with open(f'/proc/{pid}/status') as status:
+                    for line in status:
+                        if line.startswith('VmHWM:'):
+                            peak = max(peak or 0, int(line.split()[1]))
+            except OSError:
+                pass
+        return peak
+
+    def close(self):
+        self.server.terminate()
+        self.server.wait()
+
+
+def children(pid):
+    found = []
+    for path in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if path.isdigit():
+            try:
+                with open(f'/proc/{path}/stat') as stat:
+                    # The parent pid is the 4th field, after the name in parentheses (which can contain spaces)
+                    if int(stat.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        found.append(int(path))
+            except (OSError, IndexError, ValueError):
+                pass
+    return found
+
+
+def statements(server_timing):
+    match = STATEMENTS.search(server_timing or '')
+    return int(match.group(1)) if match else None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 3) if values else None
+
+
+# Creates the database file and fills it with the dataset. Runs in this process, before the server starts
+def seed(app, ctx):
+    from db import db
+    from migrations import upgrade_db
+    from passwords import hasher
+    from models.user import UserModel
+    from models.store import StoreModel
+    from models.item import ItemModel
+    from models.change import ChangeModel
+    from shards import shards
+
+    args = ctx.args
+    client = app.test_client()
+    with app.app_context():
+        upgrade_db()
+    # Registered through the API, so the first user is the admin like on a real install
+    client.post('/register', json={'username': 'admin', 'password': PASSWORD})
+    with app.app_context():
+        # Hashing a password takes a while on purpose, so every other user gets the same hash
+        password = hasher.hash(PASSWORD)
+        db.session.add_all([UserModel(f'user-{number}', password) for number in range(args.users)])
+        db.session.add_all([UserModel(f'doomed-{number}', password) for number in range(ctx.doomed)])
+        db.session.add(UserModel('revoked', password))
+        db.session.commit()
+        ctx.revoked_user = UserModel.find_by_username('revoked').id
+        ctx.doomed_users = [user_id for (user_id,) in db.session.query(UserModel.id).filter(UserModel.username.like('doomed-%')).order_by(UserModel.id)]
+        for name in ctx.stores + [f'doomed-{number}' for number in range(ctx.doomed)]:
+            StoreModel(name).save_to_db()
+        rows = [{'name': name, 'price': ctx.random.randint(1, 10000) / 100, 'store_id': ctx.random.randint(1, args.stores)} for name in ctx.items]
+        rows += [{'name': f'doomed-{number}', 'price': 1, 'store_id': 1} for number in range(ctx.doomed)]
+        ItemModel.bulk_upsert(rows)
+        ctx.latest_seq = ChangeModel.bounds()[1] or 0
+        db.engine.dispose()
+        shards.dispose()
+
+
+# Logs the admin and a few users in through POST /login of the transport under test
+def log_in(ctx, transport):
+    status, body, _ = transport.request('POST', '/login', {'username': 'admin', 'password': PASSWORD})
+    if status != 200:
+        raise RuntimeError(f'Could not log in as the admin: {status} {body}')
+    ctx.admin = body['access_token']
+    ctx.tokens, ctx.refresh_tokens = [], []
+    for number in range(min(ctx.args.users, 10)):
+        _, body, _ = transport.request('POST', '/login', {'username': f'user-{number}', 'password': PASSWORD})
+        ctx.tokens.append(body['access_token'])
+        ctx.refresh_tokens.append(body['refresh_token'])
+
+
+# Sends the requests of a scenario from --concurrency threads and returns its results
+def run_scenario(ctx, transport, scenario, requests):
+    latencies, counts, errors = [], [], [0]
+    indices = itertools.count()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            i = next(indices)
+            if i >= requests + ctx.args.warmup:
+                return
+            with lock:
+                # The bodies come from the shared random generator, built in order so every run sends the same ones
+                ctx.prepared = scenario.prepare(ctx, i, transport) if scenario.prepare else None
+                path, body, token = scenario.build(ctx, i)
+            start = time.perf_counter()
+            try:
+                status, _, count = transport.request(scenario.method, path, body, token, stream=scenario.stream)
+            except (OSError, http.client.HTTPException):
+                status, count = None, None
+            seconds = time.perf_counter() - start
+            # The first requests warm the caches and the connections up and are not counted
+            if i < ctx.args.warmup:
+                continue
+            with lock:
+                latencies.append(seconds)
+                if count is not None:
+                    counts.append(count)
+                if status not in scenario.expect:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(ctx.args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'req_per_s': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': percentile(latencies, 0.5),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'sql_per_request': round(sum(counts) / len(counts), 2) if counts else None,
+        # The peak so far, so it shows which route made the process grow
+        'peak_rss_kb': transport.peak_rss(),
+    }
+
+
+# Fails when a route registered by create_app() has no scenario, so a new route cannot be left out by accident
+def check_coverage(app):
+    covered = {(scenario.method, scenario.rule) for scenario in SCENARIOS}
+    missing = sorted((method, rule.rule) for rule in app.url_map.iter_rules() if rule.endpoint != 'static'
+                     for method in rule.methods - {'HEAD', 'OPTIONS'} if (method, rule.rule) not in covered)
+    if missing:
+        raise SystemExit('No benchmark scenario for ' + ', '.join(f'{method} {rule}' for method, rule in missing))
+
+
+def run_transport(name, args):
+    from app import create_app
+
+    ctx = Context(args)
+    database = os.path.join(tempfile.mkdtemp(), 'suite.db')
+    app = create_app(dict(SETTINGS, SQLALCHEMY_DATABASE_URI=f'sqlite:///{database}'))
+    check_coverage(app)
+    seed(app, ctx)
+    transport = InProcess(app) if name == 'inprocess' else Http(database, args.port, args.threads)
+    try:
+        log_in(ctx, transport)
+        results = {}
+        for scenario in SCENARIOS:
+            requests = args.requests
+            if scenario.stream and name == 'http':
+                # Every stream holds a thread of the worker until its next heartbeat, more would queue behind them
+                requests = min(requests, args.threads - args.concurrency)
+            results[scenario.name] = run_scenario(ctx, transport, scenario, requests)
+            print_row(name, scenario.name, results[scenario.name])
+        return {'peak_rss_kb': transport.peak_rss(), 'scenarios': results}
+    finally:
+        transport.close()
+
+
+def print_row(transport, scenario, result):
+    def number(value, digits=2):
+        return f'{value:.{digits}f}' if value is not None else '-'
+    print(f'{transport:>9} {scenario:<42} {number(result["req_per_s"], 0):>8} {number(result["p50_ms"]):>8} '
+          f'{number(result["p95_ms"]):>8} {number(result["p99_ms"]):>8} {number(result["sql_per_request"], 1):>6} '
+          f'{result["errors"]:>6} {result["peak_rss_kb"] or "-":>10}')
+
+
+# Lists what got worse than in the baseline: a latency or the SQL statements per request above the baseline by more
+# than threshold (a fraction), or the requests per second below it. min_delta_ms ignores latency changes smaller than
+# that, which are noise on routes that take a fraction of a millisecond
+def compare(baseline, results, threshold, min_delta_ms):
+    regressions = []
+    for transport, run in results['transports'].items():
+        base_run = baseline.get('transports', {}).get(transport)
+        if base_run is None:
+            continue
+        for scenario, result in run['scenarios'].items():
+            base = base_run['scenarios'].get(scenario)
+            if base is None:
+                continue
+            for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+                if None not in (base[key], result[key]) and result[key] > base[key] * (1 + threshold) and result[key] - base[key] > min_delta_ms:
+                    regressions.append(f'{transport} {scenario}: {key} {base[key]} -> {result[key]}')
+            if None not in (base['req_per_s'], result['req_per_s']) and result['req_per_s'] < base['req_per_s'] * (1 - threshold):
+                regressions.append(f'{transport} {scenario}: req_per_s {base["req_per_s"]} -> {result["req_per_s"]}')
+            # The statements do not depend on the machine, so any increase over the rounding counts
+            if None not in (base['sql_per_request'], result['sql_per_request']) and result['sql_per_request'] > base['sql_per_request'] * (1 + threshold) + 0.01:
+                regressions.append(f'{transport} {scenario}: sql_per_request {base["sql_per_request"]} -> {result["sql_per_request"]}')
+    return regressions
+
+
+# Lists the scenarios where some of the requests got an unexpected status
+def failures(results):
+    return [f'{transport} {scenario}: {result["errors"]} of {result["requests"]} requests failed'
+            for transport, run in results['transports'].items() for scenario, result in run['scenarios'].items() if result['errors']]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transports', nargs='+', default=['inprocess', 'http'], choices=('inprocess', 'http'))
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--stores', type=int, default=20)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200, help='Timed requests per route')
+    parser.add_argument('--warmup', type=int, default=10, help='Requests per route sent before the timing starts')
+    parser.add_argument('--concurrency', type=int, default=1, help='Clients sending requests at the same time')
+    parser.add_argument('--batch', type=int, default=100, help='Items per request of /items/bulk and /items/batch')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--shards', type=int, default=0, help='Spread the items over this many shards (DB_SHARDS)')
+    parser.add_argument('--threads', type=int, default=8, help='Threads of the HTTP server')
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with the results saved by an earlier run and fail on a regression')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Regression threshold, 0.1 is 10%%')
+    parser.add_argument('--min-delta-ms', type=float, default=0.5)
+    args = parser.parse_args()
+    if args.concurrency >= args.threads:
+        parser.error('--concurrency must be lower than --threads')
+    if args.shards:
+        SETTINGS['DB_SHARDS'] = args.shards
+    # A stream of the sync mode keeps its place until the server notices the client left, at its next heartbeat
+    SETTINGS['CHANGES_MAX_SYNC_STREAMS'] = args.threads - args.concurrency
+
+    results = {
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        'transports': {},
+    }
+    print(f'{"transport":>9} {"route":<42} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"sql":>6} {"errors":>6} {"rss KiB":>10}')
+    for name in args.transports:
+        results['transports'][name] = run_transport(name, args)
+
+    failed = failures(results)
+    for failure in failed:
+        print(f'FAILED {failure}')
+    if failed:
+        sys.exit('Some requests failed, the results are not saved or compared')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(json.load(baseline), results, args.threshold, args.min_delta_ms)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regression over {args.threshold:.0%} compared to {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
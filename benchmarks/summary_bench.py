@@ -0,0 +1,33 @@
+# Benchmark for the store summaries
+# Compares the latency of GET /store/<name> (every item) with GET /store/<name>?fields=summary (the precomputed
+# aggregates) as the store grows, and measures what keeping the aggregates up to date adds to PUT /item/<name>
+# Usage: python -m benchmarks.summary_bench [--sizes 1000 10000 100000] [--requests 50]
+import argparse
+from benchmarks.common import make_client, login, timed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f'{"items":>10} {"full (ms)":>12} {"summary (ms)":>14} {"PUT item (ms)":>15}')
+    for size in args.sizes:
+        # The cache would hide the cost of building the full JSON, so every request reads the database
+        client = make_client({'CACHE_TYPE': 'null'})
+        headers = login(client)
+        client.post('/store/bench')
+        client.post('/items/bulk', json=[{'name': f'item{i}', 'price': i / 100, 'store_id': 1} for i in range(size)], headers=headers)
+
+        full = timed(lambda: [client.get('/store/bench') for _ in range(args.requests)])
+        summary = timed(lambda: [client.get('/store/bench?fields=summary') for _ in range(args.requests)])
+        # Lowers the cheapest item, so every write moves the min price of the store as well
+        put = timed(lambda: [client.put(f'/item/item{i}', json={'price': -i, 'store_id': 1}, headers=headers)
+                             for i in range(args.requests)])
+        print(f'{size:>10} {full / args.requests * 1000:>12.2f} {summary / args.requests * 1000:>14.2f} '
+              f'{put / args.requests * 1000:>15.2f}')
+
+
+if __name__ == '__main__':
+    main()
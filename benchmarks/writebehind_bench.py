@@ -0,0 +1,95 @@
+# Benchmark for the write-behind queue of the item price updates
+# Several threads update the prices of a small set of hot items as fast as they can, first with every PUT committed
+# before the response and then with the write-behind queue on. Prints the updates per second, the p50 and p99 latency
+# of PUT /item/<name> and how many UPDATE statements reached the database for them
+# Any request that fails makes the benchmark stop with an error, so a broken mode is never timed as a fast one
+# Usage: python -m benchmarks.writebehind_bench [--threads 8] [--items 100] [--seconds 5] [--durability memory journal fsync]
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+from sqlalchemy import event
+from benchmarks.common import make_client, login
+from db import db
+from writebehind import write_queue
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else float('nan')
+
+
+# Stops the benchmark when a request did not get one of the expected statuses
+def check(response, expected, what):
+    if response.status_code not in expected:
+        sys.exit(f'{what} failed with {response.status_code}: {response.get_data(as_text=True)[:200]}')
+
+
+# Updates the hot items round-robin until stop is set, and keeps the latency of every PUT
+# A PUT is answered 200 when it was committed and 202 when it was queued, any other status goes to failures
+def update(client, headers, items, latencies, failures, stop, offset):
+    i = offset
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = client.put(f'/item/item{i % items}', json={'price': i / 100, 'store_id': 1}, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code not in (200, 202):
+            failures.append(response.status_code)
+        i += 1
+
+
+def run(args, config):
+    client = make_client(dict({'CACHE_TYPE': 'lru'}, **config))
+    headers = login(client)
+    check(client.post('/store/bench'), (201,), 'Creating the store')
+    check(client.post('/items/bulk', json=[{'name': f'item{i}', 'price': 1, 'store_id': 1} for i in range(args.items)], headers=headers),
+          (200,), 'Creating the items')
+
+    # Counts the statements that write the prices
+    writes = [0]
+    with client.application.app_context():
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().startswith('UPDATE items'):
+                writes[0] += len(parameters) if executemany else 1
+
+    latencies, failures, stop = [], [], threading.Event()
+    threads = [threading.Thread(target=update, args=(client.application.test_client(), headers, args.items, latencies, failures, stop, n * 7))
+               for n in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if failures:
+        sys.exit(f'{len(failures)} of {len(latencies)} PUT /item/<name> failed, statuses {sorted(set(failures))}')
+    if write_queue.enabled:
+        write_queue.flush()
+    return len(latencies) / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99), writes[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--items', type=int, default=100, help='How many different items the updates go to')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--durability', nargs='+', default=['memory', 'journal', 'fsync'])
+    args = parser.parse_args()
+
+    print(f'{"mode":>22} {"updates/s":>10} {"p50 ms":>9} {"p99 ms":>9} {"db writes":>10}')
+    modes = [('sync', {'WRITE_BEHIND_ENABLED': False})]
+    modes += [(f'write-behind {durability}', {'WRITE_BEHIND_ENABLED': True, 'WRITE_BEHIND_DURABILITY': durability,
+                                              'WRITE_BEHIND_JOURNAL_DIR': os.path.join(tempfile.mkdtemp(), 'journal')})
+              for durability in args.durability]
+    for name, config in modes:
+        throughput, p50, p99, writes = run(args, config)
+        print(f'{name:>22} {throughput:>10.0f} {p50:>9.2f} {p99:>9.2f} {writes:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Import libraries
+import time
+import uuid
+import heapq
+import threading
+from cache import LocalSharedClient
+
+
+# Turns a jti (a uuid4 string for flask-jwt-extended tokens) into 16 bytes instead of a 36 character string
+def _compact(jti):
+    try:
+        return uuid.UUID(jti).bytes
+    except ValueError:
+        return jti
+
+
+# Keeps revoked token ids in this process only. Checking a token is a single dictionary lookup
+# Every entry is forgotten once the token it revokes has expired, because an expired token is rejected anyway
+class LocalBlocklist:
+    def __init__(self):
+        # jti -> time at which the token expires
+        self._tokens = {}
+        # user id -> time before which every token of that user is revoked, and when that rule can be forgotten
+        self._users = {}
+        # (expiry, kind, key) ordered by expiry, so purging only looks at entries that have actually expired
+        self._expiries = []
+        self._lock = threading.Lock()
+
+    def revoke(self, jti, ttl):
+        expires = time.time() + ttl
+        with self._lock:
+            self._tokens[_compact(jti)] = expires
+            heapq.heappush(self._expiries, (expires, 'token', _compact(jti)))
+            self._purge()
+
+    def revoke_user(self, user_id, ttl):
+        now = time.time()
+        with self._lock:
+            self._users[user_id] = (now, now + ttl)
+            heapq.heappush(self._expiries, (now + ttl, 'user', user_id))
+            self._purge()
+
+    def is_revoked(self, jti, user_id, issued_at):
+        # No lock needed, reading a dictionary is atomic
+        if _compact(jti) in self._tokens:
+            return True
+        rule = self._users.get(user_id)
+        return rule is not None and issued_at <= rule[0]
+
+    # Removes the entries whose tokens have all expired. Must be called with the lock held
+    def _purge(self):
+        now = time.time()
+        while self._expiries and self._expiries[0][0] < now:
+            expires, kind, key = heapq.heappop(self._expiries)
+            entries = self._tokens if kind == 'token' else self._users
+            current = entries.get(key)
+            # The entry may have been replaced by a newer one that expires later, only remove it if it is ours
+            if current is not None and (current if kind == 'token' else current[1]) == expires:
+                del entries[key]
+
+    def __len__(self):
+        return len(self._tokens) + len(self._users)
+
+
+# Keeps revoked token ids in an external key-value store such as Redis, so a token revoked by one worker
+# is rejected by all of them. The client needs get(key), set(key, value, ttl) and delete(*keys) methods,
+# like the client of cache.SharedCache. The store expires the entries by itself
+class SharedBlocklist:
+    def __init__(self, client, prefix='blocklist:'):
+        self.client = client
+        self.prefix = prefix
+
+    def revoke(self, jti, ttl):
+        self.client.set(f'{self.prefix}token:{jti}', '1', max(1, int(ttl)))
+
+    def revoke_user(self, user_id, ttl):
+        self.client.set(f'{self.prefix}user:{user_id}', str(time.time()), max(1, int(ttl)))
+
+    def is_revoked(self, jti, user_id, issued_at):
+        if self.client.get(f'{self.prefix}token:{jti}') is not None:
+            return True
+        revoked_at = self.client.get(f'{self.prefix}user:{user_id}')
+        return revoked_at is not None and issued_at <= float(revoked_at)
+
+    def __len__(self):
+        return len([key for key in self.client.keys() if key.startswith(self.prefix)])
+
+
+# The blocklist used by the JWT callbacks in app.py. Like the cache, it is linked to the app with init_app()
+class Blocklist:
+    # Refresh tokens live for 30 days unless JWT_REFRESH_TOKEN_EXPIRES says otherwise
+    DEFAULT_USER_TTL = 30 * 24 * 3600
+
+    def __init__(self):
+        self.backend = LocalBlocklist()
+        self.user_ttl = Blocklist.DEFAULT_USER_TTL
+
+    # Configuration keys:
+    # BLOCKLIST_TYPE: 'local' (default) or 'shared'
+    # BLOCKLIST_SHARED_CLIENT: the key-value client used by the 'shared' backend (defaults to cache.LocalSharedClient)
+    # JWT_REFRESH_TOKEN_EXPIRES: how long revoke_user() has to remember a user, a revoked user's tokens are all gone after that
+    def init_app(self, app):
+        expires = app.config.get('JWT_REFRESH_TOKEN_EXPIRES')
+        self.user_ttl = expires.total_seconds() if expires else Blocklist.DEFAULT_USER_TTL
+        blocklist_type = app.config.get('BLOCKLIST_TYPE', 'local')
+        if blocklist_type == 'local':
+            self.backend = LocalBlocklist()
+        elif blocklist_type == 'shared':
+            self.backend = SharedBlocklist(app.config.get('BLOCKLIST_SHARED_CLIENT') or LocalSharedClient())
+        else:
+            raise ValueError(f'Unknown BLOCKLIST_TYPE {blocklist_type}')
+
+    # Revokes a single decoded token (for example the one used to log out) until it expires
+    def revoke_token(self, token):
+        # Tokens created with JWT_*_TOKEN_EXPIRES = False never expire, so we remember them as long as a revoked user
+        expires = token.get('exp', time.time() + self.user_ttl)
+        self.backend.revoke(token['jti'], expires - time.time())
+
+    # Revokes every token issued to a user so far, for example when the user is deleted
+    def revoke_user(self, user_id):
+        self.backend.revoke_user(user_id, self.user_ttl)
+
+    # Called for every request with a JWT, so it never touches the database
+    def is_revoked(self, token):
+        return self.backend.is_revoked(token['jti'], token['identity'], token['iat'])
+
+
+blocklist = Blocklist()
@@ -0,0 +1,291 @@
+# Import libraries
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+# Counters shared by every backend so we can see how well the cache is sized
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def json(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0}
+
+
+# A bounded, in-process cache. Least recently used entries are evicted first and every entry expires after ttl seconds
+# Each worker process has its own copy, so this is the fastest backend but it is not shared between workers:
+# a write only removes the stale entries of the worker that served it, the others keep theirs for up to ttl seconds
+class LRUCache:
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        # key -> (expiry time, value). An OrderedDict remembers the order in which keys were used
+        self._entries = OrderedDict()
+        # Flask can serve requests from several threads, so every change to the dictionary happens under a lock
+        self._lock = threading.Lock()
+        # Every delete gets the next number of _deletes, and _deleted remembers the number of the last delete of
+        # the max_size most recently deleted keys. _forgotten is the highest number dropped from it (see token)
+        self._deletes = 0
+        self._deleted = OrderedDict()
+        self._forgotten = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                # The entry is too old, throw it away and treat it as a miss
+                del self._entries[key]
+                self.stats.misses += 1
+                return None
+            # Mark the key as the most recently used one
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    # Taken before a value is loaded from the database and passed to set, which then refuses to cache the value
+    # if the key was deleted in the meantime: the value may have been read before the write that deleted the key
+    def token(self, key):
+        with self._lock:
+            return self._deletes
+
+    def set(self, key, value, token=None):
+        with self._lock:
+            if token is not None and (self._deleted.get(key, 0) > token or self._forgotten > token):
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            # Evict the least recently used entries once we go over the size limit
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._deletes += 1
+                self._deleted[key] = self._deletes
+                self._deleted.move_to_end(key)
+            # A key dropped here could have been deleted after any token taken before _forgotten, so set refuses those
+            while len(self._deleted) > self.max_size:
+                _, self._forgotten = self._deleted.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            # Every load that started before the clear may be stale
+            self._deletes += 1
+            self._deleted.clear()
+            self._forgotten = self._deletes
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# A cache shared by every worker, backed by an external key-value store such as Redis or Memcached
+# The client needs get(key), set(key, value, ttl), delete(*keys) and incr(key, amount, ttl) methods, values are
+# stored as JSON strings. Every delete also bumps a generation counter of the key (see token)
+# Expiry and eviction are handled by the external store, so evictions are not counted here
+class SharedCache:
+    def __init__(self, client, ttl=60, prefix='api:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stats = CacheStats()
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return json.loads(raw)
+
+    # The generation of the key before a value is loaded, see LRUCache.token. The generation lives twice as long as an
+    # entry, so it cannot expire between the token and the set of a load
+    def token(self, key):
+        return self.client.get(f'{self.prefix}generation:{key}') or '0'
+
+    # With a token, the value is only cached if no delete of the key happened since. The check and the set are two
+    # calls to the store, which leaves a window of one round trip instead of the whole load
+    def set(self, key, value, token=None):
+        if token is not None and self.token(key) != token:
+            return
+        self.client.set(self.prefix + key, json.dumps(value), self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+            for key in keys:
+                self.client.incr(f'{self.prefix}generation:{key}', 1, 2 * self.ttl)
+
+    def clear(self):
+        self.client.delete(*[key for key in self.client.keys() if key.startswith(self.prefix)])
+
+    def __len__(self):
+        return len([key for key in self.client.keys() if key.startswith(self.prefix)])
+
+
+# An in-memory stand-in for an external key-value store, used for tests and local development
+# It behaves like the shared store would (values are strings and expire after ttl) but lives inside this process
+class LocalSharedClient:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl if ttl else None, value)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    # Adds amount to the integer stored at key and returns the new value, like Redis' INCRBY
+    # A missing key starts at 0 and expires after ttl seconds, like INCRBY followed by EXPIRE ... NX
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                entry = (time.monotonic() + ttl if ttl else None, '0')
+            value = int(entry[1]) + amount
+            self._data[key] = (entry[0], str(value))
+            return value
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+
+# Used when caching is turned off. Every lookup is a miss, so the finders always go to the database
+class NullCache:
+    def __init__(self):
+        self.stats = CacheStats()
+
+    def get(self, key):
+        self.stats.misses += 1
+        return None
+
+    def token(self, key):
+        return None
+
+    def set(self, key, value, token=None):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+# The cache the models talk to. Like the db object, it is created here and linked to the app with init_app()
+# Until init_app() is called it uses an LRUCache with the default settings
+class Cache:
+    def __init__(self):
+        self.backend = LRUCache()
+
+    # Configuration keys:
+    # CACHE_TYPE: 'lru' (default), 'shared' or 'null'
+    # CACHE_MAX_SIZE: maximum number of entries kept by the 'lru' backend
+    # CACHE_TTL: seconds before an entry expires
+    # CACHE_SHARED_CLIENT: the key-value client used by the 'shared' backend (defaults to LocalSharedClient)
+    def init_app(self, app):
+        cache_type = app.config.get('CACHE_TYPE', 'lru')
+        ttl = app.config.get('CACHE_TTL', 60)
+        if cache_type == 'lru':
+            self.backend = LRUCache(app.config.get('CACHE_MAX_SIZE', 10000), ttl)
+        elif cache_type == 'shared':
+            self.backend = SharedCache(app.config.get('CACHE_SHARED_CLIENT') or LocalSharedClient(), ttl)
+        elif cache_type == 'null':
+            self.backend = NullCache()
+        else:
+            raise ValueError(f'Unknown CACHE_TYPE {cache_type}')
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def delete(self, *keys):
+        self.backend.delete(*keys)
+
+    def clear(self):
+        self.backend.clear()
+
+    # Read-through lookup: return the cached value or call loader(), cache its result and return it
+    # Nothing is cached when the loader returns None, so a missing row is looked up again next time
+    # Nor when the key is deleted while the loader runs: the loader may have read the row before the write that
+    # deleted the key, and caching what it read would bring the old entry back until it expires
+    def get_or_load(self, key, loader):
+        value = self.backend.get(key)
+        if value is None:
+            token = self.backend.token(key)
+            value = loader()
+            if value is not None:
+                self.backend.set(key, value, token)
+        return value
+
+    # Same as get_or_load with a coroutine as the loader, for the async serving mode
+    async def get_or_load_async(self, key, loader):
+        value = self.backend.get(key)
+        if value is None:
+            token = self.backend.token(key)
+            value = await loader()
+            if value is not None:
+                self.backend.set(key, value, token)
+        return value
+
+    # Same as get_or_load for many keys at once. loader(missing_keys) returns a dictionary of key -> value for the keys
+    # it found, so every miss is loaded with a single call (one IN query) instead of one call per key
+    # Returns a dictionary of key -> value, keys that are neither cached nor found by the loader are left out
+    def get_or_load_many(self, keys, loader):
+        values = {}
+        missing = []
+        for key in keys:
+            value = self.backend.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+        if missing:
+            tokens = {key: self.backend.token(key) for key in missing}
+            for key, value in loader(missing).items():
+                self.backend.set(key, value, tokens[key])
+                values[key] = value
+        return values
+
+    def stats(self):
+        stats = self.backend.stats.json()
+        stats['size'] = len(self.backend)
+        return stats
+
+
+cache = Cache()
@@ -0,0 +1,286 @@
+# Import libraries
+import os
+import time
+import bisect
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from models.change import ChangeModel, ChangesCompacted
+
+logger = logging.getLogger(__name__)
+
+# Sent first on every stream: how many milliseconds the browser waits before it reconnects
+RETRY_FRAME = b'retry: 3000\n\n'
+# A comment line, which clients ignore. It keeps proxies from closing a stream that has been quiet for a while
+HEARTBEAT_FRAME = b': keep-alive\n\n'
+
+
+# The frame that ends a stream whose client is too far behind the log (see ChangesCompacted)
+def reset_frame(latest_seq):
+    return b'event: reset\ndata: {"latest_seq": %d}\n\n' % latest_seq
+
+
+# Wakes the coroutines waiting for new changes. Runs on their event loop
+def _wake(futures):
+    for future in futures:
+        if not future.done():
+            future.set_result(None)
+
+
+# The body of a /changes/stream response of the sync mode, see ChangeFeed.open_stream. The server calls close() when
+# the response is done, even when the client left before the first event, which frees the thread it held
+class _SyncStream:
+    def __init__(self, events, release):
+        self._events = events
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._events)
+
+    def close(self):
+        self._events.close()
+        if self._release is not None:
+            self._release()
+            self._release = None
+
+
+# Pushes the change log (see models/change.py) to the clients of /changes/stream
+# A single thread per process reads the new changes from the database, turns each of them into a server-sent event
+# once and appends it to a buffer that every stream of the process reads from. Adding a client costs no query at all,
+# only clients that are further behind than the buffer read their way back up to it from the database themselves
+# Works for the threads of the sync mode and for the coroutines of the async mode
+class ChangeFeed:
+    def __init__(self):
+        self._app = None
+        self.poll_interval = 0.5
+        self.buffer_size = 10000
+        self.batch_size = 1000
+        self.heartbeat = 15
+        self.retention = timedelta(days=7)
+        self.compact_interval = 3600
+        # Guards everything below. Streams of the sync mode wait on it for new changes
+        self._condition = threading.Condition()
+        # The buffer: the seq and the event of the latest changes, oldest first
+        self._seqs = []
+        self._frames = []
+        # Every change after _base is in the buffer. None while nobody listens, the buffer is empty then
+        self._base = None
+        # Futures of the streams of the async mode waiting for new changes, by event loop
+        self._async_waiters = {}
+        self.subscribers = 0
+        # Streams of the sync mode open right now in this process. Each of them holds a thread of the worker
+        self.sync_streams = 0
+        self.max_sync_streams = 2
+        self._thread = None
+        self._pid = None
+
+    # Configuration keys:
+    # CHANGES_POLL_INTERVAL: seconds between two reads of the new changes, while at least one client is connected
+    # CHANGES_BUFFER_SIZE: how many of the latest changes every process keeps for its streams
+    # CHANGES_HEARTBEAT: seconds of silence after which a stream gets a keep-alive comment
+    # CHANGES_RETENTION_DAYS: changes older than this are deleted by the compaction
+    # CHANGES_COMPACT_INTERVAL: seconds between two compactions, 0 turns them off (run `python changefeed.py` from cron instead)
+    # CHANGES_MAX_SYNC_STREAMS: streams every worker of the sync mode serves at once, the next ones get a 503. Keep it
+    # below THREADS, or the streams take every thread and the other requests wait. The async mode has no limit
+    def init_app(self, app):
+        self._app = app
+        self.poll_interval = app.config.get('CHANGES_POLL_INTERVAL', 0.5)
+        self.buffer_size = app.config.get('CHANGES_BUFFER_SIZE', 10000)
+        self.heartbeat = app.config.get('CHANGES_HEARTBEAT', 15)
+        self.retention = timedelta(days=app.config.get('CHANGES_RETENTION_DAYS', 7))
+        self.compact_interval = app.config.get('CHANGES_COMPACT_INTERVAL', 3600)
+        self.max_sync_streams = app.config.get('CHANGES_MAX_SYNC_STREAMS', 2)
+        # The thread is started by the first request of every worker, never in the gunicorn master (see gunicorn.conf.py)
+        app.before_request(self.start)
+
+    # Starts the thread of this process, unless it is already running. Threads do not survive a fork,
+    # so a worker forked from a process that had one starts its own
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._seqs, self._frames, self._base = [], [], None
+            self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        next_compaction = time.monotonic() + self.compact_interval
+        while True:
+            try:
+                with self._app.app_context():
+                    if self.subscribers:
+                        self._poll()
+                    if self.compact_interval and time.monotonic() >= next_compaction:
+                        next_compaction = time.monotonic() + self.compact_interval
+                        deleted = ChangeModel.compact(datetime.utcnow() - self.retention)
+                        logger.info('Compacted %d changes', deleted)
+            except Exception:
+                # The next round tries again, a stream only waits a little longer
+                logger.exception('Error while reading the change log')
+            time.sleep(self.poll_interval)
+
+    # Reads the changes written since the last poll into the buffer. Must run in an application context
+    def _poll(self):
+        if self._base is None:
+            # The first client just connected. The buffer starts at the current end of the log,
+            # anything before that is read from the database by the streams that need it
+            _, latest = ChangeModel.bounds()
+            with self._condition:
+                self._base = latest or 0
+            self._notify()
+            return
+        while True:
+            last = self._seqs[-1] if self._seqs else self._base
+            changes = ChangeModel.after(last, self.batch_size)
+            if changes:
+                self._publish([change.seq for change in changes], [change.sse_frame() for change in changes])
+            if len(changes) < self.batch_size:
+                return
+
+    def _publish(self, seqs, frames):
+        with self._condition:
+            # The last client may have left while we were reading
+            if self._base is None:
+                return
+            self._seqs += seqs
+            self._frames += frames
+            # Trimmed in one go once the buffer holds twice its size, instead of one change at a time
+            if len(self._seqs) > 2 * self.buffer_size:
+                drop = len(self._seqs) - self.buffer_size
+                self._base = self._seqs[drop - 1]
+                del self._seqs[:drop], self._frames[:drop]
+        self._notify()
+
+    # Wakes every stream, in both modes
+    def _notify(self):
+        with self._condition:
+            self._condition.notify_all()
+            waiters, self._async_waiters = self._async_waiters, {}
+        for loop, futures in waiters.items():
+            loop.call_soon_threadsafe(_wake, futures)
+
+    # Whether there is something after last that the stream has not sent yet. Must be called with the lock held
+    def _ready(self, last):
+        return self._base is not None and (last < self._base or (self._seqs and self._seqs[-1] > last))
+
+    def _subscribe(self):
+        self.start()
+        with self._condition:
+            self.subscribers += 1
+
+    def _unsubscribe(self):
+        with self._condition:
+            self.subscribers -= 1
+            # Nobody listens any more, so the thread stops reading and the buffer goes
+            if not self.subscribers:
+                self._seqs, self._frames, self._base = [], [], None
+
+    # Returns the seqs and the events of the buffered changes after last, or None if the buffer does not go back that far
+    def _buffered(self, last):
+        with self._condition:
+            if self._base is None or last < self._base:
+                return None
+            start = bisect.bisect_right(self._seqs, last)
+            return self._seqs[start:], self._frames[start:]
+
+    # Same as _buffered for a client that is behind the buffer: reads the next changes from the database
+    # Raises ChangesCompacted if they are gone
+    def _read(self, last):
+        with self._app.app_context():
+            changes, _ = ChangeModel.find_since(last, self.batch_size)
+            return [change.seq for change in changes], [change.sse_frame() for change in changes]
+
+    # Takes one of the CHANGES_MAX_SYNC_STREAMS places of the sync mode for a stream of the events after last
+    # Returns the body of the response, which gives the place back once the response is closed, or None when every
+    # place is taken
+    def open_stream(self, last):
+        with self._condition:
+            if self.sync_streams >= self.max_sync_streams:
+                return None
+            self.sync_streams += 1
+        return _SyncStream(self.stream(last), self._close_stream)
+
+    def _close_stream(self):
+        with self._condition:
+            self.sync_streams -= 1
+
+    # A generator of the events after the seq last, the body of a stream of the sync mode (see open_stream)
+    # Runs for as long as the client stays connected, and holds one thread of the worker for that time
+    def stream(self, last):
+        self._subscribe()
+        try:
+            yield RETRY_FRAME
+            while True:
+                try:
+                    seqs, frames = self._buffered(last) or self._read(last)
+                except ChangesCompacted as error:
+                    yield reset_frame(error.latest_seq)
+                    return
+                if frames:
+                    last = seqs[-1]
+                    yield b''.join(frames)
+                    continue
+                with self._condition:
+                    ready = self._condition.wait_for(lambda: self._ready(last), self.heartbeat)
+                if not ready:
+                    yield HEARTBEAT_FRAME
+        finally:
+            self._unsubscribe()
+
+    # Same as stream for the async mode. Waiting for new changes costs a future instead of a thread,
+    # and the database reads of a client that is behind run on the default executor
+    async def stream_async(self, last):
+        loop = asyncio.get_event_loop()
+        self._subscribe()
+        try:
+            yield RETRY_FRAME
+            while True:
+                try:
+                    buffered = self._buffered(last)
+                    seqs, frames = buffered if buffered is not None else await loop.run_in_executor(None, self._read, last)
+                except ChangesCompacted as error:
+                    yield reset_frame(error.latest_seq)
+                    return
+                if frames:
+                    last = seqs[-1]
+                    yield b''.join(frames)
+                    continue
+                if not await self._wait_async(loop, last):
+                    yield HEARTBEAT_FRAME
+        finally:
+            self._unsubscribe()
+
+    # Waits until there is something after last or the heartbeat is due. Returns False on the heartbeat
+    async def _wait_async(self, loop, last):
+        with self._condition:
+            if self._ready(last):
+                return True
+            future = loop.create_future()
+            self._async_waiters.setdefault(loop, []).append(future)
+        try:
+            await asyncio.wait_for(future, self.heartbeat)
+            return True
+        except asyncio.TimeoutError:
+            with self._condition:
+                waiters = self._async_waiters.get(loop, [])
+                if future in waiters:
+                    waiters.remove(future)
+            return False
+
+
+feed = ChangeFeed()
+
+
+# Run `python changefeed.py` to compact the change log once, for example from cron with CHANGES_COMPACT_INTERVAL=0
+if __name__ == '__main__':
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        print(f'Compacted {ChangeModel.compact(datetime.utcnow() - feed.retention)} changes')
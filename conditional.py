@@ -0,0 +1,43 @@
+# Import libraries
+import hashlib
+from flask import request, Response
+from werkzeug.http import quote_etag, http_date
+from db import timestamp
+
+
+# Builds the ETag and Last-Modified headers for a response
+# etag is the unquoted tag, last_modified is in seconds since the epoch (or None if we do not know it)
+def validator_headers(etag, last_modified=None):
+    headers = {'ETag': quote_etag(etag)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+# Returns True if the copy the client already has is still current, so we can answer 304 Not Modified
+# If-None-Match wins over If-Modified-Since when the client sends both, like the HTTP spec says
+# req defaults to Flask's request, the async resources pass in their own (see aio.py)
+def not_modified(etag, last_modified=None, req=None):
+    if req is None:
+        req = request
+    if req.if_none_match:
+        return req.if_none_match.contains_weak(etag)
+    since = req.if_modified_since
+    if since is not None and last_modified is not None:
+        # HTTP dates only have whole seconds, which is what timestamp() returns
+        return last_modified <= timestamp(since)
+    return False
+
+
+# The response sent when the client's copy is current. It has no body, only the validators
+def not_modified_response(headers):
+    return Response(status=304, headers=headers)
+
+
+# Builds the ETag of a collection out of cheap aggregates (row count, sum of versions, newest update...)
+# The query string is part of it, because every page of a collection is a different representation
+def collection_etag(name, *aggregates, req=None):
+    if req is None:
+        req = request
+    key = '|'.join(str(value) for value in aggregates) + '|' + req.query_string.decode()
+    return f'{name}-' + hashlib.sha1(key.encode()).hexdigest()[:20]
@@ -0,0 +1,120 @@
+# Import libraries
+import os
+import multiprocessing
+
+
+# Reads an environment variable and converts it to the type of the default value
+def env(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return type(default)(value)
+
+
+# The default configuration of the application. Every setting can be overridden with an environment variable
+# create_app() loads this class with app.config.from_object(), so only the UPPERCASE attributes become settings
+class Config:
+    # Should be something long, complicated and secure. It is used to encrypt the JWT
+    SECRET_KEY = env('SECRET_KEY', 'karan')
+
+    # Connect SQLAlchemy to our sqlite database which lives in the root of our project
+    SQLALCHEMY_DATABASE_URI = env('DATABASE_URL', 'sqlite:///data.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False # SQLAlchemy has its own modification tracker, so we can turn off Flask's version
+    PROPAGATE_EXCEPTIONS = True # Without this, if Flask JWT raises a custom error, you won't see it
+
+    # Connection pool of every worker process. pool_size connections are kept open and up to max_overflow more
+    # are opened under load. Connections older than pool_recycle seconds are replaced and pre_ping tests a
+    # connection before handing it out, so a connection the database closed on us is never used
+    DB_POOL_SIZE = env('DB_POOL_SIZE', 5)
+    DB_MAX_OVERFLOW = env('DB_MAX_OVERFLOW', 10)
+    DB_POOL_RECYCLE = env('DB_POOL_RECYCLE', 1800)
+    DB_POOL_PRE_PING = env('DB_POOL_PRE_PING', True)
+
+    # Read replicas, see db.py. GET requests read from one of them, everything else uses the primary above
+    # DATABASE_REPLICA_URLS is a comma separated list. For SQLite, DB_READ_REPLICAS opens that many read-only pools
+    # on the database file instead, since SQLite has no replication. A client reads from the primary for
+    # DB_STICKY_SECONDS after it wrote something, so it always sees its own writes
+    DATABASE_REPLICA_URLS = env('DATABASE_REPLICA_URLS', '')
+    DB_READ_REPLICAS = env('DB_READ_REPLICAS', 0)
+    DB_STICKY_SECONDS = env('DB_STICKY_SECONDS', 5)
+
+    # Sharding, see shards.py. The items are spread over DB_SHARDS databases by store, the rest stays in the primary
+    # For SQLite the shards are files next to the primary (data.shard0.db...), DATABASE_SHARD_URLS lists them instead
+    # DB_SHARD_WORKERS threads of every worker query the shards in parallel
+    DB_SHARDS = env('DB_SHARDS', 0)
+    DATABASE_SHARD_URLS = env('DATABASE_SHARD_URLS', '')
+    DB_SHARD_WORKERS = env('DB_SHARD_WORKERS', 8)
+
+    # SQLite only. WAL lets readers keep reading while a writer commits, and busy_timeout makes a writer wait
+    # for the lock instead of failing straight away with "database is locked"
+    SQLITE_BUSY_TIMEOUT = env('SQLITE_BUSY_TIMEOUT', 5000) # Milliseconds
+    SQLITE_PRAGMAS = {
+        'journal_mode': env('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': env('SQLITE_SYNCHRONOUS', 'NORMAL'), # Safe with WAL, only the last commits can be lost on power failure
+        'cache_size': env('SQLITE_CACHE_SIZE', -64000), # Negative means KiB, so 64MB of page cache per connection
+        'temp_store': 'MEMORY',
+    }
+
+    # Cache in front of the item and store lookups. Use 'shared' with CACHE_SHARED_CLIENT to share it between workers
+    # With 'lru' and more than one worker, the other workers keep serving an entry for up to CACHE_TTL after a write
+    CACHE_TYPE = env('CACHE_TYPE', 'lru')
+    CACHE_MAX_SIZE = env('CACHE_MAX_SIZE', 10000) # Maximum number of cached items and stores per worker
+    CACHE_TTL = env('CACHE_TTL', 60) # Seconds before a cached entry expires
+
+    # JSON encoder for the responses: 'auto' uses orjson when it is installed, 'orjson' or 'stdlib' pick one
+    JSON_BACKEND = env('JSON_BACKEND', 'auto')
+
+    # Per-request metrics on /metrics (see metrics.py). Both of the checks below are off when set to 0
+    METRICS_ENABLED = env('METRICS_ENABLED', True)
+    METRICS_SLOW_QUERY_MS = env('METRICS_SLOW_QUERY_MS', 0) # Log SQL statements slower than this
+    METRICS_QUERY_BUDGET = env('METRICS_QUERY_BUDGET', 0) # Warn when a request runs more SQL statements than this
+
+    # Check every access and refresh token against the blocklist (see blocklist.py), so tokens can be revoked
+    JWT_BLACKLIST_ENABLED = True
+    JWT_BLACKLIST_TOKEN_CHECKS = ['access', 'refresh']
+    # 'local' keeps revoked tokens in each worker, 'shared' keeps them in BLOCKLIST_SHARED_CLIENT for every worker
+    BLOCKLIST_TYPE = env('BLOCKLIST_TYPE', 'local')
+
+    # Password hashing (see passwords.py). PBKDF2 iterations are the cost, pick them with benchmarks/password_bench.py
+    PASSWORD_HASH_ALGORITHM = env('PASSWORD_HASH_ALGORITHM', 'sha256')
+    PASSWORD_HASH_ITERATIONS = env('PASSWORD_HASH_ITERATIONS', 150000)
+    PASSWORD_HASH_EXECUTOR = env('PASSWORD_HASH_EXECUTOR', 'thread') # 'thread' or 'process'
+    PASSWORD_HASH_WORKERS = env('PASSWORD_HASH_WORKERS', 2) # Hashes running at the same time in each worker
+    PASSWORD_HASH_QUEUE = env('PASSWORD_HASH_QUEUE', 32) # Logins waiting for a hash worker before we answer 503
+
+    # Rate limits of the login and registration endpoints (see ratelimit.py), written as '<hits>/<period>'
+    # 'local' keeps the counters in each worker, 'shared' keeps them in RATELIMIT_SHARED_CLIENT for every worker
+    RATELIMIT_ENABLED = env('RATELIMIT_ENABLED', True)
+    RATELIMIT_TYPE = env('RATELIMIT_TYPE', 'local')
+    RATELIMIT_ALGORITHM = env('RATELIMIT_ALGORITHM', 'token_bucket') # 'token_bucket' or 'sliding_window'
+    RATELIMIT_TRUST_PROXY = env('RATELIMIT_TRUST_PROXY', False) # Only when a proxy in front of us sets X-Forwarded-For
+    RATELIMIT_LOGIN_IP = env('RATELIMIT_LOGIN_IP', '20/minute')
+    RATELIMIT_LOGIN_USERNAME = env('RATELIMIT_LOGIN_USERNAME', '5/minute')
+    RATELIMIT_REGISTER_IP = env('RATELIMIT_REGISTER_IP', '10/hour')
+
+    # The change log of /changes and /changes/stream (see changefeed.py)
+    CHANGES_POLL_INTERVAL = env('CHANGES_POLL_INTERVAL', 0.5) # Seconds between two reads of the log, one reader per worker
+    CHANGES_BUFFER_SIZE = env('CHANGES_BUFFER_SIZE', 10000) # Latest changes every worker keeps for its streams
+    CHANGES_HEARTBEAT = env('CHANGES_HEARTBEAT', 15) # Seconds of silence before a stream gets a keep-alive comment
+    CHANGES_RETENTION_DAYS = env('CHANGES_RETENTION_DAYS', 7) # Older changes are compacted away
+    CHANGES_COMPACT_INTERVAL = env('CHANGES_COMPACT_INTERVAL', 3600) # Seconds between two compactions, 0 turns them off
+    # Streams a worker of the sync mode serves at once, each holds one of its THREADS. The async mode has no limit
+    CHANGES_MAX_SYNC_STREAMS = env('CHANGES_MAX_SYNC_STREAMS', 2)
+
+    # Write-behind queue for the price updates of PUT /item/<name> (see writebehind.py), off by default
+    WRITE_BEHIND_ENABLED = env('WRITE_BEHIND_ENABLED', False)
+    WRITE_BEHIND_MAX_BATCH = env('WRITE_BEHIND_MAX_BATCH', 500) # Items per flush transaction, a full batch is flushed at once
+    WRITE_BEHIND_MAX_DELAY_MS = env('WRITE_BEHIND_MAX_DELAY_MS', 50) # Longest an update waits in the queue
+    WRITE_BEHIND_MAX_PENDING = env('WRITE_BEHIND_MAX_PENDING', 10000) # Items waiting per worker before updates are held back
+    WRITE_BEHIND_ENQUEUE_TIMEOUT = env('WRITE_BEHIND_ENQUEUE_TIMEOUT', 1.0) # Seconds an update waits for room before a 503
+    WRITE_BEHIND_DURABILITY = env('WRITE_BEHIND_DURABILITY', 'memory') # 'memory', 'journal' or 'fsync'
+    WRITE_BEHIND_JOURNAL_DIR = env('WRITE_BEHIND_JOURNAL_DIR', 'write-behind')
+
+    # Production server (see gunicorn.conf.py). Each worker is a separate process with THREADS threads
+    # SERVER_MODE 'async' serves asgi:app instead, with one event loop per worker and no threads (see aio.py)
+    SERVER_MODE = env('SERVER_MODE', 'sync')
+    BIND = env('BIND', '0.0.0.0:5000')
+    WORKERS = env('WORKERS', multiprocessing.cpu_count() * 2 + 1)
+    THREADS = env('THREADS', 4)
@@ -1,5 +1,163 @@
-from flask_sqlalchemy import SQLAlchemy
-
-# An object of type SQLAlchemy. This links to our Flask app and allows us to map our objects to rows in a database
-# For example, our ItemModel object with a name and price column can easily be placed into a database
-db = SQLAlchemy()
\ No newline at end of file
+import time
+import random
+import calendar
+from flask import g, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+# Read replicas are extra binds of Flask-SQLAlchemy named replica_0, replica_1...
+REPLICA_BIND_PREFIX = 'replica_'
+# The cookie that sends a client's reads to the primary for a little while after it wrote something
+STICKY_COOKIE = 'read_primary_until'
+
+
+# The session used by db.session. It sends reads to one of the read replicas while a GET request is served
+# (see init_replicas), and everything else to the primary: every write, every statement of a flush, every
+# request that is not a GET, and every background thread
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self._db = db
+        # A session keeps reading from the same replica, so a request sees a single snapshot
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase) or not (has_request_context() and g.get('db_read_replica')):
+            return super().get_bind(mapper, clause)
+        if self._replica is None:
+            self._replica = random.choice(self.app.config['DB_REPLICA_BINDS'])
+        return self._db.get_engine(self.app, bind=self._replica)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# An object of type SQLAlchemy. This links to our Flask app and allows us to map our objects to rows in a database
+# For example, our ItemModel object with a name and price column can easily be placed into a database
+db = RoutingSQLAlchemy()
+
+# SQLite refuses queries with more than 999 parameters, so IN (...) queries are split into chunks of this size
+IN_CHUNK_SIZE = 500
+
+
+# Splits a list into consecutive lists of at most size elements
+def chunks(values, size=IN_CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+
+# Turns a naive UTC datetime, like the updated_at columns, into whole seconds since the epoch. None stays None
+def timestamp(value):
+    return calendar.timegm(value.utctimetuple()) if value is not None else None
+
+
+# Builds the SQLALCHEMY_ENGINE_OPTIONS for the connection pool out of the DB_POOL_* settings
+def engine_options(config):
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    # An in-memory SQLite database only exists inside its one connection, so it cannot be pooled
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        return {}
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if uri.startswith('sqlite'):
+        # SQLAlchemy opens a new SQLite connection for every checkout by default, so we ask for a real pool.
+        # Pooled connections are used by different threads one after the other, which sqlite3 refuses unless
+        # check_same_thread is off. timeout is how long sqlite3 waits for a lock, in seconds
+        options['poolclass'] = QueuePool
+        options['connect_args'] = {'check_same_thread': False, 'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}
+    return options
+
+
+# The binds of the read replicas, out of the DATABASE_REPLICA_URLS and DB_READ_REPLICAS settings
+# A SQLite database has no replicas, so DB_READ_REPLICAS opens that many extra read-only pools on the same file instead.
+# In WAL mode every reader works on its own snapshot and never waits for the writer, which makes them behave like replicas
+def replica_binds(config):
+    urls = [url.strip() for url in config.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if not urls and uri.startswith('sqlite') and uri not in ('sqlite://', 'sqlite:///:memory:'):
+        urls = [uri] * config.get('DB_READ_REPLICAS', 0)
+    return {f'{REPLICA_BIND_PREFIX}{number}': url for number, url in enumerate(urls)}
+
+
+# Turns on the read/write splitting of RoutingSession for the replica binds created by replica_binds()
+# Returns the engines of the replicas. Must run in an application context, after db.init_app()
+def init_replicas(app):
+    binds = sorted(key for key in (app.config.get('SQLALCHEMY_BINDS') or {}) if key.startswith(REPLICA_BIND_PREFIX))
+    app.config['DB_REPLICA_BINDS'] = binds
+    if not binds:
+        return []
+    engines = [db.get_engine(app, bind=bind) for bind in binds]
+    for engine in engines:
+        set_sqlite_pragmas(engine, app.config, read_only=True)
+    sticky_seconds = app.config.get('DB_STICKY_SECONDS', 5)
+
+    # GET requests read from a replica, unless the client wrote something in the last DB_STICKY_SECONDS,
+    # in which case the replica may not have its write yet (read-your-writes)
+    @app.before_request
+    def choose_engine():
+        if request.method in ('GET', 'HEAD'):
+            try:
+                sticky_until = float(request.cookies.get(STICKY_COOKIE, 0))
+            except ValueError:
+                sticky_until = 0
+            g.db_read_replica = sticky_until < time.time()
+
+    # After a successful write, the client reads from the primary for a while. The deadline lives in a cookie,
+    # so it holds whichever worker serves the client's next request
+    @app.after_request
+    def remember_write(response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 and sticky_seconds:
+            response.set_cookie(STICKY_COOKIE, str(round(time.time() + sticky_seconds, 3)), max_age=sticky_seconds, httponly=True)
+        return response
+
+    return engines
+
+
+# The async drivers used by the async serving mode, by the scheme of SQLALCHEMY_DATABASE_URI
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg', 'mysql': 'mysql+aiomysql'}
+
+
+# Creates the engine of the async serving mode (see aio.py) for the same database and pool settings as the sync engine
+# sqlalchemy.ext.asyncio needs SQLAlchemy 1.4 and an async driver (aiosqlite for SQLite), so it is only imported here
+def create_async_engine(config):
+    from sqlalchemy.ext.asyncio import create_async_engine as _create_async_engine
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    scheme, rest = config['SQLALCHEMY_DATABASE_URI'].split(':', 1)
+    if scheme not in ASYNC_DRIVERS:
+        raise ValueError(f'The async mode does not support {scheme} databases')
+    options = engine_options(config)
+    if options.get('poolclass') is QueuePool:
+        # The async engine needs the asyncio version of the pool
+        options['poolclass'] = AsyncAdaptedQueuePool
+    engine = _create_async_engine(ASYNC_DRIVERS[scheme] + ':' + rest, **options)
+    # The pragmas are set on the sync engine the async one wraps, which is where the connect event fires
+    set_sqlite_pragmas(engine.sync_engine, config)
+    return engine
+
+
+# Runs the SQLITE_PRAGMAS on every new SQLite connection of the engine, for example to turn on WAL mode
+# The connections of a read replica (read_only) leave the journal alone and refuse to write with query_only
+def set_sqlite_pragmas(engine, config, read_only=False):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}")
+        for name, value in config['SQLITE_PRAGMAS'].items():
+            if not (read_only and name in ('journal_mode', 'synchronous')):
+                cursor.execute(f'PRAGMA {name} = {value}')
+        if read_only:
+            cursor.execute('PRAGMA query_only = 1')
+        cursor.close()
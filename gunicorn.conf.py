@@ -0,0 +1,40 @@
+# Gunicorn settings for running the API in production: gunicorn -c gunicorn.conf.py
+# Every value comes from config.py, so it can be changed with the same environment variables (BIND, WORKERS, THREADS, SERVER_MODE)
+from config import Config
+
+bind = Config.BIND
+# Several worker processes let us use every core, and the threads of a worker serve requests while others wait on the database
+workers = Config.WORKERS
+if Config.SERVER_MODE == 'async':
+    # Every worker runs an event loop that serves the async resources, so waiting requests do not need a thread each
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+elif Config.SERVER_MODE == 'sync':
+    wsgi_app = 'wsgi:app'
+    threads = Config.THREADS
+    worker_class = 'gthread'
+else:
+    raise ValueError(f'Unknown SERVER_MODE {Config.SERVER_MODE}')
+# Restart workers every so often so a slow leak can never take a worker down
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+# Runs once in the master process before any worker starts, so the migrations never run in several workers at once
+def on_starting(server):
+    from app import create_app
+    from db import db
+    from migrations import upgrade_db
+    from shards import shards
+
+    app = create_app()
+    with app.app_context():
+        upgrade_db()
+        # Close the master's connections so the forked workers do not share them
+        db.engine.dispose()
+        shards.dispose()
+    # Every worker has its own 'lru' cache and a write only clears the one of the worker that served it, so the other
+    # workers can serve the old item or store (and its old ETag) for up to CACHE_TTL seconds
+    if workers > 1 and Config.CACHE_TYPE == 'lru':
+        server.log.warning('CACHE_TYPE lru is not shared between the %d workers, reads can be up to CACHE_TTL seconds stale. '
+                           'Use CACHE_TYPE shared with a CACHE_SHARED_CLIENT every worker reaches, or null', workers)
@@ -0,0 +1,261 @@
+# Import libraries
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from flask_jwt_extended import view_decorators
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets. Durations are in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 5000)
+
+
+# A Prometheus histogram: how many observations fell in each bucket, plus their sum and count, for every set of labels
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count per bucket..., sum, count]
+        self._series = {}
+
+    # Must be called with the lock of the Metrics object held
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[position] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self._series.items()):
+            label_text = ','.join(f'{key}="{value}"' for key, value in labels)
+            # Prometheus buckets are cumulative: every bucket counts the observations of the smaller buckets as well
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {series[-1]}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {series[-2]}')
+            lines.append(f'{self.name}_count{{{label_text}}} {series[-1]}')
+        return lines
+
+
+# A Prometheus counter for every set of labels
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._series = {}
+
+    # Must be called with the lock of the Metrics object held
+    def inc(self, labels, value=1):
+        self._series[labels] = self._series.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self._series.items()):
+            label_text = ','.join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f'{self.name}{{{label_text}}} {value}' if label_text else f'{self.name} {value}')
+        return lines
+
+
+# A Prometheus gauge. Its value is read from a function when /metrics is scraped, so it never goes stale
+class Gauge:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._function = None
+
+    def set_function(self, function):
+        self._function = function
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        if self._function is not None:
+            lines.append(f'{self.name} {self._function()}')
+        return lines
+
+
+# Records per-request latency, SQL statement counts, database time and JWT decode time for every endpoint,
+# serves them on /metrics in the Prometheus text format and adds a Server-Timing header to every response
+# Every worker process keeps its own numbers, Prometheus adds them up when it scrapes every worker
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # The counter of count_statements, per thread
+        self._thread_counter = threading.local()
+        self.request_seconds = Histogram('api_request_duration_seconds', 'Time spent handling a request', DURATION_BUCKETS)
+        self.db_seconds = Histogram('api_request_db_seconds', 'Time spent running SQL statements per request', DURATION_BUCKETS)
+        self.db_statements = Histogram('api_request_db_statements', 'Number of SQL statements per request', QUERY_COUNT_BUCKETS)
+        self.jwt_seconds = Histogram('api_request_jwt_decode_seconds', 'Time spent decoding the JWT of a request', DURATION_BUCKETS)
+        self.responses = Counter('api_responses_total', 'Responses sent, by status code')
+        self.budget_exceeded = Counter('api_query_budget_exceeded_total', 'Requests that ran more SQL statements than METRICS_QUERY_BUDGET')
+        self.slow_queries = Counter('api_slow_queries_total', 'SQL statements slower than METRICS_SLOW_QUERY_MS')
+        # The write-behind queue of the item price updates (see writebehind.py)
+        self.write_queue_depth = Gauge('api_write_queue_depth', 'Items waiting in the write-behind queue')
+        self.write_flush_seconds = Histogram('api_write_queue_flush_seconds', 'Time spent flushing the write-behind queue', DURATION_BUCKETS)
+        self.write_flush_items = Histogram('api_write_queue_flush_items', 'Items written by a flush of the write-behind queue', BATCH_SIZE_BUCKETS)
+        self.write_coalesced = Counter('api_write_queue_coalesced_total', 'Updates that replaced a queued update of the same item')
+        self.write_rejected = Counter('api_write_queue_rejected_total', 'Updates rejected because the write-behind queue was full')
+        self.slow_query_seconds = None
+        self.query_budget = None
+
+    # Configuration keys:
+    # METRICS_ENABLED: set to False to turn the instrumentation off completely
+    # METRICS_SLOW_QUERY_MS: log every SQL statement slower than this many milliseconds (off by default)
+    # METRICS_QUERY_BUDGET: log a warning when a request runs more SQL statements than this (off by default)
+    # engines are the primary engine and the engines of the read replicas, all of their statements are counted
+    def init_app(self, app, *engines):
+        if not app.config.get('METRICS_ENABLED', True):
+            return
+        slow_query_ms = app.config.get('METRICS_SLOW_QUERY_MS')
+        self.slow_query_seconds = slow_query_ms / 1000 if slow_query_ms else None
+        self.query_budget = app.config.get('METRICS_QUERY_BUDGET')
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.render)
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(engine, 'handle_error', self._handle_error)
+        _instrument_jwt_decoding(self)
+
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_db_statements = 0
+        g.metrics_db_seconds = 0.0
+        g.metrics_jwt_seconds = 0.0
+
+    def _finish_request(self, response):
+        if 'metrics_start' not in g:
+            return response
+        seconds = time.perf_counter() - g.metrics_start
+        # request.endpoint is the name api.add_resource gave the resource, for example 'item' or 'storelist'
+        endpoint = request.endpoint or 'unmatched'
+        labels = (('endpoint', endpoint), ('method', request.method))
+        statements = g.metrics_db_statements
+
+        with self._lock:
+            self.request_seconds.observe(labels, seconds)
+            self.db_seconds.observe(labels, g.metrics_db_seconds)
+            self.db_statements.observe(labels, statements)
+            if g.metrics_jwt_seconds:
+                self.jwt_seconds.observe(labels, g.metrics_jwt_seconds)
+            self.responses.inc(labels + (('status', response.status_code),))
+            if self.query_budget and statements > self.query_budget:
+                self.budget_exceeded.inc(labels)
+
+        if self.query_budget and statements > self.query_budget:
+            logger.warning('%s %s ran %d SQL statements, the budget is %d', request.method, request.path, statements, self.query_budget)
+
+        # Server-Timing shows up in the browser's developer tools. Durations are in milliseconds
+        response.headers.add('Server-Timing', ', '.join([
+            f'app;dur={seconds * 1000:.2f}',
+            f'db;dur={g.metrics_db_seconds * 1000:.2f};desc="{statements} queries"',
+            f'jwt;dur={g.metrics_jwt_seconds * 1000:.2f}',
+        ]))
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['metrics_query_start'].pop()
+        if self.slow_query_seconds and seconds > self.slow_query_seconds:
+            logger.warning('Slow query (%.1f ms): %s', seconds * 1000, statement)
+            with self._lock:
+                self.slow_queries.inc(())
+        # Statements run by background threads (outside of a request) are not counted against any request,
+        # unless the thread runs them on behalf of a request (see count_statements)
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_db_statements += 1
+            g.metrics_db_seconds += seconds
+        elif getattr(self._thread_counter, 'value', None) is not None:
+            self._thread_counter.value[0] += 1
+            self._thread_counter.value[1] += seconds
+
+    # A statement that fails never reaches after_cursor_execute, so its start time is dropped here. Otherwise it would
+    # stay on the stack of the pooled connection for good, and a statement run inside another would be timed from it
+    # context.connection is None when the connection itself could not be made
+    def _handle_error(self, context):
+        if context.connection is not None and context.connection.info.get('metrics_query_start'):
+            context.connection.info['metrics_query_start'].pop()
+
+    # Counts the statements this thread runs inside the with block, as [statements, seconds]. Used by the threads that
+    # query the shards for a request (see shards.py), which hand the numbers to record_db_statements afterwards
+    @contextmanager
+    def count_statements(self):
+        self._thread_counter.value = counter = [0, 0.0]
+        try:
+            yield counter
+        finally:
+            self._thread_counter.value = None
+
+    # Adds statements run on another thread to the current request
+    def record_db_statements(self, statements, seconds):
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_db_statements += statements
+            g.metrics_db_seconds += seconds
+
+    # Called when a JWT has been decoded, with the time it took
+    def record_jwt_decode(self, seconds):
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_jwt_seconds += seconds
+
+    # Called by the write-behind queue after every flush, with the time it took and the number of items written
+    def record_write_flush(self, seconds, items):
+        with self._lock:
+            self.write_flush_seconds.observe((), seconds)
+            self.write_flush_items.observe((), items)
+
+    def record_write_coalesced(self):
+        with self._lock:
+            self.write_coalesced.inc(())
+
+    def record_write_rejected(self):
+        with self._lock:
+            self.write_rejected.inc(())
+
+    # The /metrics endpoint, in the Prometheus text format
+    def render(self):
+        # The gauge reads the queue under the lock of the queue, so it is not read under ours
+        lines = self.write_queue_depth.render()
+        with self._lock:
+            for metric in (self.request_seconds, self.db_seconds, self.db_statements, self.jwt_seconds,
+                           self.responses, self.budget_exceeded, self.slow_queries,
+                           self.write_flush_seconds, self.write_flush_items, self.write_coalesced, self.write_rejected):
+                lines += metric.render()
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+# flask-jwt-extended decodes the token inside its decorators, so we time it by wrapping the decode_token function
+# the decorators call. Only done once per process, even if several apps are created
+def _instrument_jwt_decoding(metrics):
+    decode_token = getattr(view_decorators, 'decode_token', None)
+    if decode_token is None or getattr(decode_token, 'instrumented', False):
+        return
+
+    def timed_decode_token(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return decode_token(*args, **kwargs)
+        finally:
+            metrics.record_jwt_decode(time.perf_counter() - start)
+
+    timed_decode_token.instrumented = True
+    view_decorators.decode_token = timed_decode_token
+
+
+metrics = Metrics()
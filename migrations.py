@@ -0,0 +1,169 @@
+# Import libraries
+from sqlalchemy import inspect, text
+from db import db
+from shards import shards
+
+# Every change to the schema of an existing database is a function in this list, applied in order
+# The number of migrations that have been applied is stored in the schema_version table
+# To change the schema: update the models AND append a migration that makes the same change to an existing database
+MIGRATIONS = []
+
+
+# Decorator that registers a migration. Never reorder or remove migrations, only append new ones
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+# Removes rows that share the same value in column, keeping the one with the lowest id
+# This is the row that filter_by(...).first() returned before the column was unique
+def _delete_duplicates(conn, table, column):
+    conn.execute(text(f'DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {column})'))
+
+
+# 1: index the columns we look rows up by and make names unique, so the "already exists" checks cannot race
+@migration
+def add_lookup_indexes(conn):
+    _delete_duplicates(conn, 'items', 'name')
+    _delete_duplicates(conn, 'stores', 'name')
+    _delete_duplicates(conn, 'users', 'username')
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_items_name ON items (name)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_items_store_id ON items (store_id)'))
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_stores_name ON stores (name)'))
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username)'))
+
+
+# 2: make room for password hashes. SQLite does not enforce the length of a VARCHAR, so there is nothing to do there
+# Existing plaintext passwords are hashed the next time their user logs in (see passwords.py)
+@migration
+def widen_password_column(conn):
+    if conn.dialect.name != 'sqlite':
+        conn.execute(text('ALTER TABLE users ALTER COLUMN password TYPE VARCHAR(255)'))
+
+
+# 3: store roles on the users instead of hard-coding the user with id 1 as the admin
+@migration
+def add_user_roles(conn):
+    conn.execute(text("ALTER TABLE users ADD COLUMN role VARCHAR(20) NOT NULL DEFAULT 'user'"))
+    conn.execute(text("UPDATE users SET role = 'admin' WHERE id = 1"))
+
+
+# 4: versions and update times of items and stores, which are their ETag and Last-Modified
+@migration
+def add_versions(conn):
+    for table in ('items', 'stores'):
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+        # SQLite cannot add a column with a non-constant default, so the column is filled in afterwards
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN updated_at DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00'"))
+        conn.execute(text(f'UPDATE {table} SET updated_at = CURRENT_TIMESTAMP'))
+
+
+# 5: indexes for the price filters of /items and the full-text search index on the item names
+@migration
+def add_search_indexes(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_items_price ON items (price)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_items_store_id_price ON items (store_id, price)'))
+    create_search_index(conn)
+
+
+# 6: aggregates of the items of every store, so a store summary does not have to read its items (see StoreModel.touch)
+@migration
+def add_store_aggregates(conn):
+    conn.execute(text('ALTER TABLE stores ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0'))
+    conn.execute(text('ALTER TABLE stores ADD COLUMN price_sum FLOAT NOT NULL DEFAULT 0'))
+    conn.execute(text('ALTER TABLE stores ADD COLUMN min_price FLOAT'))
+    conn.execute(text('ALTER TABLE stores ADD COLUMN max_price FLOAT'))
+    # From here on the aggregates are updated incrementally, this is the only time they are computed from every item
+    conn.execute(text('''UPDATE stores SET
+        item_count = (SELECT COUNT(*) FROM items WHERE items.store_id = stores.id),
+        price_sum = (SELECT COALESCE(SUM(price), 0) FROM items WHERE items.store_id = stores.id),
+        min_price = (SELECT MIN(price) FROM items WHERE items.store_id = stores.id),
+        max_price = (SELECT MAX(price) FROM items WHERE items.store_id = stores.id)'''))
+
+
+# 7: the shard of every store and the block of item ids handed out to the workers, for the sharded mode (see shards.py)
+@migration
+def add_store_shards(conn):
+    conn.execute(text('ALTER TABLE stores ADD COLUMN shard INTEGER'))
+    conn.execute(text('CREATE TABLE IF NOT EXISTS id_blocks (name VARCHAR(40) NOT NULL PRIMARY KEY, next_id INTEGER NOT NULL)'))
+
+
+# The FTS5 full-text index of the item names. It is an external content table, so the names are not stored twice,
+# and the triggers keep it in sync with every insert, update and delete, including the bulk ones
+SEARCH_INDEX_SQL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(name, content='items', content_rowid='id')",
+    '''CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts (rowid, name) VALUES (new.id, new.name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts (items_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name ON items BEGIN
+        INSERT INTO items_fts (items_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO items_fts (rowid, name) VALUES (new.id, new.name);
+    END''',
+    # Index the items that already exist
+    "INSERT INTO items_fts (items_fts) VALUES ('rebuild')",
+]
+
+
+# Creates the full-text index. Only SQLite built with FTS5 has it, everywhere else the search falls back to LIKE
+def create_search_index(conn):
+    if conn.dialect.name != 'sqlite':
+        return
+    if not conn.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar():
+        return
+    for statement in SEARCH_INDEX_SQL:
+        conn.execute(text(statement))
+
+
+# Things the models cannot describe (virtual tables, triggers...), created along with the tables of a brand new database
+# Migrations that add such things must call the same function, so existing databases get them as well
+SCHEMA_EXTRAS = [create_search_index]
+
+
+# Returns how many migrations have been applied to the database, creating the schema_version table if needed
+def _current_version(conn):
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    version = conn.execute(text('SELECT version FROM schema_version')).scalar()
+    if version is None:
+        conn.execute(text('INSERT INTO schema_version (version) VALUES (0)'))
+        return 0
+    return version
+
+
+# Brings the database up to date, and every shard with it. Must be called inside an application context
+def upgrade_db():
+    _upgrade(db.engine)
+    # The shards get the whole schema as well, even though only their items table is used
+    for engine in shards.engines:
+        _upgrade(engine)
+
+
+# A brand new database is created straight from the models, an existing one has its pending migrations applied
+def _upgrade(engine):
+    # Check for tables before schema_version gets created, so we know whether this is a brand new database
+    tables = set(inspect(engine).get_table_names())
+    fresh = not tables.intersection(db.metadata.tables)
+
+    # engine.begin() runs everything below in one transaction, so a failed migration leaves the database untouched
+    with engine.begin() as conn:
+        version = _current_version(conn)
+        # Creates the tables that do not exist yet. Existing tables are left alone, that is what the migrations are for
+        db.metadata.create_all(bind=conn)
+        # A brand new database was just created from the models, which already describe the latest schema
+        if fresh:
+            for extra in SCHEMA_EXTRAS:
+                extra(conn)
+        else:
+            for step in MIGRATIONS[version:]:
+                step(conn)
+        conn.execute(text('UPDATE schema_version SET version = :version'), {'version': len(MIGRATIONS)})
+
+
+# Run `python migrations.py` to upgrade the database offline, without starting the server
+if __name__ == '__main__':
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        upgrade_db()
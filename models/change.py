@@ -0,0 +1,116 @@
+# Import the SQLAlchemy object from our db.py file
+import json
+from datetime import datetime
+from sqlalchemy import select
+from db import db
+from schemas import dumps
+
+
+# Raised when a client asks for changes that have already been compacted away (see ChangeModel.compact)
+# It cannot catch up from the log any more, so it has to reload /items and /stores and start again from latest_seq
+class ChangesCompacted(Exception):
+    def __init__(self, latest_seq):
+        super().__init__(latest_seq)
+        self.latest_seq = latest_seq
+
+
+# The change log: one row for every item or store that is created, updated or deleted
+# The rows are written by the save_to_db and delete_from_db methods of the models, in the same transaction as the
+# change itself, so the log never shows a change that was rolled back and never misses one that was committed
+# seq only ever grows, so a client that remembers the last seq it has seen can ask for everything after it
+class ChangeModel(db.Model):
+    __tablename__ = 'changes'
+    # AUTOINCREMENT makes SQLite never hand out the seq of a compacted change again
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(10), nullable=False) # 'item' or 'store'
+    op = db.Column(db.String(10), nullable=False) # 'upsert' or 'delete'
+    entity_id = db.Column(db.Integer)
+    name = db.Column(db.String(80), nullable=False)
+    # The JSON of the item or store after the change, NULL for a delete
+    data = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True) # Indexed for compact()
+
+    def __init__(self, entity, op, entity_id, name, data=None):
+        self.entity = entity
+        self.op = op
+        self.entity_id = entity_id
+        self.name = name
+        self.data = json.dumps(data) if data is not None else None
+
+    def json(self):
+        return {'seq': self.seq, 'entity': self.entity, 'op': self.op, 'id': self.entity_id, 'name': self.name,
+                'data': json.loads(self.data) if self.data is not None else None}
+
+    # The change as a server-sent event. The id is the seq, which the browser sends back in Last-Event-ID when it reconnects
+    def sse_frame(self):
+        body = dumps(self.json())
+        return b'id: %d\ndata: %s\n\n' % (self.seq, body if isinstance(body, bytes) else body.encode())
+
+    # Adds a change to session. It is written by the commit of the change itself
+    @classmethod
+    def record(cls, entity, op, entity_id, name, data=None, session=None):
+        if session is None:
+            session = db.session
+        session.add(cls(entity, op, entity_id, name, data))
+
+    # Same as record for many changes of the same kind, with a single executemany instead of one INSERT per change
+    # changes is a list of (entity_id, name, data)
+    @classmethod
+    def record_many(cls, entity, op, changes, session=None):
+        if session is None:
+            session = db.session
+        now = datetime.utcnow()
+        session.bulk_insert_mappings(cls, [{'entity': entity, 'op': op, 'entity_id': entity_id, 'name': name,
+                                            'data': json.dumps(data) if data is not None else None, 'created_at': now}
+                                           for entity_id, name, data in changes])
+
+    # The lowest and highest seq still in the log, (None, None) while it is empty
+    @classmethod
+    def bounds(cls):
+        return db.session.query(*cls._bounds_columns()).one()
+
+    @classmethod
+    async def bounds_async(cls, session):
+        return (await session.execute(select(*cls._bounds_columns()))).one()
+
+    @staticmethod
+    def _bounds_columns():
+        return db.func.min(ChangeModel.seq), db.func.max(ChangeModel.seq)
+
+    # Raises ChangesCompacted if some of the changes after since have been deleted by compact()
+    @staticmethod
+    def check_since(since, oldest, latest):
+        if oldest is not None and since < oldest - 1:
+            raise ChangesCompacted(latest)
+
+    # Returns up to limit changes with a seq greater than since, oldest first, and the latest seq of the log
+    @classmethod
+    def find_since(cls, since, limit):
+        oldest, latest = cls.bounds()
+        cls.check_since(since, oldest, latest)
+        return cls.after(since, limit), latest or 0
+
+    # Same as find_since on an AsyncSession
+    @classmethod
+    async def find_since_async(cls, session, since, limit):
+        oldest, latest = await cls.bounds_async(session)
+        cls.check_since(since, oldest, latest)
+        query = select(ChangeModel).filter(ChangeModel.seq > since).order_by(ChangeModel.seq).limit(limit)
+        return (await session.execute(query)).scalars().all(), latest or 0
+
+    # SELECT * FROM changes WHERE seq > since ORDER BY seq LIMIT limit, which walks the primary key
+    @classmethod
+    def after(cls, since, limit):
+        return ChangeModel.query.filter(ChangeModel.seq > since).order_by(ChangeModel.seq).limit(limit).all()
+
+    # Deletes the changes written before the given time, except the latest one, which is how we tell a client
+    # that is too far behind (see check_since) from one that is up to date. Returns how many were deleted
+    @classmethod
+    def compact(cls, before):
+        latest = db.session.query(db.func.max(ChangeModel.seq)).scalar()
+        if latest is None:
+            return 0
+        deleted = ChangeModel.query.filter(ChangeModel.created_at < before, ChangeModel.seq < latest).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
@@ -1,54 +1,537 @@
-# Import the SQLAlchemy object from our db.py file
-from db import db 
-
-# Inherit from db which is an object of type SQLAlchemy
-# This creates the mapping between the database and the objects
-class ItemModel(db.Model):
-    # The table name in SQLAlchemy where the model should be stored
-    __tablename__ = 'items'
-    # The columns we want our table to contain
-    id = db.Column(db.Integer, primary_key=True) # Unique index
-    name = db.Column(db.String(80)) # Maximum length of the string
-    price = db.Column(db.Float(precision=2)) # The number of numbers after a decimal
-    store_id = db.Column(db.Integer, db.ForeginKey('stores.id')) # Create a foreign key to the StoreModel's id using table_name.column_name
-    # This relationship creates a new store property within the ItemModel using the store_id foreign key
-    store = db.relationship('StoreModel')
-
-    # These properties must match the SQLAlchemy column names for them to be saved to the database
-    # We can have additional properties, they just won't be saved
-    def __init__(self, name, price, store_id):
-        self.name = name
-        self.price = price
-        self.store_id = store_id
-    
-    # Returns a JSON representation of the model
-    def json(self):
-        return {'id': self.id, 'name': self.name, 'price': self.price, 'store_id': self.store_id}
-    
-    # This is a class method because it will return an object of type ItemModel
-    @classmethod
-    def find_by_name(cls, name):
-        # the query-builder method comes from the SQLAlchemy class we've inherited from
-        # We are querying the Model / Table and filtering by the name column
-        # Returns an ItemModel object with self.name and self.price
-        return ItemModel.query.filter_by(name=name).first() # SELECT * from items WHERE name=name LIMIT 1
-    
-    # Returns all items and their properties from the database
-    @classmethod
-    def find_all(cls):
-        return ItemModel.query.find_all()
-    
-    # Saving the Model to the Database
-    # When we retrieve an object with a particular id, we can change its name, add it to the session and commit it
-    # and SQLAlchemy will do an UPDATE instead of an INSERT. So this method can do both an insert or an update (upserting)
-    def save_to_db(self):
-        # SQLAlchemy can translate from an object to a row
-        # A session is a collection of object that we're going to write to the database. We can write multiple objects if we wanted
-        db.session.add(self)
-        # save the changes
-        db.session.commit()
-
-    # Delete an item from the database and save the changes
-    def delete_from_db(self):
-        db.session.delete(self)
-        db.session.commit()
\ No newline at end of file
+# Import the SQLAlchemy object from our db.py file
+import heapq
+import itertools
+from datetime import datetime
+from sqlalchemy import inspect, select, bindparam, text as sql_text
+from db import db, chunks, timestamp
+from cache import cache
+from schemas import item_response
+from models.change import ChangeModel
+from writebehind import write_queue
+from shards import shards
+
+# Inherit from db which is an object of type SQLAlchemy
+# This creates the mapping between the database and the objects
+class ItemModel(db.Model):
+    # The table name in SQLAlchemy where the model should be stored
+    __tablename__ = 'items'
+    # Filtering a store's items by price (or sorting them by price) uses this index instead of the two separate ones
+    __table_args__ = (db.Index('ix_items_store_id_price', 'store_id', 'price'),)
+    # The columns /items can be sorted by. A leading - sorts in descending order
+    SORT_KEYS = ('id', 'name', 'price', '-id', '-name', '-price')
+    # The columns we want our table to contain
+    id = db.Column(db.Integer, primary_key=True) # Unique index
+    name = db.Column(db.String(80), unique=True, index=True) # Maximum length of the string. Indexed because we look items up by name
+    price = db.Column(db.Float(precision=2), index=True) # The number of numbers after a decimal. Indexed for the price filters of /items
+    store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), index=True) # Create a foreign key to the StoreModel's id using table_name.column_name
+    # This relationship creates a new store property within the ItemModel using the store_id foreign key
+    store = db.relationship('StoreModel')
+    # Bumped by every save, these are the ETag and Last-Modified of the item (see conditional.py)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # The number of the write-behind update whose price this object shows (see writebehind.py). Not a column
+    pending = None
+    # The shard the object was loaded from in the sharded mode (see shards.py). Not a column
+    shard = None
+
+    # These properties must match the SQLAlchemy column names for them to be saved to the database
+    # We can have additional properties, they just won't be saved
+    def __init__(self, name, price, store_id):
+        self.name = name
+        self.price = price
+        self.store_id = store_id
+    
+    # Returns a JSON representation of the model
+    def json(self):
+        return item_response.dump(self)
+    
+    # This is a class method because it will return an object of type ItemModel
+    @classmethod
+    def find_by_name(cls, name):
+        # the query-builder method comes from the SQLAlchemy class we've inherited from
+        # We are querying the Model / Table and filtering by the name column
+        # Returns an ItemModel object with self.name and self.price
+        if shards.enabled:
+            # The name says nothing about the store, so every shard is asked at the same time
+            found = [item for item in shards.scatter(lambda session, shard: session.query(ItemModel).filter_by(name=name).first()) if item]
+            return write_queue.overlay(found[0] if found else None)
+        item = ItemModel.query.filter_by(name=name).first() # SELECT * from items WHERE name=name LIMIT 1
+        # A price update still waiting in the write-behind queue is what the item is worth now
+        return write_queue.overlay(item)
+
+    # Same as find_by_name on an AsyncSession, for the async serving mode (see aio.py)
+    @classmethod
+    async def find_by_name_async(cls, session, name):
+        result = await session.execute(select(ItemModel).filter_by(name=name).limit(1))
+        return write_queue.overlay(result.scalars().first())
+    
+    # Looks many items up at once with SELECT * from items WHERE name IN (...), split into chunks for SQLite's parameter limit
+    # Returns a dictionary of name -> ItemModel, names that do not exist are left out
+    @classmethod
+    def find_many_by_name(cls, names):
+        if shards.enabled:
+            return {item.name: write_queue.overlay(item) for item in cls._find_many_sharded(ItemModel.name, set(names))}
+        items = {}
+        for chunk in chunks(list(set(names))):
+            for item in ItemModel.query.filter(ItemModel.name.in_(chunk)):
+                items[item.name] = write_queue.overlay(item)
+        return items
+
+    # Same as find_many_by_name but by id. Returns a dictionary of id -> ItemModel
+    @classmethod
+    def find_many_by_id(cls, ids):
+        if shards.enabled:
+            return {item.id: write_queue.overlay(item) for item in cls._find_many_sharded(ItemModel.id, set(ids))}
+        items = {}
+        for chunk in chunks(list(set(ids))):
+            for item in ItemModel.query.filter(ItemModel.id.in_(chunk)):
+                items[item.id] = write_queue.overlay(item)
+        return items
+
+    # The IN (...) lookups of find_many_by_name and find_many_by_id in the sharded mode: every shard runs them, the
+    # results are put together
+    @staticmethod
+    def _find_many_sharded(column, values):
+        def find(session, shard):
+            return [item for chunk in chunks(list(values)) for item in session.query(ItemModel).filter(column.in_(chunk))]
+        return [item for items in shards.scatter(find) for item in items]
+
+    # Cheap aggregates that change whenever an item is created, updated or deleted, used to build the ETag of /items
+    # Returns the number of items, the sum of their versions, the newest update time and the highest id
+    @classmethod
+    def collection_version(cls):
+        if shards.enabled:
+            # The aggregates of every shard, put together: the counts and versions add up, the newest time and highest id win
+            results = shards.scatter(lambda session, shard: session.query(*cls.collection_aggregates()).one())
+            versions, times, ids = ([row[n] for row in results if row[n] is not None] for n in (1, 2, 3))
+            return (sum(row[0] for row in results), sum(versions) if versions else None,
+                    max(times) if times else None, max(ids) if ids else None)
+        return db.session.query(*cls.collection_aggregates()).one()
+
+    # Same as collection_version on an AsyncSession
+    @classmethod
+    async def collection_version_async(cls, session):
+        return (await session.execute(select(*cls.collection_aggregates()))).one()
+
+    # The aggregate columns themselves, shared by the sync and async versions
+    @staticmethod
+    def collection_aggregates():
+        return (db.func.count(ItemModel.id), db.func.sum(ItemModel.version), db.func.max(ItemModel.updated_at), db.func.max(ItemModel.id))
+
+    # The key under which the JSON of an item is cached
+    @staticmethod
+    def cache_key(name):
+        return f'item:{name}'
+
+    # What we keep in the cache for a item: its JSON plus its ETag and Last-Modified (in seconds since the epoch),
+    # so a conditional GET can be answered from the cache as well
+    # An item that shows a queued price has not got its new version yet, so the number of the update goes in the ETag
+    def cache_entry(self):
+        etag = f'item-{self.id}-{self.version}' + (f'-q{self.pending}' if self.pending else '')
+        return {'json': self.json(), 'etag': etag, 'updated_at': timestamp(self.updated_at)}
+
+    # Same as find_by_name but returns the cache entry of the item (see cache_entry), served from the cache when possible
+    # Returns None if the item does not exist
+    @classmethod
+    def find_cached_by_name(cls, name):
+        def load():
+            item = cls.find_by_name(name)
+            return item.cache_entry() if item else None
+        return cache.get_or_load(cls.cache_key(name), load)
+
+    # Same as find_cached_by_name on an AsyncSession
+    @classmethod
+    async def find_cached_by_name_async(cls, session, name):
+        async def load():
+            item = await cls.find_by_name_async(session, name)
+            return item.cache_entry() if item else None
+        return await cache.get_or_load_async(cls.cache_key(name), load)
+
+    # Same as find_cached_by_name for many names. The names missing from the cache are loaded with find_many_by_name
+    # Returns a dictionary of name -> cache entry, names that do not exist are left out
+    @classmethod
+    def find_cached_many_by_name(cls, names):
+        keys = {cls.cache_key(name): name for name in names}
+
+        def load(missing):
+            items = cls.find_many_by_name([keys[key] for key in missing])
+            return {cls.cache_key(name): item.cache_entry() for name, item in items.items()}
+        entries = cache.get_or_load_many(list(keys), load)
+        return {keys[key]: entry for key, entry in entries.items()}
+
+    # Same as find_by_name but returns the JSON of the item, served from the cache when possible
+    # Returns None if the item does not exist
+    @classmethod
+    def find_json_by_name(cls, name):
+        entry = cls.find_cached_by_name(name)
+        return entry['json'] if entry else None
+
+    # The cache keys that go stale when this item changes: the item itself and the store it belongs to,
+    # because the cached JSON of a store contains all of its items
+    def cache_keys(self):
+        keys = [ItemModel.cache_key(self.name)]
+        if shards.enabled:
+            # The item was loaded from a shard, its store is in the primary database
+            from models.store import StoreModel
+            store = StoreModel.query.get(self.store_id) if self.store_id is not None else None
+        else:
+            store = self.store
+        if store:
+            keys.append(store.cache_key(store.name))
+        return keys
+
+    # Returns all items and their properties from the database
+    @classmethod
+    def find_all(cls):
+        if shards.enabled:
+            return sorted((item for items in shards.scatter(lambda session, shard: session.query(ItemModel).all()) for item in items),
+                          key=lambda item: item.id)
+        return ItemModel.query.all()
+
+    # Returns up to limit items with an id greater than cursor, ordered by id (keyset pagination)
+    # Unlike OFFSET, the database can jump straight to the cursor using the primary key, so every page costs the same
+    @classmethod
+    def find_page(cls, limit, cursor=None):
+        if shards.enabled:
+            return cls.search(limit, cursor)
+        query = ItemModel.query.order_by(ItemModel.id)
+        if cursor is not None:
+            query = query.filter(ItemModel.id > cursor) # SELECT * from items WHERE id > cursor ORDER BY id LIMIT limit
+        return query.limit(limit).all()
+
+    # Returns up to limit items matching the filters, sorted by sort (one of SORT_KEYS) and then by id
+    # store_id, min_price and max_price use the store_id and price indexes, prefix uses the name index and
+    # text is a full-text search on the name that uses the items_fts index (see migrations.py)
+    # With the default sort the cursor is the id of the last item seen, otherwise it is [sort value, id] (see cursor_for)
+    @classmethod
+    def search(cls, limit, cursor=None, sort='id', **filters):
+        if shards.enabled:
+            # Every shard returns its own first page, already sorted, and the pages are merged into one
+            # The first limit items of the merge are the first limit items overall, since no shard can have more of them
+            # The items of a store are all in its shard, so a search within a store only asks that one
+            store_id = filters.get('store_id')
+            pages = shards.scatter(lambda session, shard: cls.search_query(session.query(ItemModel), cursor, sort, **filters).limit(limit).all(),
+                                   None if store_id is None else [shards.shard_for(store_id)])
+            key = sort.lstrip('-')
+            # NULL sorts before any value in SQL, the False puts it first here as well
+            merged = heapq.merge(*pages, key=lambda item: (getattr(item, key) is not None, getattr(item, key), item.id),
+                                 reverse=sort.startswith('-'))
+            return list(itertools.islice(merged, limit))
+        return cls.search_query(ItemModel.query, cursor, sort, **filters).limit(limit).all()
+
+    # Same as search on an AsyncSession
+    @classmethod
+    async def search_async(cls, session, limit, cursor=None, sort='id', **filters):
+        result = await session.execute(cls.search_query(select(ItemModel), cursor, sort, **filters).limit(limit))
+        return result.scalars().all()
+
+    # Adds the filters, the cursor and the sort of search() to query, which is either ItemModel.query or select(ItemModel)
+    @classmethod
+    def search_query(cls, query, cursor=None, sort='id', store_id=None, min_price=None, max_price=None, prefix=None, text=None):
+        if store_id is not None:
+            query = query.filter(ItemModel.store_id == store_id)
+        if min_price is not None:
+            query = query.filter(ItemModel.price >= min_price)
+        if max_price is not None:
+            query = query.filter(ItemModel.price <= max_price)
+        if prefix:
+            # name >= 'abc' AND name < 'abc\U0010ffff' is a range the name index can answer, unlike LIKE 'abc%'
+            query = query.filter(ItemModel.name >= prefix, ItemModel.name < prefix + '\U0010ffff')
+        if text:
+            query = query.filter(cls._text_filter(text))
+
+        column = getattr(ItemModel, sort.lstrip('-'))
+        descending = sort.startswith('-')
+        if cursor is not None:
+            # Keyset pagination: continue right after the (sort value, id) of the last item of the previous page
+            if column is ItemModel.id:
+                query = query.filter(ItemModel.id < cursor if descending else ItemModel.id > cursor)
+            else:
+                value, last_id = cursor
+                if descending:
+                    query = query.filter(db.or_(column < value, db.and_(column == value, ItemModel.id < last_id)))
+                else:
+                    query = query.filter(db.or_(column > value, db.and_(column == value, ItemModel.id > last_id)))
+        if descending:
+            query = query.order_by(column.desc(), ItemModel.id.desc())
+        else:
+            query = query.order_by(column, ItemModel.id)
+        return query
+
+    # Returns the cursor that continues a search sorted by sort right after this item
+    def cursor_for(self, sort):
+        key = sort.lstrip('-')
+        return self.id if key == 'id' else [getattr(self, key), self.id]
+
+    # Whether the database has the items_fts full-text index. Checked once per process
+    _has_fts = None
+
+    # Full-text match on the name. Every word of text has to appear in the name, in any order
+    @classmethod
+    def _text_filter(cls, text):
+        if cls._has_fts is None:
+            # The shards all have the same schema, so the first one speaks for them
+            cls._has_fts = 'items_fts' in inspect(shards.engines[0] if shards.enabled else db.engine).get_table_names()
+        words = text.split()
+        if not cls._has_fts:
+            # Without FTS5 we can only scan the names
+            return db.and_(*[ItemModel.name.ilike(f'%{word}%') for word in words])
+        # Quoting every word stops FTS5 from reading characters like * or - in the search as operators
+        match = ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+        return sql_text('items.id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH :match)').bindparams(match=match)
+
+    # Generator that walks the whole table one page at a time, so we never hold every item in memory at once
+    # sort and filters are the same arguments as search() takes, and so is the cursor
+    @classmethod
+    def iter_batches(cls, batch_size, cursor=None, sort='id', **filters):
+        while True:
+            batch = cls.search(batch_size, cursor, sort, **filters)
+            if batch:
+                yield batch
+            # A short page means we have reached the end of the table
+            if len(batch) < batch_size:
+                return
+            cursor = batch[-1].cursor_for(sort)
+    
+    # Saving the Model to the Database
+    # When we retrieve an object with a particular id, we can change its name, add it to the session and commit it
+    # and SQLAlchemy will do an UPDATE instead of an INSERT. So this method can do both an insert or an update (upserting)
+    # session defaults to Flask-SQLAlchemy's session. The async resources pass in the session of their AsyncSession (see aio.py)
+    def save_to_db(self, session=None):
+        # Imported here because models/store.py imports this file
+        from models.store import StoreModel
+
+        if shards.enabled:
+            self._save_sharded()
+            return
+        if session is None:
+            session = db.session
+
+        # A new item starts at version 1. Otherwise version + 1 is done by the database, so concurrent saves never lose a bump
+        now = datetime.utcnow()
+        store_ids = [self.store_id]
+        if self.id is not None:
+            # The old price (and store) of the item leave the aggregates of its store before the new ones are added
+            store_ids += StoreModel.remove_items([self.id], session)
+        self.version = 1 if self.id is None else ItemModel.version + 1
+        self.updated_at = now
+        # SQLAlchemy can translate from an object to a row
+        # A session is a collection of object that we're going to write to the database. We can write multiple objects if we wanted
+        session.add(self)
+        session.flush()
+        # The JSON of the store contains its items, so the store gets a new version (and new aggregates) in the same transaction
+        StoreModel.touch(store_ids, now, session, added=[(self.store_id, self.price)])
+        # Written by the same commit, so the change log never disagrees with the table (see models/change.py)
+        ChangeModel.record('item', 'upsert', self.id, self.name, self.json(), session)
+        # save the changes
+        session.commit()
+        # Remove the old copies of this item (and of its store) from the cache
+        cache.delete(*self.cache_keys())
+
+    # Inserts or updates many items at once. rows is a list of dictionaries with a name, price and store_id
+    # Instead of one commit per item, rows are written batch_size at a time with one transaction per batch
+    # If the same name appears more than once, the last row wins. Returns the number of created and updated items
+    # With update_only, rows whose item does not exist (any more) are skipped and the items stay in their store,
+    # so the rows only need a name and a price. This is how the write-behind queue flushes (see writebehind.py)
+    @classmethod
+    def bulk_upsert(cls, rows, batch_size=5000, update_only=False):
+        # Imported here because models/store.py imports this file
+        from models.store import StoreModel
+
+        # Keep only the last row for every name
+        rows = list({row['name']: row for row in rows}.values())
+        if shards.enabled:
+            return cls._bulk_upsert_sharded(rows, batch_size, update_only)
+        created = updated = 0
+        for batch in chunks(rows, batch_size):
+            names = [row['name'] for row in batch]
+            # Find which of the names already exist: SELECT id, name, store_id from items WHERE name IN (...)
+            existing = {}
+            for chunk in chunks(names):
+                query = db.session.query(ItemModel.id, ItemModel.name, ItemModel.version, ItemModel.store_id).filter(ItemModel.name.in_(chunk))
+                for _id, name, version, store_id in query:
+                    existing[name] = (_id, version, store_id)
+            if update_only:
+                batch = [dict(row, store_id=existing[row['name']][2]) for row in batch if row['name'] in existing]
+            # An item can move to another store, so the stores it used to belong to go stale as well
+            # The items being updated leave the aggregates of those stores before their new rows are added back
+            store_ids = {row['store_id'] for row in batch}
+            store_ids.update(StoreModel.remove_items([_id for _id, _, _ in existing.values()]))
+
+            now = datetime.utcnow()
+            inserts = [dict(row, version=1, updated_at=now) for row in batch if row['name'] not in existing]
+            updates = [dict(row, id=existing[row['name']][0], version=existing[row['name']][1] + 1, updated_at=now)
+                       for row in batch if row['name'] in existing]
+            # The bulk_*_mappings methods skip most of the per-object work the ORM does in save_to_db
+            db.session.bulk_insert_mappings(ItemModel, inserts)
+            db.session.bulk_update_mappings(ItemModel, updates)
+            StoreModel.touch(list(store_ids), now, added=[(row['store_id'], row['price']) for row in batch])
+            # The change log needs the ids of the new items, which the bulk insert does not give us back
+            ids = {name: _id for name, (_id, _, _) in existing.items()}
+            for chunk in chunks([row['name'] for row in inserts]):
+                ids.update({name: _id for name, _id in db.session.query(ItemModel.name, ItemModel.id).filter(ItemModel.name.in_(chunk))})
+            ChangeModel.record_many('item', 'upsert', [(ids[row['name']], row['name'], {'id': ids[row['name']], 'name': row['name'],
+                                                        'price': row['price'], 'store_id': row['store_id']}) for row in batch])
+            db.session.commit()
+            created += len(inserts)
+            updated += len(updates)
+
+            # Remove the stale copies of the items and of the stores they belong to from the cache
+            keys = [ItemModel.cache_key(name) for name in names]
+            for chunk in chunks(list(store_ids)):
+                keys += [StoreModel.cache_key(name) for (name,) in db.session.query(StoreModel.name).filter(StoreModel.id.in_(chunk))]
+            cache.delete(*keys)
+        return created, updated
+
+    # Delete an item from the database and save the changes
+    def delete_from_db(self, session=None):
+        # Imported here because models/store.py imports this file
+        from models.store import StoreModel
+
+        if shards.enabled:
+            ItemModel._write_sharded([], {}, deletes=[(self.id, self.shard, self.name)])
+            return
+        if session is None:
+            session = db.session
+        # Work out the cache keys before the item is gone, then remove them once the delete is committed
+        keys = self.cache_keys()
+        store_ids = StoreModel.remove_items([self.id], session)
+        session.delete(self)
+        session.flush()
+        # The store loses an item, so it gets a new version and its min and max prices are read again
+        StoreModel.touch(store_ids, datetime.utcnow(), session)
+        ChangeModel.record('item', 'delete', self.id, self.name, session=session)
+        session.commit()
+        cache.delete(*keys)
+
+    # save_to_db in the sharded mode. The object is not in any session, its new id, version and shard are set on it
+    def _save_sharded(self):
+        existing = {} if self.id is None else {self.name: (self.id, self.shard, self.version)}
+        for row in ItemModel._write_sharded([{'name': self.name, 'price': self.price, 'store_id': self.store_id}], existing):
+            self.id, self.shard, self.version, self.updated_at = row['id'], row['shard'], row['version'], row['updated_at']
+
+    # bulk_upsert in the sharded mode, rows have one row per name already
+    @classmethod
+    def _bulk_upsert_sharded(cls, rows, batch_size, update_only):
+        created = updated = 0
+        for batch in chunks(rows, batch_size):
+            names = [row['name'] for row in batch]
+
+            # name -> (id, shard, version, store_id) of the names that already exist, from every shard
+            def find(session, shard):
+                query = session.query(ItemModel.id, ItemModel.name, ItemModel.version, ItemModel.store_id)
+                return [(name, (_id, shard, version, store_id)) for chunk in chunks(names)
+                        for _id, name, version, store_id in query.filter(ItemModel.name.in_(chunk))]
+            existing = dict(found for results in shards.scatter(find) for found in results)
+            if update_only:
+                batch = [dict(row, store_id=existing[row['name']][3]) for row in batch if row['name'] in existing]
+            cls._write_sharded(batch, existing)
+            inserted = sum(1 for row in batch if row['name'] not in existing)
+            created += inserted
+            updated += len(batch) - inserted
+        return created, updated
+
+    # Every write of the sharded mode goes through here. rows are the items to insert or update, with a name, price
+    # and store_id, existing is name -> (id, shard, version, ...) of the ones that exist and deletes is a list of
+    # (id, shard, name) of the items to delete. Returns the rows that were written, with their id, shard, version
+    # and updated_at
+    # The items go to the shard of their store, an item whose store is in another shard moves there with its id
+    # Every shard writes its part in a transaction of its own, at the same time, and reads the new min and max prices
+    # of the stores it touched. Then the aggregates of the stores and the change log are written to the primary
+    # database. The shards and the primary database do not commit together: if the process dies in between, the
+    # items are written but the aggregates are not, and `python shards.py recount` puts them right
+    @classmethod
+    def _write_sharded(cls, rows, existing, deletes=()):
+        # Imported here because models/store.py imports this file
+        from models.store import StoreModel
+
+        now = datetime.utcnow()
+        placement = shards.placement([row['store_id'] for row in rows])
+        ids = iter(shards.next_ids(sum(1 for row in rows if row['name'] not in existing)))
+        plans = {}
+
+        def plan(shard):
+            return plans.setdefault(shard, {'insert': [], 'update': [], 'delete': [], 'stores': set()})
+        for row in rows:
+            if row['name'] in existing:
+                item_id, source, version = existing[row['name']][:3]
+            else:
+                item_id, source, version = next(ids), None, 0
+            # An item without a store stays where it is, a new one goes to the first shard
+            target = placement.get(row['store_id'], 0 if source is None else source)
+            plan(target)['stores'].add(row['store_id'])
+            if source == target:
+                plan(target)['update'].append(dict(row, id=item_id))
+            else:
+                if source is not None:
+                    plan(source)['delete'].append(item_id)
+                plan(target)['insert'].append(dict(row, id=item_id, version=version + 1, updated_at=now))
+        for item_id, shard, _ in deletes:
+            plan(shard)['delete'].append(item_id)
+
+        def write(session, shard):
+            work, items = plans[shard], cls.__table__
+            # id -> (store_id, price, version) of the rows that are updated or deleted, before the change
+            old = {}
+            for chunk in chunks([row['id'] for row in work['update']] + work['delete']):
+                # The UPDATE comes first, so the rows we read are locked from there on. It also gives them their new
+                # version, which the updated rows keep
+                session.execute(items.update().where(items.c.id.in_(chunk)).values(version=items.c.version + 1, updated_at=now))
+                for item_id, store_id, price, version in session.execute(
+                        select(items.c.id, items.c.store_id, items.c.price, items.c.version).where(items.c.id.in_(chunk))):
+                    old[item_id] = (store_id, price, version)
+            # An item deleted in the meantime is not written again
+            updates = [row for row in work['update'] if row['id'] in old]
+            if updates:
+                session.execute(items.update().where(items.c.id == bindparam('_id')),
+                                [{'_id': row['id'], 'name': row['name'], 'price': row['price'], 'store_id': row['store_id']}
+                                 for row in updates])
+            for chunk in chunks(work['delete']):
+                session.execute(items.delete().where(items.c.id.in_(chunk)))
+            if work['insert']:
+                session.execute(items.insert(), [{column: row[column] for column in ('id', 'name', 'price', 'store_id', 'version', 'updated_at')}
+                                                 for row in work['insert']])
+            # SELECT store_id, min(price), max(price) FROM items WHERE store_id IN (...) GROUP BY store_id
+            stores = [store_id for store_id in work['stores'] | {store_id for store_id, _, _ in old.values()} if store_id is not None]
+            bounds = {store_id: (None, None) for store_id in stores}
+            for chunk in chunks(stores):
+                for store_id, low, high in session.execute(select(items.c.store_id, db.func.min(items.c.price), db.func.max(items.c.price))
+                                                           .where(items.c.store_id.in_(chunk)).group_by(items.c.store_id)):
+                    bounds[store_id] = (low, high)
+            session.commit()
+            written = [dict(row, shard=shard, version=old[row['id']][2], updated_at=now) for row in updates]
+            written += [dict(row, shard=shard) for row in work['insert']]
+            return old, bounds, written
+
+        results = shards.scatter(write, list(plans))
+
+        # The old rows leave the aggregates of their stores and the new ones are added
+        deltas, bounds, written = {}, {}, []
+        for old, shard_bounds, shard_written in results:
+            bounds.update(shard_bounds)
+            written += shard_written
+            for store_id, price, _ in old.values():
+                if store_id is not None:
+                    delta = deltas.setdefault(store_id, [0, 0])
+                    delta[0] -= 1
+                    delta[1] -= price or 0
+        for row in written:
+            if row['store_id'] is not None:
+                delta = deltas.setdefault(row['store_id'], [0, 0])
+                delta[0] += 1
+                delta[1] += row['price'] or 0
+        StoreModel.apply_aggregates(deltas, bounds, now)
+        ChangeModel.record_many('item', 'upsert', [(row['id'], row['name'], {'id': row['id'], 'name': row['name'], 'price': row['price'],
+                                                                              'store_id': row['store_id']}) for row in written])
+        deleted = {item_id for old, _, _ in results for item_id in old}
+        for item_id, _, name in deletes:
+            if item_id in deleted:
+                ChangeModel.record('item', 'delete', item_id, name)
+        db.session.commit()
+
+        # Remove the stale copies of the items and of their stores from the cache
+        keys = [ItemModel.cache_key(row['name']) for row in rows] + [ItemModel.cache_key(name) for _, _, name in deletes]
+        for chunk in chunks(list(bounds)):
+            keys += [StoreModel.cache_key(name) for (name,) in db.session.query(StoreModel.name).filter(StoreModel.id.in_(chunk))]
+        cache.delete(*keys)
+        return written
@@ -1,55 +1,395 @@
-# Import the SQLAlchemy object from our db.py file
-from db import db 
-
-# Inherit from db which is an object of type SQLAlchemy
-# This creates the mapping between the database and the objects
-class StoreModel(db.Model):
-    # The table name in SQLAlchemy where the model should be stored
-    __tablename__ = 'stores'
-    # The columns we want our table to contain
-    id = db.Column(db.Integer, primary_key=True) # Unique index
-    name = db.Column(db.String(80)) # Maximum length of the string
-    # Checks for the relationship between between the StoreModel and ItemModel 
-    # So SQLAlchemy goes to the ItemModel and sees the store_id foreign-key as well as the single store property
-    # and create a many-to-one relationship between the ItemModel and the StoreModel
-    # Therefore, the items property below is a list of items
-    # When we use lazy='dynamic', self.items is no longer a list of items, 
-    # but instead a querybuilder that we can use .all() to retrieve all of the items
-    items = db.relationship('ItemModel', lazy='dynamic')
-
-    # These properties must match the SQLAlchemy column names for them to be saved to the database
-    # We can have additional properties, they just won't be saved
-    def __init__(self, name):
-        self.name = name
-    
-    # Returns a JSON representation of the model
-    def json(self):
-        return {'id': self.id, 'name': self.name, 'items': [item.json() for item in self.items.all()]}
-    
-    # This is a class method because it will return an object of type StoreModel
-    @classmethod
-    def find_by_name(cls, name):
-        # the query-builder method comes from the SQLAlchemy class we've inherited from
-        # We are querying the Model / Table and filtering by the name column
-        # Returns a StoreModel object 
-        return StoreModel.query.filter_by(name=name).first() # SELECT * from stores WHERE name=name LIMIT 1
-    
-    # Returns all stores and their properties from the database
-    @classmethod
-    def find_all(cls):
-        return StoreModel.query.find_all()
-    
-    # Saving the Model to the Database
-    # When we retrieve an object with a particular id, we can change its name, add it to the session and commit it
-    # and SQLAlchemy will do an UPDATE instead of an INSERT. So this method can do both an insert or an update (upserting)
-    def save_to_db(self):
-        # SQLAlchemy can translate from an object to a row
-        # A session is a collection of object that we're going to write to the database. We can write multiple objects if we wanted
-        db.session.add(self)
-        # save the changes
-        db.session.commit()
-
-    # Delete a store from the database and save the changes
-    def delete_from_db(self):
-        db.session.delete(self)
-        db.session.commit()
\ No newline at end of file
+# Import the SQLAlchemy object from our db.py file
+from datetime import datetime
+from sqlalchemy import select, bindparam
+from db import db, chunks, timestamp
+from cache import cache
+from models.item import ItemModel
+from models.change import ChangeModel
+from schemas import item_response
+from shards import shards
+
+# Inherit from db which is an object of type SQLAlchemy
+# This creates the mapping between the database and the objects
+class StoreModel(db.Model):
+    # The table name in SQLAlchemy where the model should be stored
+    __tablename__ = 'stores'
+    # The columns we want our table to contain
+    id = db.Column(db.Integer, primary_key=True) # Unique index
+    name = db.Column(db.String(80), unique=True, index=True) # Maximum length of the string. Indexed because we look stores up by name
+    # Checks for the relationship between between the StoreModel and ItemModel 
+    # So SQLAlchemy goes to the ItemModel and sees the store_id foreign-key as well as the single store property
+    # and create a many-to-one relationship between the ItemModel and the StoreModel
+    # Therefore, the items property below is a list of items
+    # When we use lazy='dynamic', self.items is no longer a list of items, 
+    # but instead a querybuilder that we can use .all() to retrieve all of the items
+    items = db.relationship('ItemModel', lazy='dynamic')
+    # Bumped when the store or one of its items changes, these are the ETag and Last-Modified of the store
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Aggregates of the items of the store, kept up to date by every write to the items (see touch and remove_items)
+    # so a summary of the store never has to read its items. The average price is price_sum / item_count
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    price_sum = db.Column(db.Float, nullable=False, default=0)
+    min_price = db.Column(db.Float)
+    max_price = db.Column(db.Float)
+    # The shard that holds the items of the store in the sharded mode (see shards.py), NULL otherwise
+    shard = db.Column(db.Integer)
+
+    # These properties must match the SQLAlchemy column names for them to be saved to the database
+    # We can have additional properties, they just won't be saved
+    def __init__(self, name):
+        self.name = name
+    
+    # Returns a JSON representation of the model
+    # items can be passed in when they have already been loaded (see load_items), otherwise we query them here
+    def json(self, items=None):
+        if items is None:
+            items = self.item_list()
+        return {'id': self.id, 'name': self.name, 'items': item_response.dump_many(items)}
+
+    # Returns the summary of the store: the precomputed aggregates of its items instead of the items themselves,
+    # so it costs the same whether the store has 10 items or 100000. items are added when they are passed in
+    def summary(self, items=None):
+        summary = {'id': self.id, 'name': self.name, 'item_count': self.item_count, 'min_price': self.min_price,
+                   'max_price': self.max_price, 'avg_price': self.price_sum / self.item_count if self.item_count else None,
+                   'updated_at': self.updated_at.isoformat() + 'Z'}
+        if items is not None:
+            summary['items'] = item_response.dump_many(items)
+        return summary
+
+    # Same as cache_entry for the summary. It is a different representation of the store, so it has an ETag of its own
+    def summary_entry(self, items=None):
+        etag = f'store-{self.id}-{self.version}-summary' + ('' if items is None else '-items')
+        return {'json': self.summary(items), 'etag': etag, 'updated_at': timestamp(self.updated_at)}
+
+    # Returns the summaries of a list of stores. With with_items, the items of all of them are loaded with one query
+    @classmethod
+    def summary_many(cls, stores, with_items=False):
+        if not with_items:
+            return [store.summary() for store in stores]
+        items = cls.load_items(stores)
+        return [store.summary(items[store.id]) for store in stores]
+
+    # The items of the store. self.items only looks in the primary database, so the sharded mode uses load_items
+    def item_list(self):
+        return self.load_items([self])[self.id] if shards.enabled else self.items.order_by(ItemModel.id).all()
+
+    # Loads the items of many stores at once instead of running self.items.all() for every store (the N+1 problem)
+    # Returns a dictionary of store id -> list of ItemModel objects
+    @classmethod
+    def load_items(cls, stores):
+        store_ids = [store.id for store in stores]
+        items = {store_id: [] for store_id in store_ids}
+        if shards.enabled:
+            # Only the shards of these stores are asked, each for its own stores
+            placement, by_shard = shards.placement(store_ids), {}
+            for store_id in store_ids:
+                by_shard.setdefault(placement[store_id], []).append(store_id)
+
+            def load(session, shard):
+                return [item for chunk in chunks(by_shard[shard])
+                        for item in session.query(ItemModel).filter(ItemModel.store_id.in_(chunk)).order_by(ItemModel.id)]
+            for loaded in shards.scatter(load, list(by_shard)):
+                for item in loaded:
+                    items[item.store_id].append(item)
+            return items
+        for chunk in chunks(store_ids):
+            # SELECT * from items WHERE store_id IN (...) ORDER BY id
+            for item in ItemModel.query.filter(ItemModel.store_id.in_(chunk)).order_by(ItemModel.id):
+                items[item.store_id].append(item)
+        return items
+
+    # Same as load_items on an AsyncSession, for the async serving mode (see aio.py)
+    @classmethod
+    async def load_items_async(cls, session, stores):
+        store_ids = [store.id for store in stores]
+        items = {store_id: [] for store_id in store_ids}
+        for chunk in chunks(store_ids):
+            result = await session.execute(select(ItemModel).filter(ItemModel.store_id.in_(chunk)).order_by(ItemModel.id))
+            for item in result.scalars():
+                items[item.store_id].append(item)
+        return items
+
+    # Returns the JSON representation of a list of stores using a single batched query for all of their items
+    @classmethod
+    def json_many(cls, stores):
+        items = cls.load_items(stores)
+        return [store.json(items[store.id]) for store in stores]
+    
+    # The key under which the JSON of a store is cached
+    @staticmethod
+    def cache_key(name):
+        return f'store:{name}'
+
+    # What we keep in the cache for a store: its JSON plus its ETag and Last-Modified (in seconds since the epoch),
+    # so a conditional GET can be answered from the cache as well
+    # items can be passed in like for json()
+    def cache_entry(self, items=None):
+        return {'json': self.json(items), 'etag': f'store-{self.id}-{self.version}', 'updated_at': timestamp(self.updated_at)}
+
+    # Same as find_by_name but returns the cache entry of the store (see cache_entry), served from the cache when possible
+    # Returns None if the store does not exist
+    @classmethod
+    def find_cached_by_name(cls, name):
+        def load():
+            store = cls.find_by_name(name)
+            return store.cache_entry() if store else None
+        return cache.get_or_load(cls.cache_key(name), load)
+
+    # Same as find_cached_by_name on an AsyncSession. The items of the store are loaded with load_items_async,
+    # because the dynamic items relationship cannot be used with an AsyncSession
+    @classmethod
+    async def find_cached_by_name_async(cls, session, name):
+        async def load():
+            store = await cls.find_by_name_async(session, name)
+            if store is None:
+                return None
+            items = await cls.load_items_async(session, [store])
+            return store.cache_entry(items[store.id])
+        return await cache.get_or_load_async(cls.cache_key(name), load)
+
+    # Same as find_cached_by_name but returns the summary entry of the store (see summary_entry). It is not cached:
+    # a summary is one row of the stores table. with_items adds the items, which are read from the database
+    @classmethod
+    def find_summary_by_name(cls, name, with_items=False):
+        store = cls.find_by_name(name)
+        if store is None:
+            return None
+        return store.summary_entry(store.item_list() if with_items else None)
+
+    # Same as find_summary_by_name on an AsyncSession
+    @classmethod
+    async def find_summary_by_name_async(cls, session, name, with_items=False):
+        store = await cls.find_by_name_async(session, name)
+        if store is None:
+            return None
+        items = (await cls.load_items_async(session, [store]))[store.id] if with_items else None
+        return store.summary_entry(items)
+
+    # Same as find_cached_by_name for many names. The stores missing from the cache are loaded with one IN query,
+    # and their items with one more (see load_items) instead of one query per store
+    # Returns a dictionary of name -> cache entry, names that do not exist are left out
+    @classmethod
+    def find_cached_many_by_name(cls, names):
+        keys = {cls.cache_key(name): name for name in names}
+
+        def load(missing):
+            stores = list(cls.find_many_by_name([keys[key] for key in missing]).values())
+            items = cls.load_items(stores)
+            return {cls.cache_key(store.name): store.cache_entry(items[store.id]) for store in stores}
+        entries = cache.get_or_load_many(list(keys), load)
+        return {keys[key]: entry for key, entry in entries.items()}
+
+    # Same as find_by_name but returns the JSON of the store, served from the cache when possible
+    # Returns None if the store does not exist
+    @classmethod
+    def find_json_by_name(cls, name):
+        entry = cls.find_cached_by_name(name)
+        return entry['json'] if entry else None
+
+    # Cheap aggregates that change whenever a store or one of its items changes, used to build the ETag of /stores
+    @classmethod
+    def collection_version(cls):
+        return db.session.query(*cls.collection_aggregates()).one()
+
+    # Same as collection_version on an AsyncSession
+    @classmethod
+    async def collection_version_async(cls, session):
+        return (await session.execute(select(*cls.collection_aggregates()))).one()
+
+    # The aggregate columns themselves, shared by the sync and async versions
+    @staticmethod
+    def collection_aggregates():
+        return (db.func.count(StoreModel.id), db.func.sum(StoreModel.version), db.func.max(StoreModel.updated_at), db.func.max(StoreModel.id))
+
+    # Gives the stores a new version, because one of their items changed, and brings their aggregates up to date
+    # added is a list of (store_id, price) of the items that were just saved to these stores: they are added to
+    # item_count and price_sum. The items they replaced must have been taken out with remove_items beforehand
+    # min_price and max_price are read again from the ix_items_store_id_price index, which is one seek each
+    # Must be called after the changes to the items are flushed. Does not commit, so the caller can do it in the
+    # same transaction as the change to the items. session is the session of that transaction
+    @classmethod
+    def touch(cls, store_ids, now, session=None, added=()):
+        if session is None:
+            session = db.session
+        deltas = {store_id: [0, 0] for store_id in store_ids if store_id is not None}
+        for store_id, price in added:
+            if store_id is not None:
+                delta = deltas.setdefault(store_id, [0, 0])
+                delta[0] += 1
+                delta[1] += price or 0
+        if not deltas:
+            return
+        # UPDATE stores SET version = version + 1, updated_at = now, item_count = item_count + ..., price_sum = price_sum + ...,
+        # min_price = (SELECT min(price) FROM items WHERE store_id = stores.id), max_price = (...) WHERE id = ...
+        # run once per store with executemany
+        stores, items = cls.__table__, ItemModel.__table__
+        prices = select(items.c.price).where(items.c.store_id == stores.c.id)
+        statement = stores.update().where(stores.c.id == bindparam('store')).values(
+            version=stores.c.version + 1, updated_at=bindparam('now'),
+            item_count=stores.c.item_count + bindparam('count'), price_sum=stores.c.price_sum + bindparam('total'),
+            min_price=prices.with_only_columns(db.func.min(items.c.price)).scalar_subquery(),
+            max_price=prices.with_only_columns(db.func.max(items.c.price)).scalar_subquery())
+        session.execute(statement, [{'store': store_id, 'now': now, 'count': count, 'total': total}
+                                    for store_id, (count, total) in deltas.items()])
+
+    # touch for the sharded mode, where the items are in another database than the stores (see ItemModel._write_sharded)
+    # deltas is store id -> [items added, price added], which can be negative, and bounds is store id -> (min price,
+    # max price) as read from the shard of the store, for every store in deltas and maybe more. Every store in
+    # bounds gets a new version
+    @classmethod
+    def apply_aggregates(cls, deltas, bounds, now, session=None):
+        if session is None:
+            session = db.session
+        if not bounds:
+            return
+        # The min and max prices are the values the shard read rather than a subquery, the items are not in this database
+        stores = cls.__table__
+        statement = stores.update().where(stores.c.id == bindparam('store')).values(
+            version=stores.c.version + 1, updated_at=bindparam('now'),
+            item_count=stores.c.item_count + bindparam('count'), price_sum=stores.c.price_sum + bindparam('total'),
+            min_price=bindparam('low'), max_price=bindparam('high'))
+        session.execute(statement, [{'store': store_id, 'now': now, 'count': deltas.get(store_id, (0, 0))[0],
+                                     'total': deltas.get(store_id, (0, 0))[1], 'low': low, 'high': high}
+                                    for store_id, (low, high) in bounds.items()])
+
+    # Takes items that are about to be updated or deleted out of the item_count and price_sum of their stores
+    # It reads their old store and price from the rows themselves, so it must run before the changes are flushed
+    # Returns the ids of those stores, which must be passed to touch once the changes are flushed
+    @classmethod
+    def remove_items(cls, item_ids, session=None):
+        if session is None:
+            session = db.session
+        stores, items = cls.__table__, ItemModel.__table__
+        store_ids = set()
+        # Core statements do not flush the session, but make sure the pending changes to the items stay pending
+        with session.no_autoflush:
+            for chunk in chunks(list(item_ids)):
+                removed = select(items.c.price).where(items.c.store_id == stores.c.id, items.c.id.in_(chunk))
+                # The UPDATE comes first, so the rows we read are locked from there on
+                session.execute(stores.update().where(stores.c.id.in_(select(items.c.store_id).where(items.c.id.in_(chunk)))).values(
+                    item_count=stores.c.item_count - removed.with_only_columns(db.func.count()).scalar_subquery(),
+                    price_sum=stores.c.price_sum - removed.with_only_columns(db.func.coalesce(db.func.sum(items.c.price), 0)).scalar_subquery()))
+                store_ids.update(store_id for (store_id,) in session.execute(select(items.c.store_id).where(items.c.id.in_(chunk))))
+        return [store_id for store_id in store_ids if store_id is not None]
+
+    # This is a class method because it will return an object of type StoreModel
+    @classmethod
+    def find_by_name(cls, name):
+        # the query-builder method comes from the SQLAlchemy class we've inherited from
+        # We are querying the Model / Table and filtering by the name column
+        # Returns a StoreModel object 
+        return StoreModel.query.filter_by(name=name).first() # SELECT * from stores WHERE name=name LIMIT 1
+
+    # Same as find_by_name on an AsyncSession
+    @classmethod
+    async def find_by_name_async(cls, session, name):
+        result = await session.execute(select(StoreModel).filter_by(name=name).limit(1))
+        return result.scalars().first()
+    
+    # Looks many stores up at once with SELECT * from stores WHERE name IN (...), split into chunks for SQLite's parameter limit
+    # Returns a dictionary of name -> StoreModel, names that do not exist are left out
+    @classmethod
+    def find_many_by_name(cls, names):
+        stores = {}
+        for chunk in chunks(list(set(names))):
+            for store in StoreModel.query.filter(StoreModel.name.in_(chunk)):
+                stores[store.name] = store
+        return stores
+
+    # Same as find_many_by_name but by id. Returns a dictionary of id -> StoreModel
+    @classmethod
+    def find_many_by_id(cls, ids):
+        stores = {}
+        for chunk in chunks(list(set(ids))):
+            for store in StoreModel.query.filter(StoreModel.id.in_(chunk)):
+                stores[store.id] = store
+        return stores
+
+    # Returns all stores and their properties from the database
+    @classmethod
+    def find_all(cls):
+        return StoreModel.query.all()
+
+    # Returns up to limit stores with an id greater than cursor, ordered by id (keyset pagination)
+    @classmethod
+    def find_page(cls, limit, cursor=None):
+        query = StoreModel.query.order_by(StoreModel.id)
+        if cursor is not None:
+            query = query.filter(StoreModel.id > cursor) # SELECT * from stores WHERE id > cursor ORDER BY id LIMIT limit
+        return query.limit(limit).all()
+
+    # Same as find_page on an AsyncSession
+    @classmethod
+    async def find_page_async(cls, session, limit, cursor=None):
+        query = select(StoreModel).order_by(StoreModel.id)
+        if cursor is not None:
+            query = query.filter(StoreModel.id > cursor)
+        return (await session.execute(query.limit(limit))).scalars().all()
+
+    # Generator that walks the whole table one page at a time, so we never hold every store in memory at once
+    @classmethod
+    def iter_batches(cls, batch_size, cursor=None):
+        while True:
+            batch = cls.find_page(batch_size, cursor)
+            if batch:
+                yield batch
+            # A short page means we have reached the end of the table
+            if len(batch) < batch_size:
+                return
+            cursor = batch[-1].id
+    
+    # Saving the Model to the Database
+    # When we retrieve an object with a particular id, we can change its name, add it to the session and commit it
+    # and SQLAlchemy will do an UPDATE instead of an INSERT. So this method can do both an insert or an update (upserting)
+    # session defaults to Flask-SQLAlchemy's session. The async resources pass in the session of their AsyncSession (see aio.py)
+    def save_to_db(self, session=None):
+        if session is None:
+            session = db.session
+        # A new store starts at version 1. Otherwise version + 1 is done by the database, so concurrent saves never lose a bump
+        self.version = 1 if self.id is None else StoreModel.version + 1
+        self.updated_at = datetime.utcnow()
+        # SQLAlchemy can translate from an object to a row
+        # A session is a collection of object that we're going to write to the database. We can write multiple objects if we wanted
+        session.add(self)
+        # A new store gets its id from the flush, and the change log needs it
+        session.flush()
+        # A new store is given its shard once it has an id, and keeps it until the offline tool moves it
+        if shards.enabled and self.shard is None:
+            self.shard = shards.place(self.id)
+        ChangeModel.record('store', 'upsert', self.id, self.name, {'id': self.id, 'name': self.name}, session)
+        # save the changes
+        session.commit()
+        cache.delete(StoreModel.cache_key(self.name))
+
+    # Delete a store from the database and save the changes
+    def delete_from_db(self, session=None):
+        if session is None:
+            session = db.session
+        # Deleting a store detaches its items, so their cached JSON (which contains the store_id) goes stale as well
+        # The items no longer belong to a store, so they get a new version. The UPDATE comes first, so the rows we
+        # read afterwards are locked and their (id, name, price) go to the change log as it is committed
+        # Their store_id is set to NULL here in both modes rather than left to the ORM, so the log and the table agree
+        now = datetime.utcnow()
+        if shards.enabled:
+            # The items stay in the shard of the store. An item without a store is looked up in every shard
+            def detach(shard_session, shard):
+                items = shard_session.query(ItemModel).filter(ItemModel.store_id == self.id)
+                items.update({ItemModel.version: ItemModel.version + 1, ItemModel.updated_at: now}, synchronize_session=False)
+                rows = items.with_entities(ItemModel.id, ItemModel.name, ItemModel.price).all()
+                items.update({ItemModel.store_id: None}, synchronize_session=False)
+                shard_session.commit()
+                return rows
+            items = shards.scatter(detach, [shards.shard_for(self.id)])[0]
+        else:
+            self.items.update({ItemModel.version: ItemModel.version + 1, ItemModel.updated_at: now}, synchronize_session=False)
+            items = self.items.with_entities(ItemModel.id, ItemModel.name, ItemModel.price).all()
+            self.items.update({ItemModel.store_id: None}, synchronize_session=False)
+        keys = [StoreModel.cache_key(self.name)] + [ItemModel.cache_key(name) for _, name, _ in items]
+        # Clients that follow the change log see the new version of every detached item, like any other item update
+        ChangeModel.record_many('item', 'upsert', [(item_id, name, {'id': item_id, 'name': name, 'price': price, 'store_id': None})
+                                                   for item_id, name, price in items], session)
+        session.delete(self)
+        ChangeModel.record('store', 'delete', self.id, self.name, session=session)
+        session.commit()
+        cache.delete(*keys)
\ No newline at end of file
@@ -1,55 +1,90 @@
-# Import the SQLAlchemy object from our db.py file
-from db import db
-
-# Inherit from db which is an object of type SQLAlchemy
-# This creates the mapping between the database and the objects
-class UserModel(db.Model):
-    # Tell SQLAlchemy the table name where these models should be stored
-    __tablename__ = 'users'
-    # Tell SQLAlchemy what columns we want our table to contain
-    id = db.Column(db.Integer, primary_key=True) # Our unique index
-    username = db.Column(db.String(80)) # Limits the size of the username
-    password = db.Column(db.String(80)) # Limits the size of the password
-
-    # These properties must match the SQLAlchemy column names for them to be saved to the database
-    # We can have additional properties, they just won't be saved
-    def __init__(self, username, password):
-        self.username = username
-        self.password = password
-
-    # JSON method for printing the contents of a user object
-    def json(self):
-        return {'id': self.id, 'username': self.username}
-
-    # Saving the Model to the Database
-    # When we retrieve an object with a particular id, we can change its name, add it to the session and commit it
-    # and SQLAlchemy will do an UPDATE instead of an INSERT. So this method can do both an insert or an update (upserting)
-    def save_to_db(self):
-        # SQLAlchemy can translate from an object to a row
-        # A session is a collection of object that we're going to write to the database. We can write multiple objects if we wanted
-        db.session.add(self)
-        # save the changes
-        db.session.commit()
-    
-    # Delete a user from the database
-    def delete_from_db(self):
-        # Delete the passed in user object
-        db.session.delete(self)
-        # Save the changes
-        db.session.commit()
-    
-    # Class method, meaning that we use cls instead of self. We are using the current class of User
-    @classmethod
-    def find_by_username(cls, username):
-        # the query-builder method comes from the SQLAlchemy class we've inherited from
-        # We are querying the Model / Table and filtering by the name column
-        # Returns a UserModel object with self.username and self.password
-        return UserModel.query.filter_by(username=username).first() # SELECT * from users WHERE name=name LIMIT 1
-    
-    # Class method, meaning that we use cls instead of self. We are using the current class of User
-    @classmethod
-    def find_by_id(cls, _id):
-        # the query-builder method comes from the SQLAlchemy class we've inherited from
-        # We are querying the Model / Table and filtering by the name column
-        # Returns a UserModel object with self.username and self.password
-        return UserModel.query.filter_by(id=_id).first() # SELECT * from users WHERE name=name LIMIT 1
\ No newline at end of file
+# Import the SQLAlchemy object from our db.py file
+from sqlalchemy import select
+from db import db
+from schemas import user_response
+
+# Inherit from db which is an object of type SQLAlchemy
+# This creates the mapping between the database and the objects
+class UserModel(db.Model):
+    # Tell SQLAlchemy the table name where these models should be stored
+    __tablename__ = 'users'
+    # Tell SQLAlchemy what columns we want our table to contain
+    id = db.Column(db.Integer, primary_key=True) # Our unique index
+    username = db.Column(db.String(80), unique=True, index=True) # Limits the size of the username. Indexed because we look users up by username
+    password = db.Column(db.String(255)) # The hash of the password (see passwords.py), hashes are longer than the passwords themselves
+    role = db.Column(db.String(20), nullable=False, default='user') # 'admin' or 'user'
+
+    # These properties must match the SQLAlchemy column names for them to be saved to the database
+    # We can have additional properties, they just won't be saved
+    def __init__(self, username, password, role='user'):
+        self.username = username
+        self.password = password
+        self.role = role
+
+    # JSON method for printing the contents of a user object
+    def json(self):
+        return user_response.dump(self)
+
+    # The claims we put in the user's tokens, so the resources can check the role without querying the database
+    def claims(self):
+        return {'is_admin': self.role == 'admin', 'role': self.role}
+
+    # Saving the Model to the Database
+    # When we retrieve an object with a particular id, we can change its name, add it to the session and commit it
+    # and SQLAlchemy will do an UPDATE instead of an INSERT. So this method can do both an insert or an update (upserting)
+    # session defaults to Flask-SQLAlchemy's session. The async resources pass in the session of their AsyncSession (see aio.py)
+    def save_to_db(self, session=None):
+        if session is None:
+            session = db.session
+        # SQLAlchemy can translate from an object to a row
+        # A session is a collection of object that we're going to write to the database. We can write multiple objects if we wanted
+        session.add(self)
+        # save the changes
+        session.commit()
+    
+    # Delete a user from the database
+    def delete_from_db(self, session=None):
+        if session is None:
+            session = db.session
+        # Delete the passed in user object
+        session.delete(self)
+        # Save the changes
+        session.commit()
+    
+    # Class method, meaning that we use cls instead of self. We are using the current class of User
+    @classmethod
+    def find_by_username(cls, username):
+        # the query-builder method comes from the SQLAlchemy class we've inherited from
+        # We are querying the Model / Table and filtering by the name column
+        # Returns a UserModel object with self.username and self.password
+        return UserModel.query.filter_by(username=username).first() # SELECT * from users WHERE name=name LIMIT 1
+
+    # Same as find_by_username on an AsyncSession, for the async serving mode (see aio.py)
+    @classmethod
+    async def find_by_username_async(cls, session, username):
+        result = await session.execute(select(UserModel).filter_by(username=username).limit(1))
+        return result.scalars().first()
+    
+    # Class method, meaning that we use cls instead of self. We are using the current class of User
+    @classmethod
+    def find_by_id(cls, _id):
+        # the query-builder method comes from the SQLAlchemy class we've inherited from
+        # We are querying the Model / Table and filtering by the name column
+        # Returns a UserModel object with self.username and self.password
+        return UserModel.query.filter_by(id=_id).first() # SELECT * from users WHERE name=name LIMIT 1
+
+    # Same as find_by_id on an AsyncSession
+    @classmethod
+    async def find_by_id_async(cls, session, _id):
+        return await session.get(UserModel, _id)
+
+    # Returns True if no user has registered yet. The first user to register becomes the admin
+    @classmethod
+    def is_empty(cls):
+        return UserModel.query.first() is None # SELECT * from users LIMIT 1
+
+    # Same as is_empty on an AsyncSession
+    @classmethod
+    async def is_empty_async(cls, session):
+        result = await session.execute(select(UserModel.id).limit(1))
+        return result.first() is None
@@ -0,0 +1,107 @@
+# Import libraries
+import json
+import base64
+import binascii
+from urllib.parse import urlencode
+from flask import Response, request, stream_with_context
+from flask_restful import reqparse, inputs, abort
+
+# Page sizes used by the list resources when the client does not ask for one (or asks for too many)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# How many rows we pull from the database at a time while streaming a full collection
+STREAM_BATCH_SIZE = 1000
+
+# Request Parser for the query string of the list resources (/items, /stores)
+# location='args' tells reqparse to only look in the query string and not in the JSON body
+page_parser = reqparse.RequestParser()
+page_parser.add_argument('limit', type=int, location='args', default=DEFAULT_PAGE_SIZE)
+# The cursor is the id of the last row the client has already seen (keyset pagination)
+# When the rows are sorted by another column, it is an opaque token made by encode_cursor()
+page_parser.add_argument('cursor', type=str, location='args')
+# ?stream=true writes the whole collection incrementally instead of a single page
+page_parser.add_argument('stream', type=inputs.boolean, location='args', default=False)
+
+
+# Parse the pagination arguments and clamp the limit between 1 and MAX_PAGE_SIZE
+# Unless sortable is True, the cursor has to be an id. req defaults to Flask's request (see aio.py)
+def page_args(sortable=False, req=None):
+    args = page_parser.parse_args(req)
+    limit = max(1, min(args['limit'], MAX_PAGE_SIZE))
+    cursor = args['cursor']
+    if cursor is not None:
+        cursor = decode_cursor(cursor, sortable)
+    return limit, cursor, args['stream']
+
+
+# Turns the sort value and id of the last row of a page into the cursor of the next page
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+# Reads a cursor back: an id is returned as an int and a token made by encode_cursor() as a list
+# Anything else is answered with 400, in the same format reqparse uses for invalid arguments
+def decode_cursor(cursor, sortable=False):
+    if cursor.isdigit():
+        return int(cursor)
+    if sortable:
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if isinstance(values, list) and len(values) == 2:
+                return values
+        except (ValueError, binascii.Error):
+            pass
+    abort(400, message={'cursor': 'Invalid cursor'})
+
+
+# Build the link to the next page, keeping every other query string argument the client sent
+# param is the argument the cursor goes in, /changes calls it since
+def next_link(cursor, req=None, param='cursor'):
+    if cursor is None:
+        return None
+    if req is None:
+        req = request
+    args = req.args.to_dict()
+    args[param] = cursor
+    return f'{req.path}?{urlencode(args)}'
+
+
+# Split a page fetched with limit + 1 rows into the page itself and the cursor of the next page
+# If we got the extra row back, there is at least one more page and it starts after the last row we return
+# cursor_for turns that row into the cursor, by default the cursor is its id
+def split_page(rows, limit, cursor_for=None):
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, cursor_for(rows[-1]) if cursor_for else rows[-1].id
+    return rows, None
+
+
+# Return a response that writes {"<key>": [ ... ]} one row at a time
+# batches is a generator of lists of rows and serialize turns a single row into a dict
+# If serialize is left out, the batches are expected to already contain dicts
+# Only one batch is held in memory at a time, so the worker's memory stays flat no matter how big the table is
+def stream_json_array(key, batches, serialize=None):
+    def generate():
+        yield '{' + json.dumps(key) + ': ['
+        first = True
+        for batch in batches:
+            for row in batch:
+                # Every row after the first one needs a comma in front of it
+                yield ('' if first else ', ') + json.dumps(serialize(row) if serialize else row)
+                first = False
+        yield ']}'
+
+    # stream_with_context keeps the application context alive while the generator queries the database
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+# Return a response that writes one line per row, like NDJSON or CSV. header is written once before the rows
+# serialize turns a whole batch of rows into text, so it can use a fast writer such as csv.writer for the whole batch
+def stream_lines(batches, serialize, mimetype, header=''):
+    def generate():
+        if header:
+            yield header
+        for batch in batches:
+            yield serialize(batch)
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
@@ -0,0 +1,122 @@
+# Import libraries
+import hmac
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from models.user import UserModel
+
+
+# Raised when too many passwords are already being hashed, so the request should be rejected instead of queued
+class HasherBusy(Exception):
+    pass
+
+
+# Returns the werkzeug method string for the configured cost, for example pbkdf2:sha256:150000
+def hash_method(algorithm, iterations):
+    return f'pbkdf2:{algorithm}:{iterations}'
+
+
+# Returns True if stored looks like a werkzeug hash, False if it is a plaintext password from before we hashed them
+def is_hashed(stored):
+    return stored.startswith('pbkdf2:') and stored.count('$') == 2
+
+
+# Compares a password with what is stored in the database, which is either a hash or a legacy plaintext password
+# This is a plain function (not a method) so it can be sent to another process by the ProcessPoolExecutor
+def check_password(stored, password):
+    if is_hashed(stored):
+        return check_password_hash(stored, password)
+    # Constant time comparison, so the time it takes does not tell an attacker how much of the password was right
+    return hmac.compare_digest(stored.encode(), password.encode())
+
+
+# Hashes and verifies passwords on a small pool of threads or processes
+# A KDF is slow on purpose, so running it on the request thread during a login storm would take every thread
+# of the worker. With the pool, at most PASSWORD_HASH_WORKERS hashes run at a time and the rest of the requests keep going
+class PasswordHasher:
+    def __init__(self):
+        self.method = hash_method('sha256', 150000)
+        self._executor = None
+        self._slots = None
+
+    # Configuration keys:
+    # PASSWORD_HASH_ALGORITHM: the hash function used by PBKDF2 (default sha256)
+    # PASSWORD_HASH_ITERATIONS: the cost. Higher is safer but slower, see benchmarks/password_bench.py
+    # PASSWORD_HASH_EXECUTOR: 'thread' (default) or 'process'
+    # PASSWORD_HASH_WORKERS: how many hashes can run at the same time
+    # PASSWORD_HASH_QUEUE: how many more can wait for a free worker before logins are rejected with HasherBusy
+    def init_app(self, app):
+        self.method = hash_method(app.config.get('PASSWORD_HASH_ALGORITHM', 'sha256'),
+                                  app.config.get('PASSWORD_HASH_ITERATIONS', 150000))
+        workers = app.config.get('PASSWORD_HASH_WORKERS', 2)
+        if app.config.get('PASSWORD_HASH_EXECUTOR', 'thread') == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            # hashlib releases the GIL while it hashes, so threads run the hashes in parallel as well
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hasher')
+        self._slots = threading.BoundedSemaphore(workers + app.config.get('PASSWORD_HASH_QUEUE', 32))
+
+    # Runs func(*args) on the pool and waits for the result. Raises HasherBusy if the queue is full
+    def _run(self, func, *args):
+        if self._executor is None:
+            return func(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    # Same as _run for the async serving mode: the event loop keeps serving other requests while the pool hashes
+    async def _run_async(self, func, *args):
+        if self._executor is None:
+            return func(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return await asyncio.wrap_future(self._executor.submit(func, *args))
+        finally:
+            self._slots.release()
+
+    # Returns the hash of a password using the configured cost
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    async def hash_async(self, password):
+        return await self._run_async(generate_password_hash, password, self.method)
+
+    # Returns True if the hash (or legacy plaintext password) stored for the user matches the password
+    def verify(self, stored, password):
+        return self._run(check_password, stored, password)
+
+    async def verify_async(self, stored, password):
+        return await self._run_async(check_password, stored, password)
+
+    # Returns True if the stored password is plaintext or was hashed with a different cost than the configured one
+    def needs_rehash(self, stored):
+        return not is_hashed(stored) or stored.split('$', 1)[0] != self.method
+
+    # Hashes the password again with the current cost and saves it, without making the request wait for it
+    # Used after a successful login, which is the only time we know the plaintext password
+    def rehash_in_background(self, user_id, password):
+        app = current_app._get_current_object()
+
+        def rehash():
+            new_hash = generate_password_hash(password, self.method)
+            # The request that started this has already finished, so we need our own application context
+            with app.app_context():
+                user = UserModel.find_by_id(user_id)
+                if user and self.needs_rehash(user.password):
+                    user.password = new_hash
+                    user.save_to_db()
+
+        if self._executor is None or isinstance(self._executor, ProcessPoolExecutor):
+            # The process pool cannot reach our database session, so the rehash gets a thread of its own
+            threading.Thread(target=rehash, daemon=True).start()
+        else:
+            self._executor.submit(rehash)
+
+
+hasher = PasswordHasher()
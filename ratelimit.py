@@ -0,0 +1,245 @@
+# Import libraries
+import math
+import time
+import asyncio
+import functools
+import threading
+from flask import request
+from cache import LocalSharedClient
+
+# Units a limit can be written in, for example '5/minute' or '100/hour'
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+# The locks (and dictionaries) of the local backend. Requests for different keys rarely wait on each other
+STRIPES = 64
+# How many hits a stripe takes between two purges of its expired entries
+PURGE_EVERY = 1024
+
+
+# Turns '5/minute' (or '5/2 minutes', '5 per minute') into the number of hits allowed and the period in seconds
+def parse_limit(limit):
+    count, _, period = limit.replace(' per ', '/').partition('/')
+    amount, _, unit = period.strip().rpartition(' ')
+    unit = unit.rstrip('s')
+    if unit not in PERIODS:
+        raise ValueError(f'Invalid rate limit {limit}')
+    return int(count), PERIODS[unit] * (float(amount) if amount else 1)
+
+
+# Token bucket: the bucket holds up to capacity tokens and refills at capacity / period tokens per second
+# Every hit takes a token. state starts with [tokens, time of the last hit]. Returns (allowed, seconds before the next token)
+def _token_bucket(state, capacity, period, now):
+    rate = capacity / period
+    tokens = min(capacity, state[0] + (now - state[1]) * rate)
+    state[1] = now
+    if tokens >= 1:
+        state[0] = tokens - 1
+        return True, 0
+    state[0] = tokens
+    return False, (1 - tokens) / rate
+
+
+# Sliding window: the hits of the current window plus the share of the previous window that still overlaps the last
+# period. state starts with [window number, hits in the previous window, hits in the current window]
+def _sliding_window(state, capacity, period, now):
+    window = int(now // period)
+    if state[0] != window:
+        state[1] = state[2] if state[0] == window - 1 else 0
+        state[2] = 0
+        state[0] = window
+    allowed, retry_after = _window_decision(state[1], state[2], capacity, period, now)
+    if allowed:
+        state[2] += 1
+    return allowed, retry_after
+
+
+# Whether one more hit fits in a sliding window, and if not, how long until it does
+def _window_decision(previous, current, capacity, period, now):
+    elapsed = now % period
+    if previous * (1 - elapsed / period) + current + 1 <= capacity:
+        return True, 0
+    # The previous window weighs less and less, until it is gone at the end of the current window
+    if current + 1 <= capacity:
+        return False, period * (1 - (capacity - current - 1) / previous) - elapsed
+    # The current window is full on its own, so we have to wait until its hits weigh little enough in the next one
+    return False, period - elapsed + period * (1 - (capacity - 1) / current)
+
+
+ALGORITHMS = {'token_bucket': _token_bucket, 'sliding_window': _sliding_window}
+
+
+# Keeps the limiter state in this process. Each key is a small list in one of STRIPES dictionaries, each with its own lock
+# An entry is dropped once it carries no information any more: a full bucket, or a window that has slid past every hit
+class LocalLimiter:
+    def __init__(self, algorithm='token_bucket'):
+        self.algorithm = algorithm
+        self._decide = ALGORITHMS[algorithm]
+        # A bucket is full again after one period at the most, and a window forgets every hit after two
+        self._lifetime = 1 if algorithm == 'token_bucket' else 2
+        self._stripes = [({}, threading.Lock()) for _ in range(STRIPES)]
+        self._hits = [0] * STRIPES
+
+    # Records a hit for key. Returns 0 if it is allowed, otherwise how many seconds the client has to wait
+    def hit(self, key, capacity, period):
+        stripe = hash(key) % STRIPES
+        entries, lock = self._stripes[stripe]
+        now = time.monotonic()
+        with lock:
+            state = entries.get(key)
+            if state is None:
+                # The last element is when the entry can be forgotten
+                state = entries[key] = [capacity, now, 0] if self.algorithm == 'token_bucket' else [int(now // period), 0, 0, 0]
+            allowed, retry_after = self._decide(state, capacity, period, now)
+            state[-1] = now + self._lifetime * period
+            self._hits[stripe] += 1
+            if self._hits[stripe] % PURGE_EVERY == 0:
+                self._purge(entries, now)
+        return 0 if allowed else retry_after
+
+    # Removes the expired entries of a stripe. Must be called with the lock of the stripe held
+    def _purge(self, entries, now):
+        for key in [key for key, state in entries.items() if state[-1] < now]:
+            del entries[key]
+
+    def reset(self):
+        for entries, lock in self._stripes:
+            with lock:
+                entries.clear()
+
+    def __len__(self):
+        return sum(len(entries) for entries, _ in self._stripes)
+
+
+# Keeps the limiter state in an external key-value store such as Redis, so a limit holds across every worker
+# The client needs get(key) and incr(key, amount, ttl) methods, like cache.LocalSharedClient. Every hit is one atomic
+# INCR of the counter of the current window, so only the sliding window algorithm can be shared this way
+class SharedLimiter:
+    algorithm = 'sliding_window'
+
+    def __init__(self, client, prefix='ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def hit(self, key, capacity, period):
+        now = time.time()
+        window = int(now // period)
+        current = self.client.incr(f'{self.prefix}{key}:{window}', 1, math.ceil(2 * period))
+        previous = int(self.client.get(f'{self.prefix}{key}:{window - 1}') or 0)
+        # The hit is already counted, so it is allowed when the window held at most capacity - 1 hits before it
+        allowed, retry_after = _window_decision(previous, current - 1, capacity, period, now)
+        return 0 if allowed else retry_after
+
+    def reset(self):
+        self.client.delete(*[key for key in self.client.keys() if key.startswith(self.prefix)])
+
+    def __len__(self):
+        return len([key for key in self.client.keys() if key.startswith(self.prefix)])
+
+
+# The IP address of the client. Behind a proxy (RATELIMIT_TRUST_PROXY) it is the first address of X-Forwarded-For
+def client_ip(req):
+    if limiter.trust_proxy:
+        forwarded = req.headers.get('x-forwarded-for')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return req.remote_addr
+
+
+# Returns a key function that reads a field of the JSON body, for example body_field('username')
+# Requests without the field are not limited by it (they are rejected by the request schema anyway)
+def body_field(name):
+    def key(req):
+        body = req.get_json(silent=True)
+        value = body.get(name) if isinstance(body, dict) else None
+        return str(value).lower() if value is not None else None
+    key.__name__ = name
+    return key
+
+
+# The limiter used by the resources. Like the cache and the blocklist, it is linked to the app with init_app()
+class Limiter:
+    def __init__(self):
+        self.backend = LocalLimiter()
+        self.enabled = True
+        self.trust_proxy = False
+        self._config = {}
+        self._limits = {}
+
+    # Configuration keys:
+    # RATELIMIT_ENABLED: set to False to turn every limit off
+    # RATELIMIT_TYPE: 'local' (default, per worker) or 'shared' (every worker, sliding window only)
+    # RATELIMIT_ALGORITHM: 'token_bucket' (default) or 'sliding_window', for the local backend
+    # RATELIMIT_SHARED_CLIENT: the key-value client used by the 'shared' backend (defaults to cache.LocalSharedClient)
+    # RATELIMIT_TRUST_PROXY: read the client IP from X-Forwarded-For, only when the API runs behind a proxy
+    # The limits themselves are settings as well, see RATELIMIT_LOGIN_IP and the others in config.py
+    def init_app(self, app):
+        self.enabled = app.config.get('RATELIMIT_ENABLED', True)
+        self.trust_proxy = app.config.get('RATELIMIT_TRUST_PROXY', False)
+        self._config = app.config
+        self._limits = {}
+        limiter_type = app.config.get('RATELIMIT_TYPE', 'local')
+        algorithm = app.config.get('RATELIMIT_ALGORITHM', 'token_bucket')
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f'Unknown RATELIMIT_ALGORITHM {algorithm}')
+        if limiter_type == 'local':
+            self.backend = LocalLimiter(algorithm)
+        elif limiter_type == 'shared':
+            if algorithm != 'sliding_window':
+                raise ValueError('The shared rate limiter only supports RATELIMIT_ALGORITHM sliding_window')
+            self.backend = SharedLimiter(app.config.get('RATELIMIT_SHARED_CLIENT') or LocalSharedClient())
+        else:
+            raise ValueError(f'Unknown RATELIMIT_TYPE {limiter_type}')
+
+    # A limit is either written out ('5/minute') or the name of the setting that holds it ('RATELIMIT_LOGIN_IP')
+    # Parsed once and remembered
+    def _parse(self, limit):
+        parsed = self._limits.get(limit)
+        if parsed is None:
+            parsed = self._limits[limit] = parse_limit(limit if '/' in limit else self._config[limit])
+        return parsed
+
+    # Records a hit of key against a limit. Returns 0 if it is allowed, otherwise the seconds to wait
+    def hit(self, limit, key):
+        capacity, period = self._parse(limit)
+        return self.backend.hit(f'{limit}:{key}', capacity, period)
+
+    # Decorator for the methods of a resource: @limiter.limit('RATELIMIT_LOGIN_IP', client_ip)
+    # key_func gets the request and returns the key the limit applies to, or None to skip the limit
+    # Requests over the limit are answered with 429 and a Retry-After header without running the method
+    # Works on the coroutines of the async resources as well, where the request is the first argument
+    def limit(self, limit, key_func=client_ip):
+        def decorator(method):
+            if asyncio.iscoroutinefunction(method):
+                @functools.wraps(method)
+                async def async_wrapper(self_, req, *args, **kwargs):
+                    rejected = self._check(limit, key_func, req)
+                    if rejected:
+                        return rejected
+                    return await method(self_, req, *args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                rejected = self._check(limit, key_func, request)
+                if rejected:
+                    return rejected
+                return method(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # Returns the 429 response if the request is over the limit, None otherwise
+    def _check(self, limit, key_func, req):
+        if not self.enabled:
+            return None
+        key = key_func(req)
+        if key is None:
+            return None
+        retry_after = self.hit(limit, key)
+        if retry_after:
+            return {'message': 'Too many requests, please try again later.'}, 429, {'Retry-After': str(max(1, math.ceil(retry_after)))}
+        return None
+
+    def reset(self):
+        self.backend.reset()
+
+
+limiter = Limiter()
@@ -0,0 +1,26 @@
+# The change log resources of the async serving mode (see aio.py)
+# They answer exactly like the ones in resources/change.py. A stream waits for new changes on a future instead of
+# a thread, so a worker can hold many more of them open
+from models.change import ChangeModel, ChangesCompacted
+from changefeed import feed
+from resources.change import changes_args, stream_since, changes_page, compacted_response, STREAM_HEADERS
+
+
+class AsyncChanges:
+    async def get(self, request):
+        since, limit = changes_args(request)
+        since = since or 0
+        try:
+            changes, latest_seq = await ChangeModel.find_since_async(request.session, since, limit)
+        except ChangesCompacted as error:
+            return compacted_response(error)
+        return changes_page(changes, since, latest_seq, limit, request), 200
+
+
+class AsyncChangeStream:
+    async def get(self, request):
+        since = stream_since(request)
+        if since is None:
+            since = (await ChangeModel.bounds_async(request.session))[1] or 0
+        # An async generator, which AsyncApi writes as it goes
+        return feed.stream_async(since), 200, STREAM_HEADERS
@@ -0,0 +1,92 @@
+# The Item and ItemList resources of the async serving mode (see aio.py)
+# They answer exactly like the ones in resources/item.py, but every method is a coroutine that uses the AsyncSession
+# of the request, so the event loop serves other requests while this one waits on the database
+from sqlalchemy.exc import IntegrityError
+from aio import jwt_required, jwt_optional, fresh_jwt_required
+from models.item import ItemModel
+from writebehind import write_queue, WriteQueueFull
+from resources.item import Item, ItemList, _encode_item_cursor
+from conditional import validator_headers, not_modified, collection_etag
+from db import timestamp
+from pagination import page_args, next_link, split_page
+
+
+class AsyncItem:
+    async def get(self, request, name):
+        # Search for the item in the cache, falling back to the database
+        item = await ItemModel.find_cached_by_name_async(request.session, name)
+        if item:
+            headers = validator_headers(item['etag'], item['updated_at'])
+            if not_modified(item['etag'], item['updated_at'], request):
+                return None, 304, headers
+            return item['json'], 200, headers
+        return {'message': 'Item not found'}, 404
+
+    @jwt_required
+    async def post(self, request, name):
+        if await ItemModel.find_by_name_async(request.session, name):
+            return {'message': f'An item with name {name} already exists.'}, 400
+
+        data = Item.parser.parse_args(request)
+        item = ItemModel(name, data['price'], data['store_id'])
+        try: # save_to_db runs on the sync session behind the AsyncSession, so the models keep a single save method
+            await request.session.run_sync(item.save_to_db)
+        except IntegrityError: # Another request created an item with the same name after our check above
+            return {'message': f'An item with name {name} already exists.'}, 400
+        return item.json(), 201
+
+    @jwt_required
+    async def delete(self, request, name):
+        if not request.jwt_claims.get('is_admin'):
+            return {'message': 'Admin privilege is required'}, 401
+
+        item = await ItemModel.find_by_name_async(request.session, name)
+        if item:
+            await request.session.run_sync(item.delete_from_db)
+        return {'Message': 'Item deleted'}, 410
+
+    @fresh_jwt_required
+    async def put(self, request, name):
+        data = Item.parser.parse_args(request)
+        if write_queue.enabled:
+            entry = await ItemModel.find_cached_by_name_async(request.session, name)
+            if entry is not None:
+                # Never waits for room in the queue, that would block the event loop
+                try:
+                    write_queue.enqueue(name, data['price'], timeout=0)
+                except WriteQueueFull:
+                    return {'message': 'Too many requests, please try again later.'}, 503, {'Retry-After': '1'}
+                return dict(entry['json'], price=data['price']), 202
+        item = await ItemModel.find_by_name_async(request.session, name)
+        if item is None:
+            item = ItemModel(name, data['price'], data['store_id'])
+        else:
+            item.price = data['price']
+        await request.session.run_sync(item.save_to_db)
+        return item.json()
+
+
+# Pages of items with the same filters and sorts as ItemList. The streaming and export formats are only served
+# by the sync mode, because they hold the response open for as long as the table takes to read
+class AsyncItemList:
+    @jwt_optional
+    async def get(self, request):
+        limit, cursor, stream = page_args(sortable=True, req=request)
+        args = ItemList.parser.parse_args(request)
+        sort = args['sort']
+        if stream or args['format'] != 'json':
+            return {'message': 'Streaming and exports are not available in the async mode'}, 400
+        filters = {'store_id': args['store_id'], 'min_price': args['min_price'], 'max_price': args['max_price'],
+                   'prefix': args['prefix'], 'text': args['q']}
+        if cursor is not None and isinstance(cursor, int) != (sort.lstrip('-') == 'id'):
+            return {'message': {'cursor': 'Invalid cursor'}}, 400
+
+        count, versions, updated_at, max_id = await ItemModel.collection_version_async(request.session)
+        etag = collection_etag('items', count, versions, updated_at, max_id, req=request)
+        headers = validator_headers(etag, timestamp(updated_at))
+        if not_modified(etag, timestamp(updated_at), request):
+            return None, 304, headers
+
+        items = await ItemModel.search_async(request.session, limit + 1, cursor, sort, **filters)
+        items, next_cursor = split_page(items, limit, lambda item: _encode_item_cursor(item, sort))
+        return {'items': [item.json() for item in items], 'next_cursor': next_cursor, 'next': next_link(next_cursor, request)}, 200, headers
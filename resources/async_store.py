@@ -0,0 +1,68 @@
+# The Store and StoreList resources of the async serving mode (see aio.py)
+# They answer exactly like the ones in resources/store.py, using the AsyncSession of the request
+from sqlalchemy.exc import IntegrityError
+from models.store import StoreModel
+from conditional import validator_headers, not_modified, collection_etag
+from db import timestamp
+from pagination import page_args, next_link, split_page
+from resources.store import store_view
+
+
+class AsyncStore:
+    async def get(self, request, name):
+        summary, with_items = store_view(request)
+        if summary:
+            store = await StoreModel.find_summary_by_name_async(request.session, name, with_items)
+        else:
+            # Retrieve the JSON of the store from the cache, falling back to the database
+            store = await StoreModel.find_cached_by_name_async(request.session, name)
+        if store:
+            headers = validator_headers(store['etag'], store['updated_at'])
+            if not_modified(store['etag'], store['updated_at'], request):
+                return None, 304, headers
+            return store['json'], 200, headers
+        return {'Message': 'Store not found!'}, 404
+
+    async def post(self, request, name):
+        if await StoreModel.find_by_name_async(request.session, name):
+            return {'Message': f'Store {name} already exists!'}, 400
+
+        store = StoreModel(name)
+        try: # save_to_db runs on the sync session behind the AsyncSession, so the models keep a single save method
+            await request.session.run_sync(store.save_to_db)
+        except IntegrityError: # Another request created a store with the same name after our check above
+            return {'Message': f'Store {name} already exists!'}, 400
+        # A new store has no items yet
+        return store.json([]), 201
+
+    async def delete(self, request, name):
+        store = await StoreModel.find_by_name_async(request.session, name)
+        if store:
+            await request.session.run_sync(store.delete_from_db)
+            return {'Message': 'Store Deleted'}
+        return {'Message': 'Store does not exist'}
+
+
+# Pages of stores. Like in the sync mode, the items of the whole page are loaded with a single query
+# ?stream=true is only served by the sync mode
+class AsyncStoreList:
+    async def get(self, request):
+        limit, cursor, stream = page_args(req=request)
+        summary, with_items = store_view(request)
+        if stream:
+            return {'message': 'Streaming is not available in the async mode'}, 400
+
+        count, versions, updated_at, max_id = await StoreModel.collection_version_async(request.session)
+        etag = collection_etag('stores', count, versions, updated_at, max_id, req=request)
+        headers = validator_headers(etag, timestamp(updated_at))
+        if not_modified(etag, timestamp(updated_at), request):
+            return None, 304, headers
+
+        stores, next_cursor = split_page(await StoreModel.find_page_async(request.session, limit + 1, cursor), limit)
+        if summary and not with_items:
+            page = [store.summary() for store in stores]
+        else:
+            items = await StoreModel.load_items_async(request.session, stores)
+            page = [store.summary(items[store.id]) if summary else store.json(items[store.id]) for store in stores]
+        return {'stores': page, 'next_cursor': next_cursor,
+                'next': next_link(next_cursor, request)}, 200, headers
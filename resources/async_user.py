@@ -0,0 +1,96 @@
+# The user resources of the async serving mode (see aio.py)
+# They answer exactly like the ones in resources/user.py. Passwords are hashed on the same bounded pool,
+# but the event loop awaits the result instead of blocking a thread on it
+from flask_jwt_extended import create_access_token, create_refresh_token
+from sqlalchemy.exc import IntegrityError
+from aio import jwt_required, jwt_refresh_token_required
+from models.user import UserModel
+from schemas import user_request
+from passwords import hasher, HasherBusy
+from blocklist import blocklist
+from ratelimit import limiter, body_field
+
+
+class AsyncUserRegister:
+    @limiter.limit('RATELIMIT_REGISTER_IP')
+    async def post(self, request):
+        data = user_request.parse_args(request)
+        if await UserModel.find_by_username_async(request.session, data['username']):
+            return {"message": "User already exists!"}, 400
+
+        # The first user to register becomes the admin
+        role = 'admin' if await UserModel.is_empty_async(request.session) else 'user'
+        try:
+            user = UserModel(data['username'], await hasher.hash_async(data['password']), role)
+        except HasherBusy: # Too many passwords are being hashed right now
+            return {"message": "Too many requests, please try again later."}, 503
+        try:
+            await request.session.run_sync(user.save_to_db)
+        except IntegrityError: # Another request registered the same username after our check above
+            return {"message": "User already exists!"}, 400
+        return {"message": "User created successfully."}, 201
+
+
+class AsyncUser:
+    async def get(self, request, user_id):
+        user = await UserModel.find_by_id_async(request.session, user_id)
+        if not user:
+            return {'message': 'User not found'}, 404
+        return user.json()
+
+    async def delete(self, request, user_id):
+        user = await UserModel.find_by_id_async(request.session, user_id)
+        if not user:
+            return {'message': 'User not found'}, 404
+        await request.session.run_sync(user.delete_from_db)
+        # and make sure the tokens they already have stop working
+        blocklist.revoke_user(user_id)
+        return {'message': 'User deleted'}, 200
+
+
+class AsyncUserLogin:
+    @limiter.limit('RATELIMIT_LOGIN_IP')
+    @limiter.limit('RATELIMIT_LOGIN_USERNAME', body_field('username'))
+    async def post(self, request):
+        data = user_request.parse_args(request)
+        user = await UserModel.find_by_username_async(request.session, data['username'])
+        try:
+            valid = user is not None and await hasher.verify_async(user.password, data['password'])
+        except HasherBusy: # Too many passwords are being checked right now
+            return {'message': 'Too many requests, please try again later.'}, 503
+
+        if valid:
+            # The rehash saves the new hash through the sync engine on a thread of its own
+            if hasher.needs_rehash(user.password):
+                hasher.rehash_in_background(user.id, data['password'])
+            access_token = create_access_token(identity=user.id, fresh=True, user_claims=user.claims())
+            refresh_token = create_refresh_token(identity=user.id)
+            return {'access_token': access_token, 'refresh_token': refresh_token}, 200
+        return {'message': 'Invalid credentials'}, 401
+
+
+class AsyncUserLogout:
+    @jwt_required
+    async def post(self, request):
+        blocklist.revoke_token(request.jwt)
+        return {'message': 'Successfully logged out.'}, 200
+
+
+class AsyncUserRevoke:
+    @jwt_required
+    async def post(self, request, user_id):
+        if not request.jwt_claims.get('is_admin'):
+            return {'message': 'Admin privilege is required'}, 401
+
+        blocklist.revoke_user(user_id)
+        return {'message': 'Tokens revoked.'}, 200
+
+
+class AsyncTokenRefresh:
+    @jwt_refresh_token_required
+    async def post(self, request):
+        # The user_claims_loader of app.py would look the user up with the sync engine, so we pass the claims in ourselves
+        user = await UserModel.find_by_id_async(request.session, request.jwt_identity)
+        claims = user.claims() if user else {'is_admin': False, 'role': 'user'}
+        new_token = create_access_token(identity=request.jwt_identity, fresh=False, user_claims=claims)
+        return {'access_token': new_token}, 200
@@ -0,0 +1,14 @@
+# Import libraries
+from flask_restful import Resource
+from flask_jwt_extended import jwt_required, get_jwt_claims
+from cache import cache
+
+# Returns the hit, miss and eviction counters of the cache so we can decide how big it should be
+class CacheStats(Resource):
+    @jwt_required
+    def get(self):
+        # Only admins can look at the cache
+        claims = get_jwt_claims()
+        if not claims['is_admin']:
+            return {'message': 'Admin privilege is required'}, 401
+        return cache.stats(), 200
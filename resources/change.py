@@ -0,0 +1,74 @@
+# Import libraries
+from flask import request, Response
+from flask_restful import Resource, reqparse
+from models.change import ChangeModel, ChangesCompacted
+from changefeed import feed
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, next_link
+
+# Query string of /changes and /changes/stream: ?since=<the last seq the client has seen>&limit=<page size>
+changes_parser = reqparse.RequestParser()
+changes_parser.add_argument('since', type=int, location='args')
+changes_parser.add_argument('limit', type=int, location='args', default=DEFAULT_PAGE_SIZE)
+
+# Headers of a stream. Proxies must neither cache it nor wait for the end of it before passing it on
+STREAM_HEADERS = {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+# Returns since (None when the client did not send it) and the limit clamped like page_args does
+# req defaults to Flask's request, the async resources pass in their own (see aio.py)
+def changes_args(req=None):
+    args = changes_parser.parse_args(req)
+    return args['since'], max(1, min(args['limit'], MAX_PAGE_SIZE))
+
+
+# Where a stream starts: ?since=, or the Last-Event-ID header the browser sends when it reconnects
+# Returns None when there is neither, the stream then starts at the end of the log
+def stream_since(req=None):
+    if req is None:
+        req = request
+    since, _ = changes_args(req)
+    last_event_id = req.headers.get('last-event-id', '')
+    if since is None and last_event_id.isdigit():
+        since = int(last_event_id)
+    return since
+
+
+# The body of a page of changes. next is only set when there may be more changes right now
+def changes_page(changes, since, latest_seq, limit, req=None):
+    next_since = changes[-1].seq if changes else since
+    return {'changes': [change.json() for change in changes], 'next_since': next_since, 'latest_seq': latest_seq,
+            'next': next_link(next_since, req, 'since') if len(changes) == limit else None}
+
+
+# The answer to a client that is further behind than the log goes back
+def compacted_response(error):
+    return {'message': 'These changes have been compacted. Reload /items and /stores, then ask for the changes since latest_seq',
+            'latest_seq': error.latest_seq}, 410
+
+
+# The changes to the items and stores after a seq, oldest first, one page at a time
+# Instead of polling /items and /stores, a client keeps the next_since of the last page and asks for the changes since then
+class Changes(Resource):
+    def get(self):
+        since, limit = changes_args()
+        since = since or 0
+        try:
+            changes, latest_seq = ChangeModel.find_since(since, limit)
+        except ChangesCompacted as error:
+            return compacted_response(error)
+        return changes_page(changes, since, latest_seq, limit), 200
+
+
+# The same changes as server-sent events, pushed as they are committed (see changefeed.py)
+# Every event has the change as data and its seq as id. A client that is too far behind gets a reset event and
+# the stream ends. Holds a thread of the worker for as long as the client stays, so a worker only serves
+# CHANGES_MAX_SYNC_STREAMS of them at once and answers 503 after that. The async mode costs no thread and has no limit
+class ChangeStream(Resource):
+    def get(self):
+        since = stream_since()
+        if since is None:
+            since = ChangeModel.bounds()[1] or 0
+        body = feed.open_stream(since)
+        if body is None:
+            return {'message': 'Too many streams on this server, please try again later or use the async mode.'}, 503, {'Retry-After': '3'}
+        return Response(body, headers=STREAM_HEADERS)
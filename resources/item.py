@@ -1,95 +1,249 @@
-# Import libraries
-from flask_restful import Resource, reqparse
-from flask_jwt_extended import jwt_required, get_jwt_claims, jwt_optional, get_jwt_identity, fresh_jwt_required
-from models.item import ItemModel
-
-# Every resource has to be a class that inherents from Resource class
-# This allows us to use features from the Resource class 
-# So it is basically a copy of that class, but we can change things
-class Item(Resource):
-    # Used to parse requests. Belongs to the class itself, and not to specific objects
-    parser = reqparse.RequestParser()
-    # This will look in the JSON payload but it will also look in form payloads if needed
-    parser.add_argument('price', type=float, required=True, help="This field cannot be left blank!")
-    parser.add_argument('store_id', type=int, required=True, help="Every Item must belong to a Store!")
-    # Get the payload using the parser instead of request
-    # This will parse the arguments that pass through the payload and put the valid ones in data variable
-    # So anything other than price will be erased completely
-
-    def get(self, name):
-        try: # Search for the item in the database
-            item = Item.find_by_name(name)
-            # Check whether the item exists, if so return it
-            if item:
-                return item.json()
-            return {'message': 'Item not found'}, 404
-        except: # catch any errors
-            return {'message': 'An error occured while searching the database'}, 500 # Internal server error
-
-    # This means we have to authenticate before sending the request
-    @jwt_required
-    def post(self, name):
-        # If an item already exists, return an error
-        if ItemModel.find_by_name(name):
-            return {'message': f'An item with name {name} already exists.'}, 400
-
-        # Parse the response
-        data = Item.parser.parse_args()
-        item = ItemModel(name, data['price'], data['store_id'])
-        
-        try: # Add the new item to the database
-            item.save_to_db()
-        except: # Catch any errors
-            return {"message": "An error occured while inserting the item"}, 500 # Internal server error
-
-        # Let the application know it was successful with the 201 code, meaning a resource was created
-        return item.json(), 201 
-    
-    # This means we have to authenticate before sending the request
-    @jwt_required
-    def delete(self, name):
-        # Use the claim we made in app.py to interpret the jwt and extract any claims that have been attached
-        claims = get_jwt_claims()
-        if not claims['is_admin']:
-            return {'message': 'Admin privilege is required'}, 401
-
-        # Create an object of type ItemModel if the named item exists in the database
-        item = ItemModel.find_by_name(name)
-        if item:
-            # If the item exists, call its method to delete it from the database
-            item.delete_from_db()
-        return {'Message': 'Item deleted'}, 410
-    
-     # This requires a FRESH JWT - check the TokenRefresh Resource in the User.py file for more information
-    @fresh_jwt_required
-    # Create or update an existing item
-    def put(self, name):
-        # Parse and validate the JSON payload
-        data = Item.parser.parse_args()
-
-        # Retrieve the item from the database if it exists or set item equal to none if not
-        item = ItemModel.find_by_name(name)
-
-        if item is None:
-            # If the item does not exist, then create a new item 
-            item = ItemModel(name, data['price'], data['store_id'])
-        else: 
-            # If the item does exist, update the price property
-            item.price = data['price']
-
-        # Save the item to the database (this either inserts or updates based on whether it exists)
-        item.save_to_db()
-        return item.json()
-
-class ItemList(Resource):
-    # Returns all items from our database
-    @jwt_optional
-    def get(self):
-        # This gets us whatever we save in the access token as the identity - in our case, the id of the user
-        # Because jwt is optional, it could also give us none - in case they are not logged in or didnd't send the jwt token
-        # If we wanted, we could then return a partial set of items if they are not logged in. I was too lazy to do this
-        user_id = get_jwt_identity()
-        # The find_all() method returns a list of all items in the DB as objects, 
-        # but we cannot return objects, we need to convert them into JSON
-        # So we use a list comprehension to convert each object into JSON
-        return {'items': [item.json() for item in ItemModel.find_all()]}, 200
+# Import libraries
+import io
+import csv
+import json
+from flask import request
+from flask_restful import Resource, reqparse
+from sqlalchemy.exc import IntegrityError
+from flask_jwt_extended import jwt_required, get_jwt_claims, jwt_optional, get_jwt_identity, fresh_jwt_required
+from models.item import ItemModel
+from writebehind import write_queue, WriteQueueFull
+from schemas import item_request, bulk_item_request, parse_batch_request, batch_response
+from conditional import validator_headers, not_modified, not_modified_response, collection_etag
+from db import timestamp
+from pagination import page_args, next_link, split_page, encode_cursor, stream_json_array, stream_lines, STREAM_BATCH_SIZE
+
+# Every resource has to be a class that inherents from Resource class
+# This allows us to use features from the Resource class 
+# So it is basically a copy of that class, but we can change things
+class Item(Resource):
+    # Used to parse requests. Belongs to the class itself, and not to specific objects
+    # This will look in the JSON payload but it will also look in form payloads if needed
+    # The price and store_id fields are defined once in schemas.py, which is faster than a reqparse.RequestParser
+    parser = item_request
+    # Get the payload using the parser instead of request
+    # This will parse the arguments that pass through the payload and put the valid ones in data variable
+    # So anything other than price will be erased completely
+
+    def get(self, name):
+        try: # Search for the item in the cache, falling back to the database
+            item = ItemModel.find_cached_by_name(name)
+            # Check whether the item exists, if so return it
+            if item:
+                headers = validator_headers(item['etag'], item['updated_at'])
+                # The client sent the ETag or date of the copy it already has and nothing changed since then
+                if not_modified(item['etag'], item['updated_at']):
+                    return not_modified_response(headers)
+                return item['json'], 200, headers
+            return {'message': 'Item not found'}, 404
+        except: # catch any errors
+            return {'message': 'An error occured while searching the database'}, 500 # Internal server error
+
+    # This means we have to authenticate before sending the request
+    @jwt_required
+    def post(self, name):
+        # If an item already exists, return an error
+        if ItemModel.find_by_name(name):
+            return {'message': f'An item with name {name} already exists.'}, 400
+
+        # Parse the response
+        data = Item.parser.parse_args()
+        item = ItemModel(name, data['price'], data['store_id'])
+        
+        try: # Add the new item to the database
+            item.save_to_db()
+        except IntegrityError: # Another request created an item with the same name after our check above
+            return {'message': f'An item with name {name} already exists.'}, 400
+        except: # Catch any errors
+            return {"message": "An error occured while inserting the item"}, 500 # Internal server error
+
+        # Let the application know it was successful with the 201 code, meaning a resource was created
+        return item.json(), 201 
+    
+    # This means we have to authenticate before sending the request
+    @jwt_required
+    def delete(self, name):
+        # Use the claim we made in app.py to interpret the jwt and extract any claims that have been attached
+        claims = get_jwt_claims()
+        if not claims['is_admin']:
+            return {'message': 'Admin privilege is required'}, 401
+
+        # Create an object of type ItemModel if the named item exists in the database
+        item = ItemModel.find_by_name(name)
+        if item:
+            # If the item exists, call its method to delete it from the database
+            item.delete_from_db()
+        return {'Message': 'Item deleted'}, 410
+    
+     # This requires a FRESH JWT - check the TokenRefresh Resource in the User.py file for more information
+    @fresh_jwt_required
+    # Create or update an existing item
+    def put(self, name):
+        # Parse and validate the JSON payload
+        data = Item.parser.parse_args()
+
+        # With the write-behind queue on, the new price of an existing item is queued and we answer 202 right away
+        # New items still go through the database below, since they need an id
+        if write_queue.enabled:
+            entry = ItemModel.find_cached_by_name(name)
+            if entry is not None:
+                try:
+                    write_queue.enqueue(name, data['price'])
+                except WriteQueueFull:
+                    return {'message': 'Too many requests, please try again later.'}, 503, {'Retry-After': '1'}
+                return dict(entry['json'], price=data['price']), 202
+
+        # Retrieve the item from the database if it exists or set item equal to none if not
+        item = ItemModel.find_by_name(name)
+
+        if item is None:
+            # If the item does not exist, then create a new item 
+            item = ItemModel(name, data['price'], data['store_id'])
+        else: 
+            # If the item does exist, update the price property
+            item.price = data['price']
+
+        # Save the item to the database (this either inserts or updates based on whether it exists)
+        item.save_to_db()
+        return item.json()
+
+class ItemList(Resource):
+    # ?format=ndjson or ?format=csv exports every item instead of returning a page of JSON
+    parser = reqparse.RequestParser()
+    parser.add_argument('format', type=str, location='args', choices=('json', 'ndjson', 'csv'), default='json')
+    # Filters, every one of them is optional. q is a full-text search on the name
+    parser.add_argument('store_id', type=int, location='args')
+    parser.add_argument('min_price', type=float, location='args')
+    parser.add_argument('max_price', type=float, location='args')
+    parser.add_argument('prefix', type=str, location='args')
+    parser.add_argument('q', type=str, location='args')
+    parser.add_argument('sort', type=str, location='args', choices=ItemModel.SORT_KEYS, default='id')
+
+    # Returns a page of items from our database
+    # Query string: ?limit=<page size>&cursor=<id of the last item seen>&stream=<true to stream every item>
+    # plus the filters above, for example ?store_id=1&min_price=10&sort=-price
+    @jwt_optional
+    def get(self):
+        # This gets us whatever we save in the access token as the identity - in our case, the id of the user
+        # Because jwt is optional, it could also give us none - in case they are not logged in or didnd't send the jwt token
+        # If we wanted, we could then return a partial set of items if they are not logged in. I was too lazy to do this
+        user_id = get_jwt_identity()
+        limit, cursor, stream = page_args(sortable=True)
+        args = ItemList.parser.parse_args()
+        export_format, sort = args['format'], args['sort']
+        filters = {'store_id': args['store_id'], 'min_price': args['min_price'], 'max_price': args['max_price'],
+                   'prefix': args['prefix'], 'text': args['q']}
+        # A page sorted by id continues after an id, any other sort after a [value, id] cursor
+        if cursor is not None and isinstance(cursor, int) != (sort.lstrip('-') == 'id'):
+            return {'message': {'cursor': 'Invalid cursor'}}, 400
+
+        # Exports stream every matching item after the cursor in the requested order, one line per item
+        batches = ItemModel.iter_batches(STREAM_BATCH_SIZE, cursor, sort, **filters)
+        if export_format == 'ndjson':
+            return stream_lines(batches, _ndjson_lines, 'application/x-ndjson')
+        if export_format == 'csv':
+            return stream_lines(batches, _csv_lines, 'text/csv', header='id,name,price,store_id\r\n')
+
+        # Streaming mode writes the JSON array as we read the table, one batch at a time
+        if stream:
+            return stream_json_array('items', batches, ItemModel.json)
+
+        # The ETag of the page comes from aggregates over the whole table, which is much cheaper than loading the page,
+        # so a client polling a page that has not changed gets a 304 without a single item being loaded
+        count, versions, updated_at, max_id = ItemModel.collection_version()
+        etag = collection_etag('items', count, versions, updated_at, max_id)
+        headers = validator_headers(etag, timestamp(updated_at))
+        if not_modified(etag, timestamp(updated_at)):
+            return not_modified_response(headers)
+
+        # Ask for one extra row so we know whether there is another page after this one
+        items = ItemModel.search(limit + 1, cursor, sort, **filters)
+        items, next_cursor = split_page(items, limit, lambda item: _encode_item_cursor(item, sort))
+        # The search() method returns a list of items in the DB as objects,
+        # but we cannot return objects, we need to convert them into JSON
+        # So we use a list comprehension to convert each object into JSON
+        return {'items': [item.json() for item in items], 'next_cursor': next_cursor, 'next': next_link(next_cursor)}, 200, headers
+
+
+# The cursor of the next page: the id of the last item, or an opaque token when the items are sorted by another column
+def _encode_item_cursor(item, sort):
+    cursor = item.cursor_for(sort)
+    return cursor if isinstance(cursor, int) else encode_cursor(cursor)
+
+
+# Turns a batch of items into NDJSON, one JSON object per line
+def _ndjson_lines(items):
+    return ''.join(json.dumps(item.json()) + '\n' for item in items)
+
+
+# Turns a batch of items into CSV rows with the same columns as the JSON representation
+def _csv_lines(items):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows((item.id, item.name, item.price, item.store_id) for item in items)
+    return buffer.getvalue()
+
+
+# Validates a single row of a bulk import with the same rules (and messages) as Item.parser, plus the item name
+# Returns the cleaned row and a dictionary of field -> error message, which is empty when the row is valid
+def parse_bulk_row(row):
+    if not isinstance(row, dict):
+        return None, {'row': 'Every row must be a JSON object'}
+    # bundle=True reports every invalid field of the row at once
+    data, errors = bulk_item_request.validate(row, bundle=True)
+    if not errors and not data['name']:
+        errors['name'] = "This field cannot be left blank!"
+    if errors:
+        return None, errors
+    return data, errors
+
+
+# Creates or updates many items in one request
+# The body is either a JSON array of items or NDJSON (Content-Type: application/x-ndjson), one item per line
+# Every item looks like {"name": "chair", "price": 12.99, "store_id": 1}
+class ItemBulk(Resource):
+    @jwt_required
+    def post(self):
+        # Read the rows out of the body
+        if request.mimetype == 'application/x-ndjson':
+            rows = []
+            for line in request.get_data(as_text=True).splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    # Keep the position of the line so the error below points at the right row
+                    rows.append(None)
+        else:
+            rows = request.get_json(silent=True)
+            if not isinstance(rows, list):
+                return {'message': 'The body must be a JSON array or NDJSON'}, 400
+
+        # Validate every row, keeping the position of each invalid row so the client knows which ones to fix
+        valid, errors = [], []
+        for position, row in enumerate(rows):
+            data, row_errors = parse_bulk_row(row)
+            if row_errors:
+                errors.append({'row': position, 'message': row_errors})
+            else:
+                valid.append(data)
+
+        try:
+            created, updated = ItemModel.bulk_upsert(valid)
+        except IntegrityError: # For example a store_id that does not exist when foreign keys are enforced
+            return {'message': 'An error occured while inserting the items'}, 500
+        return {'created': created, 'updated': updated, 'errors': errors}, 200
+
+
+# Looks many items up in one request instead of one GET /item/<name> per item
+# The body is {"names": ["chair", "table"]} or {"ids": [1, 2]}, see parse_batch_request
+# Names are served from the cache when possible, and everything else is loaded with a single IN (...) query
+class ItemBatch(Resource):
+    @jwt_optional
+    def post(self):
+        field, keys = parse_batch_request()
+        if field == 'names':
+            found = {name: entry['json'] for name, entry in ItemModel.find_cached_many_by_name(keys).items()}
+        else:
+            found = {item_id: item.json() for item_id, item in ItemModel.find_many_by_id(keys).items()}
+        return batch_response('items', keys, found), 200
@@ -1,49 +1,117 @@
-# Import libraries
-from flask_restful import Resource, reqparse
-from flask_jwt import jwt_required
-from models.store import StoreModel
-
-class Store(Resource):
-
-    # Retrieves the store object if it exists otherwise returns an error
-    def get(self, name):
-        # Create an object of type StoreModel using the name
-        store = StoreModel.find_by_name(name)
-        # if the store exists, return the json string
-        if store:
-            return store.json()
-        # if the store does not exist, return an error
-        return {'Message': 'Store not found!'}, 404
-
-    # Creates a new store and saves it in the database
-    def post(self, name):
-        # Check whether the store already exists, if so return an error
-        if StoreModel.find_by_name(name):
-            return {'Message': f'Store {name} already exists!'}, 400
-        
-        # If the store does not exist, instantiate a new object
-        store = StoreModel(name)
-        try: # Try saving the store to the database
-            store.save_to_db()
-            return store.json(), 201
-        except: # If an error occurs
-            return {'Message': 'An error occurred while creating the store.'}, 500
-
-    def delete(self, name):
-        # Check whether the store exists
-        store = StoreModel.find_by_name(name)
-        # If the store exists, delete it from the database
-        if store:
-            store.delete_from_db()
-            return {'Message': 'Store Deleted'}
-        else:
-            return {'Message': 'Store does not exist'}
-
-# Return a list of stores and their properties
-class StoreList(Resource):
-    def get(self):
-        # The find_all() method returns a list of all items in the DB as objects, 
-        # but we cannot return objects, we need to convert them into JSON
-        # So we use a list comprehension to convert each object into JSON
-        return {'stores': [store.json for store in StoreModel.find_all()]}
-
+# Import libraries
+from flask_restful import Resource, reqparse
+from sqlalchemy.exc import IntegrityError
+from flask_jwt_extended import jwt_required
+from models.store import StoreModel
+from conditional import validator_headers, not_modified, not_modified_response, collection_etag
+from db import timestamp
+from schemas import parse_batch_request, batch_response
+from pagination import page_args, next_link, split_page, stream_json_array, STREAM_BATCH_SIZE
+
+# How a store is represented, for /store/<name> and /stores
+# ?fields=summary answers with the precomputed aggregates of the store instead of its items (see StoreModel.summary),
+# and ?expand=items adds the items to the summary. Without either, a store is its id, name and items, like it always was
+view_parser = reqparse.RequestParser()
+view_parser.add_argument('fields', type=str, location='args', choices=('full', 'summary'), default='full')
+view_parser.add_argument('expand', type=str, location='args', choices=('items',))
+
+
+# Returns (summary, with_items) from the query string. req defaults to Flask's request, like in pagination.page_args
+def store_view(req=None):
+    args = view_parser.parse_args(req)
+    return args['fields'] == 'summary', args['expand'] == 'items'
+
+
+class Store(Resource):
+
+    # Retrieves the store object if it exists otherwise returns an error
+    # Query string: ?fields=summary&expand=items, see view_parser
+    def get(self, name):
+        summary, with_items = store_view()
+        if summary:
+            # One row, whatever the number of items, unless they are asked for as well
+            store = StoreModel.find_summary_by_name(name, with_items)
+        else:
+            # Retrieve the JSON of the store from the cache, falling back to the database
+            store = StoreModel.find_cached_by_name(name)
+        # if the store exists, return the json string
+        if store:
+            headers = validator_headers(store['etag'], store['updated_at'])
+            # The client sent the ETag or date of the copy it already has and nothing changed since then
+            if not_modified(store['etag'], store['updated_at']):
+                return not_modified_response(headers)
+            return store['json'], 200, headers
+        # if the store does not exist, return an error
+        return {'Message': 'Store not found!'}, 404
+
+    # Creates a new store and saves it in the database
+    def post(self, name):
+        # Check whether the store already exists, if so return an error
+        if StoreModel.find_by_name(name):
+            return {'Message': f'Store {name} already exists!'}, 400
+        
+        # If the store does not exist, instantiate a new object
+        store = StoreModel(name)
+        try: # Try saving the store to the database
+            store.save_to_db()
+            return store.json(), 201
+        except IntegrityError: # Another request created a store with the same name after our check above
+            return {'Message': f'Store {name} already exists!'}, 400
+        except: # If an error occurs
+            return {'Message': 'An error occurred while creating the store.'}, 500
+
+    def delete(self, name):
+        # Check whether the store exists
+        store = StoreModel.find_by_name(name)
+        # If the store exists, delete it from the database
+        if store:
+            store.delete_from_db()
+            return {'Message': 'Store Deleted'}
+        else:
+            return {'Message': 'Store does not exist'}
+
+# Return a list of stores and their properties
+class StoreList(Resource):
+    # Query string: ?limit=<page size>&cursor=<id of the last store seen>&stream=<true to stream every store>
+    # plus ?fields=summary&expand=items, see view_parser
+    def get(self):
+        limit, cursor, stream = page_args()
+        summary, with_items = store_view()
+
+        # Summaries without items never read the items table
+        def to_json(stores):
+            return StoreModel.summary_many(stores, with_items) if summary else StoreModel.json_many(stores)
+
+        # Streaming mode writes the JSON array as we read the table
+        # Every batch of stores loads all of its items with one extra query
+        if stream:
+            batches = (to_json(batch) for batch in StoreModel.iter_batches(STREAM_BATCH_SIZE, cursor))
+            return stream_json_array('stores', batches)
+
+        # A store gets a new version whenever one of its items changes, so aggregates over the stores alone
+        # are enough to build the ETag of the page
+        count, versions, updated_at, max_id = StoreModel.collection_version()
+        etag = collection_etag('stores', count, versions, updated_at, max_id)
+        headers = validator_headers(etag, timestamp(updated_at))
+        if not_modified(etag, timestamp(updated_at)):
+            return not_modified_response(headers)
+
+        # Ask for one extra row so we know whether there is another page after this one
+        stores, next_cursor = split_page(StoreModel.find_page(limit + 1, cursor), limit)
+        # json_many() converts the stores into JSON and loads the items of the whole page in a single query
+        return {'stores': to_json(stores), 'next_cursor': next_cursor, 'next': next_link(next_cursor)}, 200, headers
+
+
+# Looks many stores up in one request instead of one GET /store/<name> per store
+# The body is {"names": ["ikea", "target"]} or {"ids": [1, 2]}, see parse_batch_request
+# The stores are loaded with one IN (...) query and the items of all of them with one more
+class StoreBatch(Resource):
+    def post(self):
+        field, keys = parse_batch_request()
+        if field == 'names':
+            found = {name: entry['json'] for name, entry in StoreModel.find_cached_many_by_name(keys).items()}
+        else:
+            stores = StoreModel.find_many_by_id(keys)
+            items = StoreModel.load_items(list(stores.values()))
+            found = {store_id: store.json(items[store_id]) for store_id, store in stores.items()}
+        return batch_response('stores', keys, found), 200
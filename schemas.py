@@ -0,0 +1,185 @@
+# Import libraries
+import json
+from operator import attrgetter
+from flask import request, make_response
+from flask_restful import abort
+
+# orjson is an optional, much faster JSON encoder. Without it we fall back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# A single field of a request body. Works like reqparse's add_argument(name, type=..., required=..., help=...)
+class Field:
+    __slots__ = ('name', 'type', 'required', 'help', 'default')
+
+    def __init__(self, name, type=str, required=False, help=None, default=None):
+        self.name = name
+        self.type = type
+        self.required = required
+        self.help = help
+        self.default = default
+
+    # Returns the message reqparse would send for this field, so the responses do not change
+    def error(self, message):
+        return self.help.format(error_msg=message) if self.help else message
+
+
+# Validates request bodies. A drop-in replacement for reqparse.RequestParser that builds its field list once,
+# instead of creating an Argument and copying the request for every field of every request
+class RequestSchema:
+    def __init__(self, *fields):
+        self.fields = fields
+
+    # Validates and converts a dictionary. Returns the data and a dictionary of field -> error message
+    # Unless bundle is True, we stop at the first error like reqparse does
+    def validate(self, source, bundle=False):
+        data = {}
+        errors = {}
+        for field in self.fields:
+            if field.name not in source:
+                if field.required:
+                    errors[field.name] = field.error('Missing required parameter in the JSON body or the post body or the query string')
+                    if not bundle:
+                        break
+                data[field.name] = field.default
+                continue
+            value = source[field.name]
+            # Like reqparse, an explicit null is allowed through without conversion
+            if value is None:
+                data[field.name] = None
+                continue
+            try:
+                data[field.name] = field.type(value)
+            except (TypeError, ValueError) as error:
+                errors[field.name] = field.error(str(error))
+                if not bundle:
+                    break
+        return data, errors
+
+    # Same as reqparse's parse_args(): reads the JSON body (or the form and query string if there is no JSON body)
+    # and aborts with 400 and {'message': {field: error}} if a field is missing or invalid
+    # Like reqparse, req defaults to Flask's request
+    def parse_args(self, req=None):
+        if req is None:
+            req = request
+        source = req.get_json(silent=True)
+        if not isinstance(source, dict):
+            source = req.values
+        data, errors = self.validate(source)
+        if errors:
+            abort(400, message=errors)
+        return data
+
+
+# Turns model objects into dictionaries
+# operator.attrgetter reads every field of an object in one call made in C, so dumping an object costs about
+# the same as a hand-written dictionary and there is no per-field loop in Python at request time
+class ResponseSchema:
+    def __init__(self, *names):
+        if not names:
+            raise ValueError('A ResponseSchema needs at least one field')
+        self.names = names
+        getter = attrgetter(*names)
+        if len(names) == 1:
+            # attrgetter returns the value itself rather than a tuple for a single name
+            self.dump = lambda obj: {names[0]: getter(obj)}
+        else:
+            self.dump = lambda obj: dict(zip(names, getter(obj)))
+
+    def dump_many(self, objs):
+        dump = self.dump
+        return [dump(obj) for obj in objs]
+
+
+# The JSON encoder used for every response. Set with configure_json()
+_dumps = None
+
+
+def _stdlib_dumps(data):
+    return json.dumps(data)
+
+
+def _orjson_dumps(data):
+    # orjson returns bytes, which Flask can send as they are
+    return orjson.dumps(data)
+
+
+# Picks the JSON encoder from JSON_BACKEND: 'auto' (orjson when it is installed, the default), 'orjson' or 'stdlib'
+def configure_json(app):
+    global _dumps
+    backend = app.config.get('JSON_BACKEND', 'auto')
+    if backend == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_BACKEND is orjson but orjson is not installed')
+    if backend in ('auto', 'orjson') and orjson is not None:
+        _dumps = _orjson_dumps
+    elif backend in ('auto', 'stdlib'):
+        _dumps = _stdlib_dumps
+    else:
+        raise ValueError(f'Unknown JSON_BACKEND {backend}')
+
+
+# Encodes data with the configured encoder, returns str or bytes
+def dumps(data):
+    return (_dumps or _stdlib_dumps)(data)
+
+
+# Replaces Flask-RESTful's default JSON representation, which always uses the standard library encoder
+# Register it with api.representation('application/json')(output_json)
+def output_json(data, code, headers=None):
+    # Flask-RESTful ends every JSON response with a newline, so we do as well
+    body = dumps(data)
+    response = make_response(body + (b'\n' if isinstance(body, bytes) else '\n'), code)
+    response.headers.extend(headers or {})
+    response.mimetype = 'application/json'
+    return response
+
+
+# How many names or ids a single batch request can ask for
+MAX_BATCH_KEYS = 1000
+
+
+# Reads the body of a batch lookup, {"names": [...]} or {"ids": [...]}, and returns ('names' or 'ids', list of keys)
+# Aborts with 400 when the body is anything else, has too many keys or keys of the wrong type
+def parse_batch_request():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or len(body) != 1 or not ({'names', 'ids'} & body.keys()):
+        abort(400, message='The body must be {"names": [...]} or {"ids": [...]}')
+    field, keys = next(iter(body.items()))
+    if not isinstance(keys, list):
+        abort(400, message={field: 'Must be a list'})
+    if len(keys) > MAX_BATCH_KEYS:
+        abort(400, message={field: f'At most {MAX_BATCH_KEYS} keys can be looked up at once'})
+    # bool is a subclass of int, but true is not an id
+    key_type = str if field == 'names' else int
+    if not all(isinstance(key, key_type) and not isinstance(key, bool) for key in keys):
+        abort(400, message={field: 'Every name must be a string' if field == 'names' else 'Every id must be an integer'})
+    return field, keys
+
+
+# The response of a batch lookup: found is a dictionary of key -> JSON. The results are in the order of the keys
+# of the request, with null for every key that does not exist, and the missing keys are listed in not_found as well
+def batch_response(name, keys, found):
+    return {name: [found.get(key) for key in keys], 'not_found': [key for key in keys if key not in found]}
+
+
+# Request bodies, with the same rules and messages the reqparse parsers had
+item_request = RequestSchema(
+    Field('price', type=float, required=True, help="This field cannot be left blank!"),
+    Field('store_id', type=int, required=True, help="Every Item must belong to a Store!"),
+)
+# A row of POST /items/bulk is an item body plus the name, which is part of the URL for a single item
+bulk_item_request = RequestSchema(
+    Field('name', type=str, required=True, help="This field cannot be left blank!"),
+    *item_request.fields
+)
+user_request = RequestSchema(
+    Field('username', type=str, required=True, help="This field cannot be left blank!"),
+    Field('password', type=str, required=True, help="This field cannot be left blank!"),
+)
+
+# Responses, used by the json() methods of the models
+item_response = ResponseSchema('id', 'name', 'price', 'store_id')
+user_response = ResponseSchema('id', 'username')
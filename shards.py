@@ -0,0 +1,338 @@
+# Import libraries
+import os
+import sys
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, orm, select, func, text
+from db import db, chunks, engine_options, set_sqlite_pragmas
+from metrics import metrics
+
+# Item ids are handed out by the primary database in blocks of this size, so a worker asks it once per ID_BLOCK_SIZE new items
+ID_BLOCK_SIZE = 1000
+# Rows per transaction when the offline tool moves the items of a store
+MOVE_BATCH_SIZE = 5000
+
+# The next item id of the sharded mode. The shards cannot number the items themselves, because an id has to be
+# unique across every shard and stay the same when its item moves to another shard
+id_blocks = db.Table('id_blocks',
+                     db.Column('name', db.String(40), primary_key=True),
+                     db.Column('next_id', db.Integer, nullable=False))
+
+
+# Horizontal sharding of the items by store
+# The items are spread over several databases, the shards, and all the items of a store live in the same shard,
+# so the writes to stores in different shards never wait on the same lock. The users, the stores, their aggregates
+# and the change log stay in the primary database (DATABASE_URL). The shard of every store is its shard column,
+# set when the store is created and changed by the offline tool at the bottom of this file
+# Every shard has the whole schema (see migrations.upgrade_db), only its items table is used
+# A lookup that does not know the store (an item by name or by id, a page of /items) asks every shard at the
+# same time on a pool of threads and merges the answers (see scatter)
+class ShardSet:
+    def __init__(self):
+        self.enabled = False
+        self.urls = []
+        self.engines = []
+        self._sessions = []
+        self._executor = None
+        # store id -> shard of the stores we have looked up, the placement only changes while the API is stopped
+        self._placement = {}
+        # The item ids of the block this worker has reserved, see next_ids
+        self._ids = iter(())
+        self._ids_left = 0
+        self._ids_pid = None
+        self._lock = threading.Lock()
+
+    # Configuration keys:
+    # DB_SHARDS: the number of shards. For SQLite they are files next to DATABASE_URL, data.shard0.db, data.shard1.db...
+    # 0 (the default) turns sharding off and every item lives in the primary database
+    # DATABASE_SHARD_URLS: a comma separated list of database URLs to use as the shards instead
+    # DB_SHARD_WORKERS: threads of every worker that query the shards in parallel
+    def init_app(self, app):
+        self.urls = shard_urls(app.config)
+        self.enabled = bool(self.urls)
+        self.engines, self._sessions, self._placement = [], [], {}
+        # A process that creates another app (the benchmarks do) reserves its ids from the new primary database
+        self._ids_left = 0
+        if not self.enabled:
+            return
+        for url in self.urls:
+            engine = create_engine(url, **engine_options(dict(app.config, SQLALCHEMY_DATABASE_URI=url)))
+            set_sqlite_pragmas(engine, app.config)
+            self.engines.append(engine)
+            # The objects we load are used after their session is closed, so the commit must not expire them
+            self._sessions.append(orm.sessionmaker(bind=engine, expire_on_commit=False))
+        self._executor = ThreadPoolExecutor(max_workers=app.config.get('DB_SHARD_WORKERS', 8), thread_name_prefix='shards')
+
+    # Closes the connections of every shard, so a process that forks does not share them with its children
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+    # A new session on a shard. The caller commits and closes it
+    def session(self, shard):
+        return self._sessions[shard]()
+
+    # Where a new store goes
+    def place(self, store_id):
+        return store_id % len(self.engines)
+
+    # Returns the shard of every store id as a dictionary. Must run in an application context
+    # None (an item without a store) has no shard. A store id that does not exist (any more) gets the shard
+    # place() would give it, so its items are still found in the same shard every time
+    def placement(self, store_ids):
+        # Imported here because models/store.py imports this file
+        from models.store import StoreModel
+
+        shards = {store_id: self._placement.get(store_id) for store_id in set(store_ids) if store_id is not None}
+        missing = [store_id for store_id, shard in shards.items() if shard is None]
+        for chunk in chunks(missing):
+            for store_id, shard in db.session.query(StoreModel.id, StoreModel.shard).filter(StoreModel.id.in_(chunk)):
+                if shard is not None:
+                    shards[store_id] = self._placement[store_id] = shard
+        return {store_id: self.place(store_id) if shard is None else shard for store_id, shard in shards.items()}
+
+    def shard_for(self, store_id):
+        return self.placement([store_id]).get(store_id)
+
+    # Runs func(session, shard) on every shard in shard_ids (every shard by default) at the same time, each on a
+    # thread of the pool with a session of its own, and returns their results in the same order
+    # The objects func loads are closed out of their session and know their shard (ItemModel.shard)
+    def scatter(self, func, shard_ids=None):
+        shard_ids = list(range(len(self.engines)) if shard_ids is None else shard_ids)
+        if len(shard_ids) == 1:
+            results = [self._run(func, shard_ids[0])]
+        else:
+            results = [future.result() for future in [self._executor.submit(self._run, func, shard) for shard in shard_ids]]
+        # The statements ran on other threads, so they are added to the metrics of the request here
+        for result, statements, seconds in results:
+            metrics.record_db_statements(statements, seconds)
+        return [result for result, _, _ in results]
+
+    def _run(self, func, shard):
+        session = self.session(shard)
+        try:
+            with metrics.count_statements() as counter:
+                result = func(session, shard)
+            for instance in session.identity_map.values():
+                instance.shard = shard
+            return result, counter[0], counter[1]
+        finally:
+            session.close()
+
+    # Reserves count new item ids. Must run in an application context
+    def next_ids(self, count):
+        with self._lock:
+            # A forked worker must not hand out the ids of the block its parent reserved
+            if self._ids_pid != os.getpid():
+                self._ids_pid, self._ids_left = os.getpid(), 0
+            ids = []
+            while len(ids) < count:
+                if not self._ids_left:
+                    self._ids_left = max(ID_BLOCK_SIZE, count - len(ids))
+                    self._ids = iter(self._reserve(self._ids_left))
+                ids.append(next(self._ids))
+                self._ids_left -= 1
+            return ids
+
+    # Takes the next count ids from the id_blocks table of the primary database, in a transaction of its own
+    # so the lock of the primary is only held for that long
+    def _reserve(self, count):
+        with db.engine.begin() as conn:
+            updated = conn.execute(id_blocks.update().where(id_blocks.c.name == 'items')
+                                   .values(next_id=id_blocks.c.next_id + count)).rowcount
+            if not updated:
+                # The first id ever: continue after the highest id of the primary and of every shard
+                start = max([highest_item_id(conn)] + [highest_engine_item_id(engine) for engine in self.engines]) + 1
+                conn.execute(id_blocks.insert().values(name='items', next_id=start + count))
+            end = conn.execute(select(id_blocks.c.next_id).where(id_blocks.c.name == 'items')).scalar()
+        return range(end - count, end)
+
+
+# The highest item id in the database of a connection, 0 while it has no items
+def highest_item_id(conn):
+    return conn.execute(text('SELECT COALESCE(MAX(id), 0) FROM items')).scalar()
+
+
+# Same as highest_item_id on a connection of its own to engine
+def highest_engine_item_id(engine):
+    with engine.connect() as conn:
+        return highest_item_id(conn)
+
+
+# The URLs of the shards, out of the DATABASE_SHARD_URLS and DB_SHARDS settings
+def shard_urls(config):
+    urls = [url.strip() for url in config.get('DATABASE_SHARD_URLS', '').split(',') if url.strip()]
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if not urls and config.get('DB_SHARDS', 0):
+        if not uri.startswith('sqlite:///') or uri == 'sqlite:///:memory:':
+            raise ValueError('DB_SHARDS needs a SQLite database file, set DATABASE_SHARD_URLS instead')
+        root, extension = os.path.splitext(uri)
+        urls = [f'{root}.shard{number}{extension or ".db"}' for number in range(config['DB_SHARDS'])]
+    return urls
+
+
+shards = ShardSet()
+
+
+''' The offline tool. Stop the API first: every worker remembers where the stores are '''
+
+# The engine of a shard, or of the primary database for None
+def _engine(shard):
+    return db.engine if shard is None else shards.engines[shard]
+
+
+# Copies the items of a store from one database to another with their ids, then points the store at its new shard
+# and deletes the items from the old one. Every step can be run again, so a move that stopped halfway is finished
+# by running it again. source None is the primary database, which is where the items were before sharding
+def move_store(store_id, source, target):
+    from models.item import ItemModel
+    from models.store import StoreModel
+
+    if source == target:
+        return 0
+    items = ItemModel.__table__
+    where = items.c.store_id.is_(None) if store_id is None else items.c.store_id == store_id
+    moved, last_id = 0, 0
+    # Rows left behind by a move that stopped halfway
+    with _engine(target).begin() as conn:
+        conn.execute(items.delete().where(where))
+    while True:
+        with _engine(source).connect() as conn:
+            rows = [dict(row._mapping) for row in conn.execute(select(items).where(where, items.c.id > last_id)
+                                                                        .order_by(items.c.id).limit(MOVE_BATCH_SIZE))]
+        if not rows:
+            break
+        with _engine(target).begin() as conn:
+            conn.execute(items.insert(), rows)
+        moved += len(rows)
+        last_id = rows[-1]['id']
+    if store_id is not None:
+        StoreModel.query.filter_by(id=store_id).update({StoreModel.shard: target})
+        db.session.commit()
+    with _engine(source).begin() as conn:
+        conn.execute(items.delete().where(where))
+    return moved
+
+
+# The number of items of every store on every shard: {shard: {store_id: count}}
+def shard_loads():
+    from models.item import ItemModel
+
+    items = ItemModel.__table__
+    loads = {}
+    for shard, engine in enumerate(shards.engines):
+        with engine.connect() as conn:
+            loads[shard] = dict(conn.execute(select(items.c.store_id, func.count()).group_by(items.c.store_id)).all())
+    return loads
+
+
+# Moves every item of the primary database to the shard of its store. Run it once, when sharding is turned on
+def init_shards():
+    from models.item import ItemModel
+    from models.store import StoreModel
+
+    items = ItemModel.__table__
+    with db.engine.connect() as conn:
+        store_ids = [store_id for (store_id,) in conn.execute(select(items.c.store_id).distinct())]
+    for store in StoreModel.query.filter(StoreModel.shard.is_(None)):
+        store.shard = shards.place(store.id)
+    db.session.commit()
+    placement = shards.placement([store_id for store_id in store_ids if store_id is not None])
+    for store_id in store_ids:
+        target = 0 if store_id is None else placement[store_id]
+        print(f'Store {store_id}: {move_store(store_id, None, target)} items moved to shard {target}')
+
+
+# Plans the moves that even out the number of items per shard: the largest store of the fullest shard that fits
+# in half the gap goes to the emptiest shard, until no store fits. Only moves stores whose move narrows the gap
+def plan_rebalance(loads, sources=None, targets=None):
+    totals = {shard: sum(stores.values()) for shard, stores in loads.items()}
+    stores = {shard: dict(counts) for shard, counts in loads.items()}
+    sources = list(totals) if sources is None else sources
+    targets = list(totals) if targets is None else targets
+    moves = []
+    while True:
+        source = max(sources, key=lambda shard: totals[shard])
+        target = min(targets, key=lambda shard: totals[shard])
+        gap = totals[source] - totals[target]
+        fitting = [(count, store_id) for store_id, count in stores[source].items() if 0 < count <= gap / 2 and store_id is not None]
+        if source == target or not fitting:
+            return moves
+        count, store_id = max(fitting)
+        moves.append((store_id, source, target, count))
+        del stores[source][store_id]
+        stores[target][store_id] = count
+        totals[source] -= count
+        totals[target] += count
+
+
+# Recomputes the aggregates of every store from its shard, for example after a crash between the commit of a
+# shard and the commit of the primary database (see ItemModel._write_sharded)
+def recount():
+    from models.item import ItemModel
+    from models.store import StoreModel
+
+    items = ItemModel.__table__
+    aggregates = {}
+    for engine in shards.engines:
+        with engine.connect() as conn:
+            for row in conn.execute(select(items.c.store_id, func.count(), func.coalesce(func.sum(items.c.price), 0),
+                                           func.min(items.c.price), func.max(items.c.price)).group_by(items.c.store_id)):
+                aggregates[row[0]] = row[1:]
+    for store in StoreModel.query:
+        store.item_count, store.price_sum, store.min_price, store.max_price = aggregates.get(store.id, (0, 0, None, None))
+        store.version = StoreModel.version + 1
+        store.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+# Run `python shards.py <command>` with the same settings as the API, for example DB_SHARDS=4:
+# status: the number of stores and items of every shard
+# init: moves the items of the primary database to the shards, once, when sharding is turned on
+# move <store id> <shard>: moves a store and its items to another shard
+# split <shard> <new shard>: moves about half of the items of a shard to another (typically new and empty) shard.
+# To add a shard, raise DB_SHARDS (or add a URL to DATABASE_SHARD_URLS) and split the fullest shard into it
+# rebalance: moves stores until every shard has about the same number of items
+# recount: recomputes the aggregates of every store
+# split and rebalance print their plan and stop there unless --apply is given
+if __name__ == '__main__':
+    from app import create_app
+    from migrations import upgrade_db
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=('status', 'init', 'move', 'split', 'rebalance', 'recount'))
+    parser.add_argument('arguments', type=int, nargs='*')
+    parser.add_argument('--apply', action='store_true')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if not shards.enabled:
+            sys.exit('Sharding is off, set DB_SHARDS or DATABASE_SHARD_URLS')
+        # Creates the shards that do not exist yet
+        upgrade_db()
+        if args.command == 'status':
+            for shard, stores in shard_loads().items():
+                print(f'Shard {shard} ({shards.urls[shard]}): {len(stores)} stores, {sum(stores.values())} items')
+        elif args.command == 'init':
+            init_shards()
+        elif args.command == 'move':
+            store_id, target = args.arguments
+            print(f'{move_store(store_id, shards.shard_for(store_id), target)} items moved to shard {target}')
+        elif args.command == 'recount':
+            recount()
+        else:
+            loads = shard_loads()
+            if args.command == 'split':
+                source, target = args.arguments
+                moves = plan_rebalance(loads, [source], [target])
+            else:
+                moves = plan_rebalance(loads)
+            for store_id, source, target, count in moves:
+                print(f'Store {store_id}: {count} items from shard {source} to shard {target}')
+                if args.apply:
+                    move_store(store_id, source, target)
+            if moves and not args.apply:
+                print('Run again with --apply to move them')
@@ -0,0 +1,297 @@
+# Import libraries
+import os
+import json
+import glob
+import time
+import uuid
+import fcntl
+import atexit
+import logging
+import itertools
+import threading
+from sqlalchemy.orm.attributes import set_committed_value
+from cache import cache
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# What the queue does with an update before PUT /item/<name> is answered:
+# 'memory' keeps it in memory only, so the updates that were not flushed yet are lost if the worker dies
+# 'journal' also appends it to a journal file, which survives the worker but not the machine
+# 'fsync' appends it to the journal and waits for the disk, which survives a power cut as well but costs a disk write per update
+DURABILITY_MODES = ('memory', 'journal', 'fsync')
+# Seconds the flush thread waits before it tries again when a flush failed
+RETRY_DELAY = 1
+
+
+# Raised when the queue is full and stayed full for WRITE_BEHIND_ENQUEUE_TIMEOUT, the request should be rejected
+class WriteQueueFull(Exception):
+    pass
+
+
+# Write-behind (write coalescing) for the price updates of PUT /item/<name>
+# An update is acknowledged as soon as it is queued. A thread of the worker flushes the queue with bulk_upsert, in one
+# transaction per WRITE_BEHIND_MAX_BATCH items, once that many items are waiting or WRITE_BEHIND_MAX_DELAY_MS after the
+# first of them arrived. Several updates of the same item before a flush become one, the last price wins
+# find_by_name shows the queued prices (see overlay), so a client reads its own writes from the worker it wrote to
+# Other workers, the item lists and the stores see the new price once it is flushed
+class WriteBehindQueue:
+    def __init__(self):
+        self.enabled = False
+        self.max_batch = 500
+        self.max_delay = 0.05
+        self.max_pending = 10000
+        self.enqueue_timeout = 1.0
+        self.durability = 'memory'
+        self.journal_dir = 'write-behind'
+        self._app = None
+        # Guards everything below. Requests waiting for room in a full queue, and the flush thread, wait on it
+        self._condition = threading.Condition()
+        # name -> (price, number of the update) of the updates that have not been flushed yet
+        self._pending = {}
+        # The same for the updates the flush thread is writing right now. They are still pending until the commit
+        self._flushing = {}
+        # When the oldest update of _pending arrived, the flush is due max_delay later
+        self._oldest = None
+        # No flush before this time, set when a flush failed so the thread does not retry in a tight loop
+        self._retry_at = 0
+        self._numbers = itertools.count(1)
+        # The journal file the updates are appended to, and the older ones that can go once their updates are flushed
+        # They all stay open until they are deleted, since the lock on an open file is what tells that a worker still owns it
+        self._journal = None
+        self._journal_path = None
+        self._closed_journals = []
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        # Names the journals of this process. Not the pid, a pid is used again by the workers of a restarted container
+        self._token = None
+
+    # Configuration keys:
+    # WRITE_BEHIND_ENABLED: queue the price updates of PUT /item/<name> instead of committing them (off by default)
+    # WRITE_BEHIND_MAX_BATCH: flush as soon as this many items are waiting, also the size of a flush transaction
+    # WRITE_BEHIND_MAX_DELAY_MS: flush at the latest this many milliseconds after the oldest waiting update arrived
+    # WRITE_BEHIND_MAX_PENDING: how many items can wait in the queue of a worker, counting the ones being flushed. Updates to an item that is already
+    # waiting always fit, since they replace the queued price
+    # WRITE_BEHIND_ENQUEUE_TIMEOUT: seconds an update waits for room in a full queue before the request gets a 503
+    # WRITE_BEHIND_DURABILITY: 'memory', 'journal' or 'fsync', see DURABILITY_MODES
+    # WRITE_BEHIND_JOURNAL_DIR: where the journal files are kept, one per worker
+    def init_app(self, app):
+        # A process that creates another app (the benchmarks do) writes what it queued for the previous one first
+        if self._pid == os.getpid():
+            self.flush()
+        self._app = app
+        self.enabled = app.config.get('WRITE_BEHIND_ENABLED', False)
+        self.max_batch = app.config.get('WRITE_BEHIND_MAX_BATCH', 500)
+        self.max_delay = app.config.get('WRITE_BEHIND_MAX_DELAY_MS', 50) / 1000
+        self.max_pending = app.config.get('WRITE_BEHIND_MAX_PENDING', 10000)
+        self.enqueue_timeout = app.config.get('WRITE_BEHIND_ENQUEUE_TIMEOUT', 1.0)
+        self.durability = app.config.get('WRITE_BEHIND_DURABILITY', 'memory')
+        self.journal_dir = app.config.get('WRITE_BEHIND_JOURNAL_DIR', 'write-behind')
+        if self.durability not in DURABILITY_MODES:
+            raise ValueError(f'Unknown WRITE_BEHIND_DURABILITY {self.durability}')
+        metrics.write_queue_depth.set_function(self.depth)
+        with self._condition:
+            if self._pid == os.getpid():
+                # The thread is already running, only the journal follows the new settings
+                if self._journal is not None:
+                    self._closed_journals.append(self._close_journal())
+                if self.durability != 'memory':
+                    os.makedirs(self.journal_dir, exist_ok=True)
+                    self._open_journal()
+
+    # How many items are waiting to be written, including the ones being written right now
+    def depth(self):
+        with self._condition:
+            return self._depth()
+
+    # Must be called with the lock held
+    def _depth(self):
+        return len(self._pending) + len(self._flushing)
+
+    # Starts the flush thread of this process, unless it is already running. Called by the first update of a worker,
+    # so the gunicorn master never starts one. It first replays the journals that dead workers left behind
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._token = uuid.uuid4().hex
+            if self.durability != 'memory':
+                os.makedirs(self.journal_dir, exist_ok=True)
+                self._replay_journals()
+                self._open_journal()
+            threading.Thread(target=self._run, name='write-behind', daemon=True).start()
+            # A worker that is shut down cleanly writes what it still has
+            atexit.register(self.flush)
+
+    # Queues the new price of an existing item. Raises WriteQueueFull if there is no room for it in time
+    # timeout overrides WRITE_BEHIND_ENQUEUE_TIMEOUT, the async resources pass 0 so they never block the event loop
+    def enqueue(self, name, price, timeout=None):
+        self.start()
+        if timeout is None:
+            timeout = self.enqueue_timeout
+        with self._condition:
+            if name in self._pending:
+                metrics.record_write_coalesced()
+            elif not self._condition.wait_for(lambda: self._depth() < self.max_pending, timeout):
+                metrics.record_write_rejected()
+                raise WriteQueueFull()
+            number = next(self._numbers)
+            self._pending[name] = (price, number)
+            if self._journal is not None:
+                self._append(name, price)
+            # Wake the flush thread when its timer starts, and when the batch is full
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._condition.notify_all()
+            elif len(self._pending) >= self.max_batch:
+                self._condition.notify_all()
+        # The cached JSON shows the old price. The next read builds it again from find_by_name, which shows the new one
+        cache.delete(self._item_cache_key(name))
+        return number
+
+    # Returns (price, number of the update) of the latest queued update of an item, or None
+    def pending(self, name):
+        with self._condition:
+            return self._pending.get(name) or self._flushing.get(name)
+
+    # Shows the queued price on an ItemModel object without marking it as changed, so nothing is written when the
+    # session flushes. Also works on None, for the lookups that found nothing. Returns the object
+    def overlay(self, item):
+        if item is None or not (self._pending or self._flushing):
+            return item
+        pending = self.pending(item.name)
+        if pending is not None:
+            price, number = pending
+            set_committed_value(item, 'price', price)
+            item.pending = number
+        return item
+
+    def _run(self):
+        while True:
+            with self._condition:
+                # Sleep until something is queued, then until the batch is full or the oldest update is due
+                while True:
+                    if self._pending:
+                        due = self._oldest + self.max_delay if len(self._pending) < self.max_batch else 0
+                        remaining = max(due, self._retry_at) - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    else:
+                        self._condition.wait()
+            self.flush()
+
+    # Writes every queued update to the database. Returns how many items were written
+    def flush(self):
+        # Imported here because models/item.py imports this file
+        from models.item import ItemModel
+
+        with self._flush_lock:
+            with self._condition:
+                if not self._pending:
+                    return 0
+                self._flushing, self._pending, self._oldest = self._pending, {}, None
+                batch = self._flushing
+                # The updates that arrive from now on go to a new journal file, the current one can be deleted after the commit
+                if self._journal is not None:
+                    self._closed_journals.append(self._close_journal())
+                    self._open_journal()
+
+            start = time.perf_counter()
+            try:
+                with self._app.app_context():
+                    ItemModel.bulk_upsert([{'name': name, 'price': price} for name, (price, _) in batch.items()],
+                                          batch_size=self.max_batch, update_only=True)
+            except Exception:
+                logger.exception('Error while flushing %d queued item updates, they will be retried', len(batch))
+                with self._condition:
+                    # Put them back, unless a newer update of the same item arrived in the meantime
+                    for name, update in batch.items():
+                        self._pending.setdefault(name, update)
+                    self._flushing = {}
+                    if self._oldest is None:
+                        self._oldest = time.monotonic()
+                    self._retry_at = time.monotonic() + RETRY_DELAY
+                    # The updates that had arrived in the meantime may now have room
+                    self._condition.notify_all()
+                return 0
+
+            metrics.record_write_flush(time.perf_counter() - start, len(batch))
+            with self._condition:
+                self._flushing = {}
+                journals, self._closed_journals = self._closed_journals, []
+                # Requests waiting for room in a full queue can go on
+                self._condition.notify_all()
+            for path, journal in journals:
+                os.remove(path)
+                journal.close()
+            return len(batch)
+
+    @staticmethod
+    def _item_cache_key(name):
+        # Imported here because models/item.py imports this file
+        from models.item import ItemModel
+        return ItemModel.cache_key(name)
+
+    # The journal of a worker is write-behind-<token>-<n>.jsonl, one {"name", "price"} object per line
+    # The worker holds an exclusive lock on it until it is deleted. The lock goes away with the worker, however it dies
+    def _open_journal(self):
+        self._journal_path = os.path.join(self.journal_dir, f'write-behind-{self._token}-{next(self._numbers)}.jsonl')
+        self._journal = open(self._journal_path, 'a')
+        fcntl.flock(self._journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    # Stops appending to the journal. Returns (path, file), the file is closed once the path is deleted
+    def _close_journal(self):
+        journal, self._journal = self._journal, None
+        journal.flush()
+        return self._journal_path, journal
+
+    # Must be called with the lock held, the lines of two updates would get mixed up otherwise
+    def _append(self, name, price):
+        self._journal.write(json.dumps({'name': name, 'price': price}) + '\n')
+        self._journal.flush()
+        if self.durability == 'fsync':
+            os.fsync(self._journal.fileno())
+
+    # Writes the updates of the journals of workers that are gone, so what they had acknowledged is not lost
+    # A journal that can be locked has no worker any more. The lock is held during the replay, so two workers starting
+    # at the same time never replay the same one, and a journal whose replay died with its worker is replayed again
+    def _replay_journals(self):
+        from models.item import ItemModel
+
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, 'write-behind-*'))):
+            try:
+                journal = open(path)
+            except FileNotFoundError:
+                # Flushed and deleted by its worker since the glob
+                continue
+            with journal:
+                try:
+                    fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Its worker is alive, or another worker is replaying it
+                    continue
+                # Another worker may have replayed and deleted it between our open and our lock
+                try:
+                    if os.stat(path).st_ino != os.fstat(journal.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+                updates = {}
+                for line in journal:
+                    try:
+                        update = json.loads(line)
+                    except ValueError:
+                        # The last line of a journal whose worker died in the middle of writing it
+                        continue
+                    updates[update['name']] = update
+                with self._app.app_context():
+                    ItemModel.bulk_upsert(list(updates.values()), batch_size=self.max_batch, update_only=True)
+                os.remove(path)
+            logger.info('Replayed %d queued item updates from %s', len(updates), path)
+
+
+write_queue = WriteBehindQueue()
@@ -0,0 +1,4 @@
+# Entrypoint for production WSGI servers: gunicorn -c gunicorn.conf.py
+from app import create_app
+
+app = create_app()